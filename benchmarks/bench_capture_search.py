@@ -0,0 +1,149 @@
+"""
+Search latency over a relay capture, answered from the payload term index of core.capture.
+
+A capture of synthetic OCPP 2.0.1 traffic is written first (Authorize, TransactionEvent, StatusNotification,
+MeterValues and Heartbeat of many ChargePoints), then searches of different selectivity are timed.
+
+    python benchmarks/bench_capture_search.py --records 2000000 --capture-dir /tmp/capture
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from core.capture import CaptureReader, CaptureWriter  # noqa: E402
+from core.frames import Frame  # noqa: E402
+
+
+def _frames(records, charge_points, rng):
+    for seq in range(records):
+        cp = f"CP{rng.randrange(charge_points):06d}"
+        evse = rng.randint(1, 2)
+        transaction = f"tx-{cp}-{seq // 20000}"
+        kind = rng.random()
+        if kind < 0.05:
+            payload = [
+                "Authorize",
+                {
+                    "idToken": {
+                        "idToken": f"TAG{rng.randrange(10 * charge_points):07d}",
+                        "type": "ISO14443",
+                    }
+                },
+            ]
+        elif kind < 0.25:
+            payload = [
+                "TransactionEvent",
+                {
+                    "eventType": "Updated",
+                    "timestamp": "2025-01-01T00:00:00Z",
+                    "triggerReason": "MeterValuePeriodic",
+                    "seqNo": seq,
+                    "transactionInfo": {"transactionId": transaction},
+                    "evse": {"id": evse, "connectorId": 1},
+                },
+            ]
+        elif kind < 0.35:
+            payload = [
+                "StatusNotification",
+                {
+                    "timestamp": "2025-01-01T00:00:00Z",
+                    "connectorStatus": rng.choice(["Available", "Occupied", "Faulted"]),
+                    "evseId": evse,
+                    "connectorId": 1,
+                },
+            ]
+        elif kind < 0.75:
+            payload = [
+                "MeterValues",
+                {
+                    "evseId": evse,
+                    "meterValue": [
+                        {
+                            "timestamp": "2025-01-01T00:00:00Z",
+                            "sampledValue": [
+                                {
+                                    "value": seq * 10.0,
+                                    "measurand": "Energy.Active.Import.Register",
+                                }
+                            ],
+                        }
+                    ],
+                },
+            ]
+        else:
+            payload = ["Heartbeat", {}]
+        yield cp, Frame.parse(json.dumps([2, f"m{seq}", *payload]))
+
+
+async def write_capture(directory, records, charge_points, seed):
+    rng = random.Random(seed)
+    writer = CaptureWriter(directory, stream="bench", max_buffered=records + 1)
+    timestamp = time.time() - records / 1000
+    for seq, (cp, frame) in enumerate(_frames(records, charge_points, rng)):
+        writer.append(timestamp + seq / 1000, cp, "cp-csms", frame)
+        if seq % 50_000 == 0:
+            await writer.flush()
+    await writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--records", type=int, default=1_000_000)
+    parser.add_argument("--charge-points", type=int, default=1000)
+    parser.add_argument(
+        "--capture-dir", help="Reuse or keep the capture, a temporary one by default"
+    )
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    directory = Path(args.capture_dir or tempfile.mkdtemp(prefix="capture-search-"))
+    if not any(directory.glob("*.cap")):
+        started = time.perf_counter()
+        asyncio.run(
+            write_capture(directory, args.records, args.charge_points, args.seed)
+        )
+        elapsed = time.perf_counter() - started
+        print(
+            f"Captured {args.records} frames in {elapsed:.1f} s ({args.records / elapsed:.0f}/s)"
+        )
+
+    reader = CaptureReader(directory)
+    started = time.perf_counter()
+    count = reader.count()
+    print(
+        f"Loaded the index of {count} frames in {time.perf_counter() - started:.2f} s\n"
+    )
+
+    searches = {
+        "idTag (one tag)": "idTag=TAG0000042",
+        "transactionId": "transactionId=tx-CP000042-25",
+        "transactionId + evseId": "transactionId=tx-CP000042-25 evseId=2",
+        "status + charge point": "status=Faulted charge_point_id=CP000042",
+        "action (newest 100)": "action=MeterValues",
+        "no match": "idTag=UNKNOWN",
+    }
+    print(f"{'Search':<26}{'Matches':>9}{'p50 (ms)':>11}{'max (ms)':>11}")
+    for name, text in searches.items():
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            records = reader.search(text, limit=100)
+            timings.append((time.perf_counter() - started) * 1000)
+        print(
+            f"{name:<26}{len(records):>9}{statistics.median(timings):>11.2f}{max(timings):>11.2f}"
+        )
+    reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import json
+import sys
+import timeit
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from core.frames import Frame  # noqa: E402
+
+
+def heartbeat_frame():
+    return json.dumps([2, str(uuid.uuid4()), "Heartbeat", {}])
+
+
+def meter_values_frame(samples):
+    sampled_values = [
+        {
+            "value": 1234.5 + i,
+            "measurand": "Energy.Active.Import.Register",
+            "unitOfMeasure": {"unit": "Wh"},
+            "context": "Sample.Periodic",
+        }
+        for i in range(10)
+    ]
+    meter_value = [
+        {"timestamp": "2025-01-01T00:00:00Z", "sampledValue": sampled_values}
+        for _ in range(samples)
+    ]
+    return json.dumps(
+        [2, str(uuid.uuid4()), "MeterValues", {"evseId": 1, "meterValue": meter_value}]
+    )
+
+
+def json_decode(message):
+    return json.loads(message)[1]
+
+
+def header_only(message):
+    return Frame.parse(message).message_id
+
+
+def main():
+    frames = {
+        "Heartbeat": heartbeat_frame(),
+        "MeterValues (small)": meter_values_frame(1),
+        "MeterValues (large)": meter_values_frame(40),
+    }
+    print(
+        f"{'Frame':<22}{'Size (B)':>10}{'json.loads (µs)':>18}{'Frame.parse (µs)':>19}{'Speed-up':>10}"
+    )
+    for name, message in frames.items():
+        runs = 20000 if len(message) < 4096 else 2000
+        decode = min(timeit.repeat(lambda: json_decode(message), number=runs, repeat=5))
+        header = min(timeit.repeat(lambda: header_only(message), number=runs, repeat=5))
+        decode_us, header_us = decode / runs * 1e6, header / runs * 1e6
+        print(
+            f"{name:<22}{len(message):>10}{decode_us:>18.2f}{header_us:>19.2f}{decode_us / header_us:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
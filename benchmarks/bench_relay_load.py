@@ -0,0 +1,582 @@
+"""
+Load and latency benchmark of the relay, using example_endpoint/csms.py as the CSMS.
+
+The same workload runs twice, once with the simulated ChargePoints connected straight to the CSMS and once through the
+relay. The latency the relay adds is the difference between both runs at each percentile.
+
+    python benchmarks/bench_relay_load.py --charge-points 1000 --duration 30 --output results.json
+    python benchmarks/bench_relay_load.py --baseline results.json
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from array import array
+from pathlib import Path
+
+import websockets
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+from core.frames import CALL, CALLRESULT, Frame  # noqa: E402
+
+CSMS_PORT = 9000
+PERCENTILES = {"p50": 50, "p90": 90, "p99": 99, "p999": 99.9}
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def _payload(action, rng):
+    timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    if action == "Heartbeat":
+        return {}
+    if action == "StatusNotification":
+        return {
+            "timestamp": timestamp,
+            "connectorStatus": rng.choice(["Available", "Occupied"]),
+            "evseId": 1,
+            "connectorId": 1,
+        }
+    if action == "MeterValues":
+        return {
+            "evseId": 1,
+            "meterValue": [
+                {
+                    "timestamp": timestamp,
+                    "sampledValue": [
+                        {
+                            "value": rng.uniform(0, 100000),
+                            "measurand": measurand,
+                            "unitOfMeasure": {"unit": unit},
+                        }
+                        for measurand, unit in (
+                            ("Energy.Active.Import.Register", "Wh"),
+                            ("Power.Active.Import", "W"),
+                            ("Current.Import", "A"),
+                            ("Voltage", "V"),
+                        )
+                    ],
+                }
+            ],
+        }
+    raise ValueError(f"No payload for {action}")
+
+
+class SimulatedChargePoint:
+    """
+    Sends calls at a fixed rate, one outstanding call at a time, and answers TriggerMessage like example_endpoint/cp.py
+    does: with a CALLRESULT followed by the requested StatusNotification.
+    """
+
+    def __init__(self, charge_point_id, url, mix, rate, measure_from, until, results):
+        self.charge_point_id = charge_point_id
+        self.url = url
+        self.actions, self.weights = zip(*mix.items())
+        self.interval = 1 / rate
+        self.measure_from = measure_from
+        self.until = until
+        self.results = results
+        self.rng = random.Random(charge_point_id)
+        self.pending = {}
+        self.triggered = asyncio.Queue()
+
+    async def run(self):
+        try:
+            async with websockets.connect(
+                f"{self.url}/{self.charge_point_id}",
+                subprotocols=["ocpp2.0.1"],
+                open_timeout=60,
+                ping_interval=None,
+            ) as ws:
+                receiver = asyncio.create_task(self._receive(ws))
+                try:
+                    await self._call(
+                        ws,
+                        "BootNotification",
+                        {
+                            "chargingStation": {
+                                "model": "Bench",
+                                "vendorName": "Bench",
+                            },
+                            "reason": "PowerUp",
+                        },
+                    )
+                    await self._send_calls(ws)
+                finally:
+                    receiver.cancel()
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+            self.results["connect_failures"] += 1
+
+    async def _send_calls(self, ws):
+        # Spread the ChargePoints evenly over one interval, so they don't all fire at once
+        next_send = time.time() + self.rng.uniform(0, self.interval)
+        while next_send < self.until:
+            await asyncio.sleep(max(0.0, next_send - time.time()))
+            next_send += self.interval
+            while not self.triggered.empty():
+                await self._call(
+                    ws,
+                    self.triggered.get_nowait(),
+                    _payload("StatusNotification", self.rng),
+                )
+            action = self.rng.choices(self.actions, self.weights)[0]
+            await self._call(ws, action, _payload(action, self.rng))
+
+    async def _call(self, ws, action, payload):
+        loop = asyncio.get_running_loop()
+        message_id = str(uuid.uuid4())
+        response = self.pending[message_id] = loop.create_future()
+        sent_at = time.time()
+        started = time.perf_counter()
+        await ws.send(json.dumps([CALL, message_id, action, payload]))
+        try:
+            message_type = await asyncio.wait_for(response, timeout=30)
+        except asyncio.TimeoutError:
+            message_type = None
+        finally:
+            self.pending.pop(message_id, None)
+        if not self.measure_from <= sent_at < self.until:
+            return
+        if message_type is None:
+            self.results["timeouts"] += 1
+        elif message_type != CALLRESULT:
+            self.results["errors"] += 1
+        else:
+            self.results["latencies"].setdefault(action, array("d")).append(
+                time.perf_counter() - started
+            )
+
+    async def _receive(self, ws):
+        async for message in ws:
+            frame = Frame.parse(message)
+            if not frame.is_call:
+                response = self.pending.get(frame.message_id)
+                if response is not None and not response.done():
+                    response.set_result(frame.message_type)
+                continue
+            if frame.action == "TriggerMessage":
+                await ws.send(
+                    json.dumps([CALLRESULT, frame.message_id, {"status": "Accepted"}])
+                )
+                self.results["triggers"] += 1
+                if time.time() < self.until:
+                    self.triggered.put_nowait("StatusNotification")
+            else:
+                await ws.send(json.dumps([CALLRESULT, frame.message_id, {}]))
+
+
+def _generate(charge_point_ids, url, mix, rate, measure_from, until, connection):
+    results = {
+        "latencies": {},
+        "errors": 0,
+        "timeouts": 0,
+        "triggers": 0,
+        "connect_failures": 0,
+    }
+
+    async def run():
+        await asyncio.gather(
+            *(
+                SimulatedChargePoint(
+                    charge_point_id, url, mix, rate, measure_from, until, results
+                ).run()
+                for charge_point_id in charge_point_ids
+            )
+        )
+
+    asyncio.run(run())
+    connection.send(results)
+    connection.close()
+
+
+def _processes(pids):
+    pids, pending = [], list(pids)
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        try:
+            with open(f"/proc/{pid}/task/{pid}/children") as f:
+                pending.extend(int(child) for child in f.read().split())
+        except FileNotFoundError:
+            pass
+    return pids
+
+
+def _cpu_seconds(pids):
+    total = 0
+    for process in _processes(pids):
+        try:
+            with open(f"/proc/{process}/stat") as f:
+                # The command name may contain spaces, the fields of interest are counted from its closing bracket
+                fields = f.read().rsplit(")", 1)[1].split()
+        except FileNotFoundError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / CLOCK_TICKS
+
+
+def _rss_mb(pids):
+    total = 0
+    for process in _processes(pids):
+        try:
+            with open(f"/proc/{process}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except FileNotFoundError:
+            continue
+    return total / 1024
+
+
+class ResourceSampler:
+    """CPU and RSS of some processes, including all their descendants (e.g. relay workers)."""
+
+    def __init__(self, pids, interval=0.5):
+        self.pids = pids
+        self.interval = interval
+        self.peak_rss_mb = 0.0
+
+    def start(self):
+        self.started = time.time()
+        self.cpu_started = _cpu_seconds(self.pids)
+        self.task = asyncio.create_task(self._sample())
+
+    async def _sample(self):
+        while True:
+            self.peak_rss_mb = max(self.peak_rss_mb, _rss_mb(self.pids))
+            await asyncio.sleep(self.interval)
+
+    def stop(self) -> dict:
+        self.task.cancel()
+        elapsed = time.time() - self.started
+        return {
+            "cpu_percent": (_cpu_seconds(self.pids) - self.cpu_started) / elapsed * 100,
+            "rss_mb_peak": self.peak_rss_mb,
+            "rss_mb_end": _rss_mb(self.pids),
+        }
+
+
+def _percentiles(latencies) -> dict:
+    ordered = sorted(latencies)
+    if not ordered:
+        return {name: None for name in PERCENTILES}
+    return {
+        name: ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+        * 1000
+        for name, percentile in PERCENTILES.items()
+    }
+
+
+async def _wait_for_port(port, timeout=15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"Nothing is listening on port {port}")
+
+
+def _port_in_use(port):
+    with socket.socket() as sock:
+        return sock.connect_ex(("127.0.0.1", port)) == 0
+
+
+async def _drain_events(url):
+    # The relay is configured, and its event bus exercised, by an attached UI subscriber
+    async with websockets.connect(url, max_size=None, ping_interval=None) as ws:
+        async for _ in ws:
+            pass
+
+
+async def _run_phase(args, url, mix, monitored):
+    loop = asyncio.get_running_loop()
+    ids = [f"BENCH{index:06d}" for index in range(args.charge_points)]
+    measure_from = time.time() + args.ramp_up + args.warmup
+    until = measure_from + args.duration
+    connections, processes = [], []
+    for index in range(args.generator_processes):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        # Spawned rather than forked, a fork would inherit this process' running event loop
+        process = multiprocessing.get_context("spawn").Process(
+            target=_generate,
+            args=(
+                ids[index :: args.generator_processes],
+                url,
+                mix,
+                args.rate,
+                measure_from,
+                until,
+                sender,
+            ),
+        )
+        process.start()
+        connections.append(receiver)
+        processes.append(process)
+
+    await asyncio.sleep(max(0.0, measure_from - time.time()))
+    # The load generator is measured too, on a small box it competes with the relay for CPU
+    monitored = {**monitored, "generator": [process.pid for process in processes]}
+    samplers = {name: ResourceSampler(pids) for name, pids in monitored.items()}
+    for sampler in samplers.values():
+        sampler.start()
+    await asyncio.sleep(max(0.0, until - time.time()))
+    resources = {name: sampler.stop() for name, sampler in samplers.items()}
+
+    merged = {
+        "latencies": {},
+        "errors": 0,
+        "timeouts": 0,
+        "triggers": 0,
+        "connect_failures": 0,
+    }
+    for connection, process in zip(connections, processes):
+        results = await loop.run_in_executor(None, connection.recv)
+        await loop.run_in_executor(None, process.join)
+        for action, latencies in results.pop("latencies").items():
+            merged["latencies"].setdefault(action, array("d")).extend(latencies)
+        for key, value in results.items():
+            merged[key] += value
+
+    latencies = merged.pop("latencies")
+    everything = [latency for values in latencies.values() for latency in values]
+    return {
+        "calls": len(everything),
+        "calls_per_s": len(everything) / args.duration,
+        **merged,
+        "latency_ms": _percentiles(everything),
+        "actions": {
+            action: {"calls": len(values), **_percentiles(values)}
+            for action, values in sorted(latencies.items())
+        },
+        **{
+            f"{name}_{key}": value
+            for name, measured in resources.items()
+            for key, value in measured.items()
+        },
+    }
+
+
+def _commit():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if dirty else commit
+
+
+async def run(args) -> dict:
+    mix = {
+        "Heartbeat": args.heartbeat,
+        "MeterValues": args.meter_values,
+        "StatusNotification": args.status_notification,
+    }
+    mix = {action: weight for action, weight in mix.items() if weight > 0}
+    for port in (CSMS_PORT, args.relay_port):
+        if _port_in_use(port):
+            raise RuntimeError(f"Port {port} is already in use")
+
+    processes = []
+    try:
+        csms = subprocess.Popen(
+            [sys.executable, "example_endpoint/csms.py"],
+            cwd=ROOT,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        processes.append(csms)
+        relay_command = [
+            sys.executable,
+            "relay.py",
+            "--port",
+            str(args.relay_port),
+            "--workers",
+            str(args.relay_workers),
+            *args.relay_args,
+        ]
+        relay = subprocess.Popen(
+            relay_command,
+            cwd=ROOT,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        processes.append(relay)
+        await _wait_for_port(CSMS_PORT)
+        await _wait_for_port(args.relay_port)
+
+        print(f"Direct: {args.charge_points} ChargePoints → CSMS", file=sys.stderr)
+        direct = await _run_phase(
+            args, f"ws://127.0.0.1:{CSMS_PORT}", mix, {"csms": [csms.pid]}
+        )
+
+        csms_info = base64.b64encode(
+            json.dumps(
+                {"url": f"ws://127.0.0.1:{CSMS_PORT}", "id": "", "pass": ""}
+            ).encode("ascii")
+        ).decode("ascii")
+        subscriber = asyncio.create_task(
+            _drain_events(f"ws://127.0.0.1:{args.relay_port}/streamlit/{csms_info}")
+        )
+        await asyncio.sleep(0.5)
+        print(
+            f"Relayed: {args.charge_points} ChargePoints → relay → CSMS",
+            file=sys.stderr,
+        )
+        relayed = await _run_phase(
+            args,
+            f"ws://127.0.0.1:{args.relay_port}",
+            mix,
+            {"csms": [csms.pid], "relay": [relay.pid]},
+        )
+        subscriber.cancel()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    return {
+        "meta": {
+            "commit": _commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "relay_command": " ".join(relay_command[1:]),
+            "charge_points": args.charge_points,
+            "rate_per_charge_point": args.rate,
+            "mix": mix,
+            "duration_s": args.duration,
+        },
+        "added_latency_ms": {
+            name: (
+                relayed["latency_ms"][name] - direct["latency_ms"][name]
+                if relayed["latency_ms"][name] is not None
+                and direct["latency_ms"][name] is not None
+                else None
+            )
+            for name in PERCENTILES
+        },
+        "direct": direct,
+        "relayed": relayed,
+    }
+
+
+def _summary(results) -> dict:
+    relayed = results["relayed"]
+    return {
+        "calls/s": relayed["calls_per_s"],
+        **{
+            f"added {name} ms": value
+            for name, value in results["added_latency_ms"].items()
+        },
+        **{
+            f"relayed {name} ms": value for name, value in relayed["latency_ms"].items()
+        },
+        "errors": relayed["errors"],
+        "timeouts": relayed["timeouts"],
+        "relay cpu %": relayed.get("relay_cpu_percent"),
+        "relay rss peak MB": relayed.get("relay_rss_mb_peak"),
+        "csms cpu %": relayed.get("csms_cpu_percent"),
+        "generator cpu %": relayed.get("generator_cpu_percent"),
+    }
+
+
+def _print(results, baseline=None):
+    meta = results["meta"]
+    print(
+        f"commit {meta['commit']} | {meta['charge_points']} ChargePoints x {meta['rate_per_charge_point']} calls/s "
+        f"| mix {meta['mix']} | {meta['duration_s']} s | {meta['relay_command']}"
+    )
+    current = _summary(results)
+    previous = _summary(baseline) if baseline else {}
+    if baseline:
+        print(
+            f"{'':<22}{baseline['meta']['commit']:>14}{meta['commit']:>14}{'change':>10}"
+        )
+    for name, value in current.items():
+        line = f"{name:<22}"
+        if baseline:
+            before = previous.get(name)
+            line += f"{before:>14.2f}" if before is not None else f"{'-':>14}"
+        line += f"{value:>14.2f}" if value is not None else f"{'-':>14}"
+        if baseline and value is not None and previous.get(name):
+            line += f"{(value - previous[name]) / abs(previous[name]) * 100:>+9.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--charge-points", type=int, default=500)
+    parser.add_argument(
+        "--rate", type=float, default=1.0, help="Calls per second per ChargePoint"
+    )
+    parser.add_argument("--heartbeat", type=float, default=1.0, help="Mix weight")
+    parser.add_argument("--meter-values", type=float, default=4.0, help="Mix weight")
+    parser.add_argument(
+        "--status-notification", type=float, default=1.0, help="Mix weight"
+    )
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument(
+        "--ramp-up",
+        type=float,
+        default=5.0,
+        help="Time given to the ChargePoints to connect before the warmup starts",
+    )
+    parser.add_argument("--generator-processes", type=int, default=1)
+    parser.add_argument("--relay-port", type=int, default=8500)
+    parser.add_argument("--relay-workers", type=int, default=1)
+    parser.add_argument(
+        "--relay-args",
+        nargs=argparse.REMAINDER,
+        default=[],
+        help="Further relay.py arguments",
+    )
+    parser.add_argument("--output", help="Write the results as json to this file")
+    parser.add_argument(
+        "--baseline", help="Results json of an earlier run to compare with"
+    )
+    args = parser.parse_args()
+
+    # Every simulated ChargePoint needs a socket, the relay two
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = asyncio.run(run(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    _print(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import json
+import sys
+import timeit
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from core.frames import Frame  # noqa: E402
+from core.rules import RuleEngine, RuleSet  # noqa: E402
+
+
+def rules(count):
+    # Rules of other actions, only the last ones apply to the frames of the benchmark
+    specs = [
+        {"name": f"vendor-{i}", "action": f"Vendor{i}", "drop": True}
+        for i in range(count)
+    ]
+    specs.append(
+        {
+            "name": "clamp-heartbeat",
+            "action": "BootNotification",
+            "message_type": "CALLRESULT",
+            "clamp": {"interval": [None, 30]},
+        }
+    )
+    specs.append(
+        {
+            "name": "strip-vendor",
+            "action": "DataTransfer",
+            "match": {"vendorId": "com.acme"},
+            "drop": True,
+        }
+    )
+    return RuleSet(specs)
+
+
+def main():
+    frames = {
+        "Heartbeat (no rule)": (
+            json.dumps([2, str(uuid.uuid4()), "Heartbeat", {}]),
+            "Heartbeat",
+        ),
+        "DataTransfer (match)": (
+            json.dumps([2, str(uuid.uuid4()), "DataTransfer", {"vendorId": "other"}]),
+            "DataTransfer",
+        ),
+        "BootNotification (rewrite)": (
+            json.dumps(
+                [
+                    3,
+                    str(uuid.uuid4()),
+                    {"status": "Accepted", "interval": 300, "currentTime": "now"},
+                ]
+            ),
+            "BootNotification",
+        ),
+    }
+    print(f"{'Frame':<28}{'Rules':>8}{'apply (µs)':>12}")
+    for count in (0, 1000):
+        engine = RuleEngine(rules=rules(count))
+        for name, (message, action) in frames.items():
+            frame = Frame.parse(message)
+            direction = "csms-cp" if frame.message_type == 3 else "cp-csms"
+            runs = 100000
+            seconds = min(
+                timeit.repeat(
+                    lambda: engine.apply("CP_1", direction, frame, action, message),
+                    number=runs,
+                    repeat=5,
+                )
+            )
+            print(f"{name:<28}{len(engine.rules):>8}{seconds / runs * 1e6:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
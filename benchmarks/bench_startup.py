@@ -0,0 +1,117 @@
+"""
+Startup time of a headless relay, from starting the process until GET /ready answers 200.
+
+The relay is configured through the environment only (OCPP_RELAY_CSMS_URL), no CSMS needs to be running to become
+ready. Also reports the time to import relay.py and checks that the UI's and optional heavy dependencies stay off the
+startup path. With --max-ready, exits with 1 if the median time to ready is above it, e.g. in CI.
+
+    python benchmarks/bench_startup.py --repeat 10
+    python benchmarks/bench_startup.py --workers 4 --max-ready 1.5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+# Modules relay.py must not import when starting up
+OFF_STARTUP_PATH = ("streamlit", "redis", "dataclasses_json", "jsonschema", "ocpp")
+
+_IMPORT = """
+import json, sys, time
+started = time.perf_counter()
+import relay
+print(json.dumps({"seconds": time.perf_counter() - started, "modules": sorted(sys.modules)}))
+"""
+
+
+def measure_import():
+    result = subprocess.run(
+        [sys.executable, "-c", _IMPORT],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout)
+
+
+def measure_ready(port, workers, timeout=30.0) -> float:
+    env = dict(
+        os.environ,
+        OCPP_RELAY_CSMS_URL="ws://localhost:9000",
+        OCPP_RELAY_PORT=str(port),
+        OCPP_RELAY_WORKERS=str(workers),
+    )
+    started = time.perf_counter()
+    relay = subprocess.Popen(
+        [sys.executable, str(ROOT / "relay.py")],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(
+                    f"http://localhost:{port}/ready", timeout=1
+                ) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            if relay.poll() is not None:
+                raise RuntimeError(f"The relay exited with {relay.returncode}")
+            time.sleep(0.005)
+        raise TimeoutError(f"The relay wasn't ready within {timeout} s")
+    finally:
+        relay.terminate()
+        relay.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8599)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--max-ready", type=float, help="Seconds the median time to ready may take"
+    )
+    args = parser.parse_args()
+
+    imports = [measure_import() for _ in range(args.repeat)]
+    loaded = [
+        module
+        for module in imports[0]["modules"]
+        if module.split(".")[0] in OFF_STARTUP_PATH
+    ]
+    readiness = [measure_ready(args.port, args.workers) for _ in range(args.repeat)]
+
+    import_times = [result["seconds"] * 1000 for result in imports]
+    ready_times = [seconds * 1000 for seconds in readiness]
+    print(f"{'':<22}{'p50 (ms)':>10}{'max (ms)':>10}")
+    print(
+        f"{'import relay':<22}{statistics.median(import_times):>10.0f}{max(import_times):>10.0f}"
+    )
+    print(
+        f"{f'ready ({args.workers} workers)':<22}{statistics.median(ready_times):>10.0f}{max(ready_times):>10.0f}"
+    )
+    print(f"\nModules imported at startup: {len(imports[0]['modules'])}")
+    if loaded:
+        print(f"Heavy modules on the startup path: {', '.join(loaded)}")
+
+    if loaded or (
+        args.max_ready is not None and statistics.median(readiness) > args.max_ready
+    ):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,168 +1,243 @@
-import base64
-import json
-import logging
-import os
-import re
-import threading
-import time
-
-import streamlit as st
-import websocket
-from streamlit_ace import st_ace
-
-from state import Event
-
-
-class RelayConnectionManager:
-    def __init__(self, connection_url):
-        self.connection_url = connection_url
-        self.connected_event = threading.Event()
-        self.stop_event = threading.Event()
-        self.thread = threading.Thread(target=self.run, daemon=True)
-        self.logger = logging.getLogger(RelayConnectionManager.__qualname__)
-        self.logger.info("Starting RelayConnectionManager's thread")
-        self.thread.start()
-
-    def run(self):
-        while not self.stop_event.is_set():
-            ws = websocket.WebSocketApp(
-                self.connection_url,
-                on_open=self.on_open,
-                on_message=self.on_message,
-                on_close=self.on_close,
-                on_error=self.on_error,
-            )
-            self.logger.info(
-                f"Trying to open a connection to the relay at {self.connection_url}"
-            )
-            ws.run_forever()
-            if not self.connected_event.is_set():
-                self.logger.info(
-                    "Opening a connection to relay failed. Retrying in 3 seconds"
-                )
-                time.sleep(3)
-
-        self.logger.info("Closing websocket connection to the relay")
-        ws.close()
-
-    def stop(self):
-        self.stop_event.set()
-        self.logger.info("Stop event set, waiting for thread it join")
-        self.thread.join(timeout=10)
-        self.logger.info("RelayConnectionManager's Thread join complete")
-
-    def on_open(self, ws):
-        self.connected_event.set()
-        st.session_state.app_state.relay_connected = True
-
-    def on_message(self, ws, ws_message_str):
-        ws_message = json.loads(ws_message_str)
-        if isinstance(ws_message, dict):
-            event = ws_message.get("event", None)
-            if event == "Connection":
-                ts = ws_message.get("timestamp")
-                cp_id = ws_message.get("payload").get("charge_point_id")
-                ws_subp = ws_message.get("payload").get("ws_subprotocol")
-                st.session_state.app_state.charge_point_id = cp_id
-                st.session_state.app_state.latest_event = f"OCPP-Relay is now actively relaying {ws_subp} messages on behalf of **{cp_id}** since {ts}"
-            elif event == "Disconnection":
-                ts = ws_message.get("timestamp")
-                cp_id = st.session_state.app_state.charge_point_id
-                st.session_state.app_state.charge_point_id = ""
-                st.session_state.app_state.latest_event = (
-                    f"**{cp_id}** disconnected from OCPP-Relay at {ts}"
-                )
-        else:
-            ocpp_message = ws_message
-            message_type = ocpp_message[0]
-            message_id = ocpp_message[1]
-            timestamp = int(time.time())
-            if message_type == 2:  # Request
-                message_name = ocpp_message[2]
-                st.session_state.app_state.events[message_id] = Event(
-                    timestamp=timestamp,
-                    message_name=message_name,
-                    request=ws_message_str,
-                )
-            else:
-                st.session_state.app_state.events[message_id].response = ws_message_str
-
-    def on_close(self, ws, sc, msg):
-        self.connected_event.clear()
-
-    def on_error(self, ws, error):
-        self.connected_event.clear()
-        time.sleep(3)
-
-
-def setup_relay(csms_info):
-    csms_info_b64 = base64.b64encode(json.dumps(csms_info).encode("ascii")).decode(
-        "ascii"
-    )
-    connection_url = f"{st.session_state.app_state.relay_url}/streamlit/{csms_info_b64}"
-    rcm = RelayConnectionManager(connection_url)
-    st.session_state.app_state.relay_connection_manager = rcm
-    st.runtime.scriptrunner.add_script_run_ctx(rcm.thread)
-    st.session_state.app_state.relay_configured = True
-
-
-def show_configuration_component() -> bool:
-    def _validate_csms_url(url):
-        match = re.match(
-            r"wss?:\/\/(?:[a-zA-Z0-9.-]+|\[[a-fA-F0-9:]+\])(?::\d+)?(?:\/[^\s]*)?", url
-        )
-        return bool(match)
-
-    with st.form("configuration"):
-        url_col, id_col, pass_col = st.columns([3, 1, 1])
-        with url_col:
-            csms_url = st.text_input(
-                "Enter your CSMS base URL (i.e without the CP identifier, such as `wss://example.com/ocpp`):",
-                disabled=bool(st.session_state.app_state.csms_info),
-            )
-        with id_col:
-            csms_id = st.text_input(
-                "Enter your BasicAuth ID:",
-                disabled=bool(st.session_state.app_state.csms_info),
-            )
-        with pass_col:
-            csms_pass = st.text_input(
-                "Enter your BasicAuth Password:",
-                disabled=bool(st.session_state.app_state.csms_info),
-                type="password",
-            )
-        submitted = st.form_submit_button(
-            "Submit", disabled=bool(st.session_state.app_state.csms_info)
-        )
-        if submitted:
-            if not _validate_csms_url(csms_url):
-                st.error("Invalid CSMS URL")
-            else:
-                st.session_state.app_state.csms_info = {
-                    "url": csms_url.rstrip("/"),
-                    "id": csms_id,
-                    "pass": csms_pass,
-                }
-                st.rerun()
-
-        if st.session_state.app_state.csms_info:
-            if not st.session_state.app_state.relay_configured:
-                setup_relay(st.session_state.app_state.csms_info)
-
-            if not st.session_state.app_state.relay_connected:
-                with st.spinner("Configuring relay..."):
-                    time.sleep(3)
-                    st.rerun()
-            elif not bool(st.session_state.app_state.latest_event):
-                st.markdown(
-                    f":blue-background[Configure ChargePoint with the following CSMS (Relay) URL: `{st.session_state.app_state.relay_url}`]"
-                )
-                with st.spinner("Waiting for a ChargePoint to connect to relay..."):
-                    time.sleep(3)
-                    st.rerun()
-            else:
-                if bool(st.session_state.app_state.charge_point_id):
-                    st.success(st.session_state.app_state.latest_event, icon="🚀")
-                else:
-                    st.error(st.session_state.app_state.latest_event, icon="🚨")
-                return True
+import base64
+import dataclasses
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import streamlit as st
+import websocket
+from streamlit_ace import st_ace
+
+from core.sessions import DIRECTIONS
+from state import Event
+
+
+class RelayConnectionManager:
+    def __init__(self, connection_url):
+        self.connection_url = connection_url
+        self.connected_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.logger = logging.getLogger(RelayConnectionManager.__qualname__)
+        self.logger.info("Starting RelayConnectionManager's thread")
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            ws = websocket.WebSocketApp(
+                self.connection_url,
+                on_open=self.on_open,
+                on_message=self.on_message,
+                on_close=self.on_close,
+                on_error=self.on_error,
+            )
+            self.logger.info(
+                f"Trying to open a connection to the relay at {self.connection_url}"
+            )
+            ws.run_forever()
+            if not self.connected_event.is_set():
+                self.logger.info(
+                    "Opening a connection to relay failed. Retrying in 3 seconds"
+                )
+                time.sleep(3)
+
+        self.logger.info("Closing websocket connection to the relay")
+        ws.close()
+
+    def stop(self):
+        self.stop_event.set()
+        self.logger.info("Stop event set, waiting for thread it join")
+        self.thread.join(timeout=10)
+        self.logger.info("RelayConnectionManager's Thread join complete")
+
+    def on_open(self, ws):
+        self.connected_event.set()
+        st.session_state.app_state.relay_connected = True
+
+    def on_message(self, ws, ws_message_str):
+        ws_message = json.loads(ws_message_str)
+        event = ws_message.get("event", None)
+        if event == "Connection":
+            ts = ws_message.get("timestamp")
+            cp_id = ws_message.get("payload").get("charge_point_id")
+            ws_subp = ws_message.get("payload").get("ws_subprotocol")
+            cp_ids = st.session_state.app_state.charge_point_ids
+            st.session_state.app_state.charge_point_ids = sorted({*cp_ids, cp_id})
+            st.session_state.app_state.charge_point_id = cp_id
+            st.session_state.app_state.latest_event = f"OCPP-Relay is now actively relaying {ws_subp} messages on behalf of **{cp_id}** since {ts}"
+        elif event == "Disconnection":
+            ts = ws_message.get("timestamp")
+            cp_id = ws_message.get("payload").get("charge_point_id")
+            cp_ids = st.session_state.app_state.charge_point_ids
+            st.session_state.app_state.charge_point_ids = [
+                connected_id for connected_id in cp_ids if connected_id != cp_id
+            ]
+            if st.session_state.app_state.charge_point_id == cp_id:
+                st.session_state.app_state.charge_point_id = ""
+            st.session_state.app_state.latest_event = (
+                f"**{cp_id}** disconnected from OCPP-Relay at {ts}"
+            )
+        elif event == "Message":
+            payload = ws_message.get("payload")
+            cp_id = payload.get("charge_point_id")
+            ocpp_message = payload.get("message")
+            message_type = ocpp_message[0]
+            message_id = ocpp_message[1]
+            event_id = f"{cp_id}/{message_id}"
+            timestamp = int(time.time())
+            injected_messages = st.session_state.app_state.injected_messages
+            # Responses are matched by the relay and arrive with their Exchange
+            if message_type == 2:  # Request
+                message_name = ocpp_message[2]
+                st.session_state.app_state.events[event_id] = Event(
+                    timestamp=timestamp,
+                    message_name=message_name,
+                    request=json.dumps(ocpp_message),
+                    charge_point_id=cp_id,
+                    injected=any(
+                        injected_messages.is_pending(cp_id, direction, message_id)
+                        for direction in DIRECTIONS
+                    ),
+                    direction=payload.get("direction", ""),
+                )
+        elif event == "Exchange":
+            payload = ws_message.get("payload")
+            cp_id = payload.get("charge_point_id")
+            message_id = payload.get("message_id")
+            event_id = f"{cp_id}/{message_id}"
+            events = st.session_state.app_state.events
+            # The request is missing if it was relayed before this UI attached
+            request_event = events.get(event_id)
+            response = payload.get("response")
+            # Written as a whole, the stored event is updated in place by its id
+            events[event_id] = Event(
+                timestamp=(
+                    request_event.timestamp
+                    if request_event
+                    else int(payload.get("requested_at"))
+                ),
+                message_name=payload.get("action"),
+                request=json.dumps(payload.get("request")),
+                response=json.dumps(response) if response is not None else None,
+                charge_point_id=cp_id,
+                injected=bool(request_event and request_event.injected)
+                or payload.get("injected"),
+                direction=payload.get("direction"),
+                outcome=payload.get("outcome"),
+                round_trip=payload.get("round_trip"),
+                violations=request_event.violations if request_event else [],
+            )
+            st.session_state.app_state.injected_messages.complete(
+                cp_id, payload.get("direction"), message_id
+            )
+
+        elif event == "Validation":
+            payload = ws_message.get("payload")
+            event_id = f"{payload.get('charge_point_id')}/{payload.get('message_id')}"
+            events = st.session_state.app_state.events
+            flagged = events.get(event_id)
+            if flagged is not None:
+                part = "Request" if payload.get("message_type") == 2 else "Response"
+                events[event_id] = dataclasses.replace(
+                    flagged,
+                    violations=flagged.violations
+                    + [f"{part}: {error}" for error in payload.get("errors")],
+                )
+
+    def on_close(self, ws, sc, msg):
+        self.connected_event.clear()
+
+    def on_error(self, ws, error):
+        self.connected_event.clear()
+        time.sleep(3)
+
+
+def setup_relay(csms_info):
+    csms_info_b64 = base64.b64encode(json.dumps(csms_info).encode("ascii")).decode(
+        "ascii"
+    )
+    connection_url = f"{st.session_state.app_state.relay_url}/streamlit/{csms_info_b64}"
+    rcm = RelayConnectionManager(connection_url)
+    st.session_state.app_state.relay_connection_manager = rcm
+    st.runtime.scriptrunner.add_script_run_ctx(rcm.thread)
+    st.session_state.app_state.relay_configured = True
+
+
+# The status banner is redrawn at most this often (seconds)
+STATUS_REFRESH_INTERVAL = 1.0
+
+
+def _relay_ready() -> bool:
+    return bool(
+        st.session_state.app_state.relay_connected
+        and st.session_state.app_state.latest_event
+    )
+
+
+@st.fragment(run_every=STATUS_REFRESH_INTERVAL)
+def show_relay_status(rendered_ready: bool):
+    # Only the banner reruns while waiting, the whole page once the relay and a ChargePoint are there (or gone)
+    if _relay_ready() != rendered_ready:
+        st.rerun()
+    if not st.session_state.app_state.relay_connected:
+        st.status("Configuring relay...")
+    elif not st.session_state.app_state.latest_event:
+        st.markdown(
+            f":blue-background[Configure ChargePoint with the following CSMS (Relay) URL: `{st.session_state.app_state.relay_url}`]"
+        )
+        st.status("Waiting for a ChargePoint to connect to relay...")
+    elif bool(st.session_state.app_state.charge_point_ids):
+        st.success(st.session_state.app_state.latest_event, icon="🚀")
+    else:
+        st.error(st.session_state.app_state.latest_event, icon="🚨")
+
+
+def show_configuration_component() -> bool:
+    def _validate_csms_url(url):
+        match = re.match(
+            r"wss?:\/\/(?:[a-zA-Z0-9.-]+|\[[a-fA-F0-9:]+\])(?::\d+)?(?:\/[^\s]*)?", url
+        )
+        return bool(match)
+
+    with st.form("configuration"):
+        url_col, id_col, pass_col = st.columns([3, 1, 1])
+        with url_col:
+            csms_url = st.text_input(
+                "Enter your CSMS base URL (i.e without the CP identifier, such as `wss://example.com/ocpp`):",
+                disabled=bool(st.session_state.app_state.csms_info),
+            )
+        with id_col:
+            csms_id = st.text_input(
+                "Enter your BasicAuth ID:",
+                disabled=bool(st.session_state.app_state.csms_info),
+            )
+        with pass_col:
+            csms_pass = st.text_input(
+                "Enter your BasicAuth Password:",
+                disabled=bool(st.session_state.app_state.csms_info),
+                type="password",
+            )
+        submitted = st.form_submit_button(
+            "Submit", disabled=bool(st.session_state.app_state.csms_info)
+        )
+        if submitted:
+            if not _validate_csms_url(csms_url):
+                st.error("Invalid CSMS URL")
+            else:
+                st.session_state.app_state.csms_info = {
+                    "url": csms_url.rstrip("/"),
+                    "id": csms_id,
+                    "pass": csms_pass,
+                }
+                st.rerun()
+
+    if st.session_state.app_state.csms_info:
+        if not st.session_state.app_state.relay_configured:
+            setup_relay(st.session_state.app_state.csms_info)
+        ready = _relay_ready()
+        show_relay_status(ready)
+        return ready
+    return False
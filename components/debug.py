@@ -1,9 +1,12 @@
-import streamlit as st
-
-
-@st.dialog("Debug App")
-def debug_app_viewer():
-    st.subheader("AppState:")
-    st.write(st.session_state.app_state)
-    st.divider()
-    st.write(f"Number of OCPP Events: {len(st.session_state.app_state.events)}")
+import streamlit as st
+
+
+@st.dialog("Debug App")
+def debug_app_viewer():
+    st.subheader("AppState:")
+    st.write(st.session_state.app_state)
+    st.divider()
+    st.write(f"Number of OCPP Events: {len(st.session_state.app_state.events)}")
+    st.write("Injected Messages:", st.session_state.app_state.injected_messages.stats())
+    st.write("State Store:", st.session_state.app_state.state_store.stats())
+    st.write("Event Store:", st.session_state.app_state.events.stats())
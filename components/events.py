@@ -1,122 +1,289 @@
-import json
-from datetime import datetime
-from pathlib import Path
-
-import streamlit as st
-
-from state import Event
-
-
-def load_example_events():
-    example_events_dir = Path(__file__).parent.parent / "example_events"
-    for example_event_file in example_events_dir.glob("*.json"):
-        id = example_event_file.name.replace(".json", "")
-        if id not in st.session_state.app_state.events.keys():
-            with example_event_file.open() as f:
-                st.session_state.app_state.events[id] = Event(**json.load(f))
-            break
-
-
-def get_ocpp_message_direction(message_name: str) -> str:
-    # TODO
-    ocpp_16_csms_to_cp = {
-        "ChangeAvailability",
-        "ChangeConfiguration",
-        "ClearCache",
-        "DataTransfer",
-        "GetCompositeSchedule",
-        "GetConfiguration",
-        "RemoteStartTransaction",
-        "RemoteStopTransaction",
-        "Reset",
-        "UnlockConnector",
-        "UpdateFirmware",
-        "SetChargingProfile",
-        "ClearChargingProfile",
-        "GetDiagnostics",
-        "TriggerMessage",
-    }
-    ocpp_16_cp_to_csms = {
-        "Authorize",
-        "BootNotification",
-        "DataTransfer",
-        "DiagnosticsStatusNotification",
-        "FirmwareStatusNotification",
-        "Heartbeat",
-        "MeterValues",
-        "StartTransaction",
-        "StatusNotification",
-        "StopTransaction",
-    }
-    ocpp_201_csms_to_cp = {
-        "GetBaseReport",
-        "GetLog",
-        "GetReport",
-        "SetVariables",
-    }
-    ocpp_201_cp_to_csms = {
-        "LogStatusNotification",
-        "NotifyChargingLimit",
-        "NotifyEvent",
-        "NotifyReport",
-    }
-
-    if message_name in ocpp_16_csms_to_cp or message_name in ocpp_201_csms_to_cp:
-        return "CSMS → CP"
-    elif message_name in ocpp_16_cp_to_csms or message_name in ocpp_201_cp_to_csms:
-        return "CP → CSMS"
-    else:
-        return "Unknown"
-
-
-@st.dialog("OCPP Event Viewer")
-def ocpp_event_viewer(selected_event_id):
-    if selected_event_id is not None:
-        selected_event: Event = st.session_state.app_state.events[selected_event_id]
-        st.subheader(selected_event.message_name)
-        st.write(
-            f"**Request Timestamp**: {datetime.utcfromtimestamp(selected_event.timestamp).strftime('%Y-%m-%d %H:%M:%S')}Z"
-        )
-        st.write(
-            f"**Message Direction**: {get_ocpp_message_direction(selected_event.message_name)}"
-        )
-        if selected_event_id in st.session_state.app_state.injected_message_ids:
-            st.write("💉 **Injected Message** 💉")
-        st.divider()
-        left, right = st.columns(2)
-
-        with left:
-            st.write("Request")
-            if selected_event.request:
-                st.json(selected_event.request)
-            else:
-                st.info("JSON is not available yet for display", icon="ℹ️")
-
-        with right:
-            st.write("Response")
-            if selected_event.response:
-                st.json(selected_event.response)
-            else:
-                st.info("JSON is not available yet for display", icon="ℹ️")
-    else:
-        st.write("Select an event to view the complete message")
-
-
-def show_events_component():
-    st.sidebar.header("OCPP Events")
-
-    if st.sidebar.button("Refresh", icon=":material/autorenew:"):
-        pass
-    if st.session_state.app_state.events:
-        for id, event in reversed(st.session_state.app_state.events.items()):
-            ts = datetime.utcfromtimestamp(event.timestamp).strftime(
-                "%Y-%m-%d %H:%M:%S"
-            )
-            if id in st.session_state.app_state.injected_message_ids:
-                txt = f"💉 - {ts}Z - {event.message_name} - 🔍"
-            else:
-                txt = f"✉️ - {ts}Z - {event.message_name} - 🔍"
-            if st.sidebar.button(txt, key=str(event.timestamp) + id):
-                ocpp_event_viewer(id)
-    else:
-        st.sidebar.write("*No events yet*")
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+from pathlib import Path
+
+import streamlit as st
+
+from components.export import show_capture_export
+from core.event_index import EventFilter
+from state import Event
+
+
+def load_example_events():
+    example_events_dir = Path(__file__).parent.parent / "example_events"
+    for example_event_file in example_events_dir.glob("*.json"):
+        id = example_event_file.name.replace(".json", "")
+        if id not in st.session_state.app_state.events:
+            with example_event_file.open() as f:
+                st.session_state.app_state.events[id] = Event(**json.load(f))
+            break
+
+
+DIRECTION_LABELS = {"cp-csms": "CP → CSMS", "csms-cp": "CSMS → CP"}
+
+
+def get_ocpp_message_direction(message_name: str) -> str:
+    # Only a fallback for events without the direction tagged by the relay (e.g. example events)
+    ocpp_16_csms_to_cp = {
+        "ChangeAvailability",
+        "ChangeConfiguration",
+        "ClearCache",
+        "DataTransfer",
+        "GetCompositeSchedule",
+        "GetConfiguration",
+        "RemoteStartTransaction",
+        "RemoteStopTransaction",
+        "Reset",
+        "UnlockConnector",
+        "UpdateFirmware",
+        "SetChargingProfile",
+        "ClearChargingProfile",
+        "GetDiagnostics",
+        "TriggerMessage",
+    }
+    ocpp_16_cp_to_csms = {
+        "Authorize",
+        "BootNotification",
+        "DataTransfer",
+        "DiagnosticsStatusNotification",
+        "FirmwareStatusNotification",
+        "Heartbeat",
+        "MeterValues",
+        "StartTransaction",
+        "StatusNotification",
+        "StopTransaction",
+    }
+    ocpp_201_csms_to_cp = {
+        "GetBaseReport",
+        "GetLog",
+        "GetReport",
+        "SetVariables",
+    }
+    ocpp_201_cp_to_csms = {
+        "LogStatusNotification",
+        "NotifyChargingLimit",
+        "NotifyEvent",
+        "NotifyReport",
+    }
+
+    if message_name in ocpp_16_csms_to_cp or message_name in ocpp_201_csms_to_cp:
+        return "CSMS → CP"
+    elif message_name in ocpp_16_cp_to_csms or message_name in ocpp_201_cp_to_csms:
+        return "CP → CSMS"
+    else:
+        return "Unknown"
+
+
+@st.dialog("OCPP Event Viewer")
+def ocpp_event_viewer(selected_event_id):
+    if selected_event_id is not None:
+        selected_event: Event = st.session_state.app_state.events[selected_event_id]
+        st.subheader(selected_event.message_name)
+        if selected_event.charge_point_id:
+            st.write(f"**ChargePoint**: {selected_event.charge_point_id}")
+        st.write(
+            f"**Request Timestamp**: {datetime.utcfromtimestamp(selected_event.timestamp).strftime('%Y-%m-%d %H:%M:%S')}Z"
+        )
+        st.write(
+            f"**Message Direction**: {DIRECTION_LABELS.get(selected_event.direction) or get_ocpp_message_direction(selected_event.message_name)}"
+        )
+        if selected_event.round_trip is not None:
+            st.write(f"**Round-trip Time**: {selected_event.round_trip * 1000:.1f} ms")
+        elif selected_event.outcome in ("timeout", "closed"):
+            st.write(f"**No Response** ({selected_event.outcome})")
+        if selected_event.injected:
+            st.write("💉 **Injected Message** 💉")
+        if selected_event.violations:
+            st.warning(
+                "**Schema violations**\n\n"
+                + "\n".join(
+                    f"- {violation}" for violation in selected_event.violations
+                ),
+                icon=":material/rule:",
+            )
+        st.divider()
+        left, right = st.columns(2)
+
+        with left:
+            st.write("Request")
+            if selected_event.request:
+                st.json(selected_event.request)
+            else:
+                st.info("JSON is not available yet for display", icon="ℹ️")
+
+        with right:
+            st.write("Response")
+            if selected_event.response:
+                st.json(selected_event.response)
+            else:
+                st.info("JSON is not available yet for display", icon="ℹ️")
+    else:
+        st.write("Select an event to view the complete message")
+
+
+EVENTS_PER_PAGE = 50
+SEARCH_LIMIT = 200
+# The event list is redrawn at most this often (seconds), however many events arrive meanwhile
+EVENTS_REFRESH_INTERVAL = 1.0
+TIME_RANGES = {
+    "All": None,
+    "Last 5 minutes": 5 * 60,
+    "Last hour": 60 * 60,
+    "Last 24 hours": 24 * 60 * 60,
+}
+
+
+def show_event_filters() -> EventFilter:
+    events = st.session_state.app_state.events
+    with st.expander("Filters", icon=":material/filter_list:"):
+        action = st.selectbox(
+            "Action", events.values("action"), index=None, placeholder="All"
+        )
+        charge_point_id = st.selectbox(
+            "ChargePoint",
+            events.values("charge_point_id"),
+            index=None,
+            placeholder="All",
+        )
+        direction = st.selectbox(
+            "Direction",
+            list(DIRECTION_LABELS),
+            format_func=DIRECTION_LABELS.get,
+            index=None,
+            placeholder="All",
+        )
+        injected_only = st.checkbox("Injected messages only")
+        time_range = TIME_RANGES[st.selectbox("Time range", list(TIME_RANGES))]
+    return EventFilter(
+        action=action,
+        charge_point_id=charge_point_id,
+        direction=direction,
+        injected_only=injected_only,
+        since=int(time.time()) - time_range if time_range else None,
+    )
+
+
+def query_relay(endpoint: str, params: dict) -> dict:
+    # Plain HTTP on the relay's websocket port, ws(s):// → http(s)://
+    relay_url = st.session_state.app_state.relay_url.replace("ws", "http", 1)
+    query = urllib.parse.urlencode(params)
+    try:
+        with urllib.request.urlopen(f"{relay_url}/{endpoint}?{query}", timeout=10) as f:
+            return json.load(f)
+    except urllib.error.HTTPError as e:
+        return json.load(e)
+    except (urllib.error.URLError, OSError) as e:
+        return {"error": f"Relay isn't reachable: {e}"}
+
+
+def search_capture(text: str, limit: int = SEARCH_LIMIT) -> dict:
+    # The relay answers from its capture
+    return query_relay("search", {"q": text, "limit": limit})
+
+
+def show_capture_search():
+    text = st.text_input(
+        "Search captured frames",
+        placeholder="idTag=04A2B3C4 transactionId=1234",
+        help="Space separated field=value terms, fields: action, idTag, transactionId, evseId, connectorId, "
+        "status, charge_point_id, message_id. Needs a relay started with --capture-dir.",
+    )
+    if not text:
+        return
+    result = search_capture(text)
+    if "error" in result:
+        st.error(result["error"], icon=":material/search_off:")
+        return
+    records = result["records"]
+    st.caption(
+        f"{len(records)}{'+' if len(records) == SEARCH_LIMIT else ''} frames, newest first, "
+        f"in {result['elapsed'] * 1000:.1f} ms"
+    )
+    if records:
+        st.dataframe(
+            [
+                {
+                    "Time": datetime.utcfromtimestamp(record["timestamp"]).strftime(
+                        "%Y-%m-%d %H:%M:%S.%f"
+                    )[:-3],
+                    "ChargePoint": record["charge_point_id"],
+                    "Direction": DIRECTION_LABELS[record["direction"]],
+                    "Action": record["action"],
+                    "Message Id": record["message_id"],
+                    "Frame": record["frame"],
+                }
+                for record in records
+            ],
+            hide_index=True,
+        )
+
+
+def show_events_component():
+    st.header("OCPP Events")
+    show_capture_search()
+    show_capture_export()
+    with st.sidebar:
+        show_event_list()
+
+
+@st.fragment(run_every=EVENTS_REFRESH_INTERVAL)
+def show_event_list():
+    # Only this fragment reruns, reading just the events appended since its previous run
+    st.session_state.app_state.events.sync()
+    event_filter = show_event_filters()
+    # Cursors of the pages before the current one, paging restarts from the newest events when the filter changes
+    filter_key = (
+        event_filter.action,
+        event_filter.charge_point_id,
+        event_filter.direction,
+        event_filter.injected_only,
+        event_filter.since is not None,
+    )
+    if st.session_state.get("events_filter") != filter_key:
+        st.session_state.events_filter = filter_key
+        st.session_state.events_cursors = [None]
+    cursors = st.session_state.events_cursors
+    page = st.session_state.app_state.events.page(
+        event_filter, before=cursors[-1], limit=EVENTS_PER_PAGE
+    )
+    if page.events:
+        for id, event in page.events:
+            ts = datetime.utcfromtimestamp(event.timestamp).strftime(
+                "%Y-%m-%d %H:%M:%S"
+            )
+            if event.injected:
+                txt = (
+                    f"💉 - {ts}Z - {event.charge_point_id} - {event.message_name} - 🔍"
+                )
+            else:
+                txt = (
+                    f"✉️ - {ts}Z - {event.charge_point_id} - {event.message_name} - 🔍"
+                )
+            if event.violations:
+                txt += " ⚠️"
+            if st.button(txt, key=str(event.timestamp) + id):
+                ocpp_event_viewer(id)
+        newer, older = st.columns(2)
+        # Paging happens in the callbacks, before the list is drawn again
+        newer.button(
+            "Newer",
+            icon=":material/chevron_left:",
+            disabled=len(cursors) == 1,
+            on_click=cursors.pop,
+        )
+        older.button(
+            "Older",
+            icon=":material/chevron_right:",
+            disabled=page.next_cursor is None,
+            on_click=cursors.append,
+            args=(page.next_cursor,),
+        )
+        st.caption(f"Page {len(cursors)}, up to {page.total} matching events")
+    elif st.session_state.app_state.events:
+        st.write("*No matching events*")
+    else:
+        st.write("*No events yet*")
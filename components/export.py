@@ -0,0 +1,108 @@
+import datetime
+import os
+import tempfile
+import time
+
+import streamlit as st
+
+from core.capture import CaptureReader
+from core.export import FORMATS, MIME_TYPES, ExportFilter, export
+
+FORMAT_LABELS = {
+    "jsonl": "JSONL (frames)",
+    "csv": "CSV (exchanges with latency)",
+    "parquet": "Parquet (frames)",
+}
+
+
+def _day_range(days):
+    # date_input gives no, one or two days while a range is being picked
+    if not days:
+        return None, None
+    first, last = days[0], days[-1]
+    return (
+        datetime.datetime.combine(
+            first, datetime.time.min, datetime.timezone.utc
+        ).timestamp(),
+        datetime.datetime.combine(
+            last, datetime.time.max, datetime.timezone.utc
+        ).timestamp(),
+    )
+
+
+def prepare_export(capture_dir: str, format: str, export_filter: ExportFilter):
+    previous = st.session_state.get("capture_export")
+    if previous is not None and os.path.exists(previous["path"]):
+        os.unlink(previous["path"])
+    # Written in chunks to a temporary file, the export is never held in memory as a whole while it is made
+    with tempfile.NamedTemporaryFile(
+        prefix="ocpp-relay-export-", suffix=f".{format}", delete=False
+    ) as out:
+        started = time.perf_counter()
+        count = export(CaptureReader(capture_dir), export_filter, format, out)
+    st.session_state.capture_export = {
+        "path": out.name,
+        "format": format,
+        "rows": count,
+        "elapsed": time.perf_counter() - started,
+    }
+
+
+def show_capture_export():
+    events = st.session_state.app_state.events
+    with st.expander("Export captured traffic", icon=":material/download:"):
+        capture_dir = st.text_input(
+            "Capture directory",
+            value=os.environ.get("OCPP_RELAY_CAPTURE_DIR", "captures"),
+            help="The --capture-dir the relay writes to. Large exports are better made with "
+            "`python -m core.export`, a download is held in memory by the UI.",
+        )
+        format = st.selectbox("Format", FORMATS, format_func=FORMAT_LABELS.get)
+        charge_point_id = st.selectbox(
+            "ChargePoint",
+            events.values("charge_point_id"),
+            index=None,
+            placeholder="All",
+            key="export_charge_point_id",
+        )
+        action = st.selectbox(
+            "Action",
+            events.values("action"),
+            index=None,
+            placeholder="All",
+            key="export_action",
+        )
+        start, end = _day_range(
+            st.date_input("Days (UTC)", value=[], format="YYYY-MM-DD")
+        )
+        if st.button("Prepare export", icon=":material/file_export:"):
+            if not os.path.isdir(capture_dir):
+                st.error(
+                    f"No capture directory {capture_dir}", icon=":material/folder_off:"
+                )
+                return
+            with st.spinner("Exporting"):
+                prepare_export(
+                    capture_dir,
+                    format,
+                    ExportFilter(
+                        charge_point_id=charge_point_id,
+                        action=action,
+                        start=start,
+                        end=end,
+                    ),
+                )
+        prepared = st.session_state.get("capture_export")
+        if prepared is not None and os.path.exists(prepared["path"]):
+            rows = "exchanges" if prepared["format"] == "csv" else "frames"
+            st.caption(
+                f"{prepared['rows']} {rows} exported in {prepared['elapsed']:.1f} s"
+            )
+            with open(prepared["path"], "rb") as f:
+                st.download_button(
+                    "Download",
+                    data=f,
+                    file_name=f"ocpp-capture.{prepared['format']}",
+                    mime=MIME_TYPES[prepared["format"]],
+                    icon=":material/download:",
+                )
@@ -1,65 +1,188 @@
-import json
-
-import streamlit as st
-import websocket
-from streamlit_ace import st_ace
-
-
-def show_message_injection_component():
-    st.divider()
-    st.markdown("#### OCPP Message Injection")
-    options = {"CSMS → CP": "csms-cp", "CP → CSMS": "cp-csms"}
-    with st.form("injection"):
-        left, right = st.columns([1, 4])
-        with left:
-            direction = st.segmented_control(
-                "Select Message Direction:", options.keys(), selection_mode="single"
-            )
-
-        with right:
-            json_input = st_ace(
-                language="json",
-                theme="github",
-                placeholder="Enter JSON PDU here",
-                height=180,
-                key="json_input",
-                auto_update=True,
-            )
-
-        if st.form_submit_button(
-            "Inject OCPP Message",
-            disabled=not st.session_state.app_state.charge_point_id,
-        ):
-            if not direction:
-                st.error("Select a message direction before injecting a message")
-            else:
-                try:
-                    json_message = json.loads(json_input)
-                    if json_message[0] != 2:
-                        st.error(
-                            "Injected OCPP Message should be a CALL Message i.e Request (2)"
-                        )
-                    elif type(json_message[1]) != str:
-                        st.error("Please make sure message ID is a string")
-                    elif (
-                        json_message[1]
-                        in st.session_state.app_state.injected_message_ids
-                    ):
-                        st.error(
-                            f"The message ID {json_message[1]} is already used. Please use a unique ID"
-                        )
-                    else:
-                        st.session_state.app_state.injected_message_ids.append(
-                            json_message[1]
-                        )
-                        ws = websocket.WebSocket()
-                        ws.connect(
-                            f"{st.session_state.app_state.relay_url}/inject/{options[direction]}"
-                        )
-                        ws.send(json_input)
-                        ws.close()
-                        st.success(
-                            f"OCPP Message injected successfully for direction {direction}"
-                        )
-                except json.JSONDecodeError:
-                    st.error("Invalid JSON!")
+import itertools
+import json
+import logging
+import threading
+
+import streamlit as st
+import websocket
+from streamlit_ace import st_ace
+
+# Seconds to wait for the response of an injected call
+INJECTION_TIMEOUT = 30.0
+
+
+class InjectionChannel:
+    """
+    Long-lived injection channel to the relay shared by all UI sessions, a reader thread hands every reply to the
+    caller waiting for its tag.
+    """
+
+    def __init__(self, relay_url):
+        self.url = f"{relay_url}/inject"
+        self.logger = logging.getLogger(InjectionChannel.__qualname__)
+        self._lock = threading.Lock()
+        self._ws = None
+        self._tags = itertools.count()
+        # tag -> [threading.Event, reply, connection the call was sent on]
+        self._waiting = {}
+
+    def _connect(self):
+        if self._ws is None or not self._ws.connected:
+            self.logger.info(f"Opening the injection channel to {self.url}")
+            self._ws = websocket.create_connection(self.url)
+            threading.Thread(target=self._read, args=(self._ws,), daemon=True).start()
+        return self._ws
+
+    def _read(self, ws):
+        try:
+            while True:
+                reply = json.loads(ws.recv())
+                waiting = self._waiting.get(reply.get("tag"))
+                if waiting is not None:
+                    waiting[1] = reply
+                    waiting[0].set()
+        except (websocket.WebSocketException, OSError, ValueError) as e:
+            self.logger.info(f"Injection channel closed: {e!r}")
+        # Calls sent on the channel get no reply anymore, their callers needn't wait for the timeout
+        with self._lock:
+            for tag, waiting in list(self._waiting.items()):
+                if waiting[2] is ws and waiting[1] is None:
+                    waiting[1] = {
+                        "tag": tag,
+                        "outcome": "closed",
+                        "reason": "The injection channel closed",
+                    }
+                    waiting[0].set()
+
+    def call(self, charge_point_id, direction, message, timeout=INJECTION_TIMEOUT):
+        """Injects a CALL, returns the relay's reply with its outcome and response frame (None on a timeout)."""
+        waiting = [threading.Event(), None, None]
+        with self._lock:
+            tag = next(self._tags)
+            self._waiting[tag] = waiting
+        request = json.dumps(
+            {
+                "tag": tag,
+                "charge_point_id": charge_point_id,
+                "direction": direction,
+                "message": message,
+                "timeout": timeout,
+            }
+        )
+        try:
+            with self._lock:
+                try:
+                    waiting[2] = self._connect()
+                    waiting[2].send(request)
+                except (websocket.WebSocketException, OSError):
+                    # Reopened once, e.g. after the relay restarted
+                    self._ws = None
+                    waiting[2] = self._connect()
+                    waiting[2].send(request)
+            # The relay answers timed out calls itself, the margin only covers a relay that went away
+            waiting[0].wait(timeout + 5.0)
+            return waiting[1]
+        finally:
+            self._waiting.pop(tag, None)
+
+
+def show_message_injection_component():
+    st.divider()
+    st.markdown("#### OCPP Message Injection")
+    options = {"CSMS → CP": "csms-cp", "CP → CSMS": "cp-csms"}
+    with st.form("injection"):
+        left, right = st.columns([1, 4])
+        with left:
+            direction = st.segmented_control(
+                "Select Message Direction:", options.keys(), selection_mode="single"
+            )
+            charge_point_id = st.selectbox(
+                "Select ChargePoint:", st.session_state.app_state.charge_point_ids
+            )
+
+        with right:
+            json_input = st_ace(
+                language="json",
+                theme="github",
+                placeholder="Enter JSON PDU here",
+                height=180,
+                key="json_input",
+                auto_update=True,
+            )
+
+        if st.form_submit_button(
+            "Inject OCPP Message",
+            disabled=not st.session_state.app_state.charge_point_ids,
+        ):
+            if not direction:
+                st.error("Select a message direction before injecting a message")
+            elif not charge_point_id:
+                st.error("Select a ChargePoint before injecting a message")
+            else:
+                try:
+                    json_message = json.loads(json_input)
+                    if json_message[0] != 2:
+                        st.error(
+                            "Injected OCPP Message should be a CALL Message i.e Request (2)"
+                        )
+                    elif type(json_message[1]) != str:
+                        st.error("Please make sure message ID is a string")
+                    elif (
+                        st.session_state.app_state.injected_messages.is_pending(
+                            charge_point_id, options[direction], json_message[1]
+                        )
+                        or f"{charge_point_id}/{json_message[1]}"
+                        in st.session_state.app_state.events
+                    ):
+                        st.error(
+                            f"The message ID {json_message[1]} is already used. Please use a unique ID"
+                        )
+                    else:
+                        injected_messages = st.session_state.app_state.injected_messages
+                        injected_messages.add(
+                            charge_point_id, options[direction], json_message[1]
+                        )
+                        if st.session_state.app_state.injection_channel is None:
+                            st.session_state.app_state.injection_channel = (
+                                InjectionChannel(st.session_state.app_state.relay_url)
+                            )
+                        try:
+                            with st.spinner(
+                                f"Injecting to {charge_point_id} and waiting for the response..."
+                            ):
+                                reply = (
+                                    st.session_state.app_state.injection_channel.call(
+                                        charge_point_id,
+                                        options[direction],
+                                        json_message,
+                                    )
+                                )
+                        except (websocket.WebSocketException, OSError):
+                            # Never sent, its id can be used again right away
+                            injected_messages.discard(
+                                charge_point_id, options[direction], json_message[1]
+                            )
+                            raise
+                        if reply is not None and reply["outcome"] == "rejected":
+                            injected_messages.discard(
+                                charge_point_id, options[direction], json_message[1]
+                            )
+                        if reply is None or reply["outcome"] in ("timeout", "closed"):
+                            st.warning(
+                                f"OCPP Message injected to {charge_point_id} for direction {direction}, "
+                                f"but no response arrived ({reply['outcome'] if reply else 'timeout'})"
+                            )
+                        elif reply["outcome"] == "rejected":
+                            st.error(
+                                f"The relay rejected the message: {reply['reason']}"
+                            )
+                        else:
+                            st.success(
+                                f"OCPP Message injected successfully to {charge_point_id} for direction {direction}, "
+                                f"{reply['outcome']} after {reply['round_trip'] * 1000:.1f} ms"
+                            )
+                            st.json(reply["response"])
+                except json.JSONDecodeError:
+                    st.error("Invalid JSON!")
+                except (websocket.WebSocketException, OSError) as e:
+                    st.error(f"Injecting through the relay failed: {e}")
@@ -0,0 +1,125 @@
+from datetime import datetime
+
+import streamlit as st
+
+from components.events import query_relay
+
+
+def _time(timestamp):
+    if timestamp is None:
+        return "-"
+    return datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S") + "Z"
+
+
+def _label(summary: dict) -> str:
+    state = "🔌 active" if summary["active"] else "✅ ended"
+    return f"{summary['transaction_id']} - {_time(summary['started_at'])} - {state}"
+
+
+def show_transaction_summary(summary: dict):
+    energy, max_power, avg_power, soc, duration = st.columns(5)
+    energy.metric(
+        "Energy",
+        (
+            f"{summary['energy_wh'] / 1000:.2f} kWh"
+            if summary["energy_wh"] is not None
+            else "-"
+        ),
+    )
+    max_power.metric(
+        "Max Power",
+        (
+            f"{summary['power_max_w'] / 1000:.1f} kW"
+            if summary["power_max_w"] is not None
+            else "-"
+        ),
+    )
+    avg_power.metric(
+        "Avg Power",
+        (
+            f"{summary['power_avg_w'] / 1000:.1f} kW"
+            if summary["power_avg_w"] is not None
+            else "-"
+        ),
+    )
+    soc.metric(
+        "SoC",
+        (
+            f"{summary['soc_start']:.0f} → {summary['soc_end']:.0f} %"
+            if summary["soc_start"] is not None
+            else "-"
+        ),
+    )
+    duration.metric(
+        "Duration",
+        (
+            f"{summary['duration'] / 60:.0f} min"
+            if summary["duration"] is not None
+            else "-"
+        ),
+    )
+    st.caption(
+        f"EVSE {summary['evse_id']}, {summary['samples']} samples from {_time(summary['started_at'])} "
+        + (
+            f"to {_time(summary['ended_at'])}"
+            if summary["ended_at"] is not None
+            else "on, still charging"
+        )
+        + (", series truncated" if summary["truncated"] else "")
+    )
+
+
+def show_transaction_charts(series: dict):
+    times = [datetime.utcfromtimestamp(timestamp) for timestamp in series["timestamp"]]
+    for column, label in (
+        ("power", "Power (W)"),
+        ("current", "Current (A)"),
+        ("energy", "Energy (Wh)"),
+        ("soc", "SoC (%)"),
+    ):
+        # Columns without any sample in this transaction aren't charted
+        if any(value is not None for value in series[column]):
+            st.line_chart({"Time": times, label: series[column]}, x="Time", y=label)
+
+
+def show_transactions_component():
+    st.header("Transactions")
+    charge_point_ids = sorted(
+        {
+            *st.session_state.app_state.charge_point_ids,
+            *st.session_state.app_state.events.values("charge_point_id"),
+        }
+    )
+    charge_point_id = st.selectbox(
+        "ChargePoint",
+        charge_point_ids,
+        index=None,
+        placeholder="Select a ChargePoint",
+        key="transactions_charge_point_id",
+    )
+    if charge_point_id is None:
+        return
+    result = query_relay("transactions", {"charge_point_id": charge_point_id})
+    if "error" in result:
+        st.error(result["error"], icon=":material/ev_station:")
+        return
+    summaries = {
+        summary["transaction_id"]: summary for summary in result["transactions"]
+    }
+    if not summaries:
+        st.write("*No meter values relayed for this ChargePoint yet*")
+        return
+    transaction_id = st.selectbox(
+        "Transaction",
+        list(summaries),
+        format_func=lambda transaction_id: _label(summaries[transaction_id]),
+    )
+    result = query_relay(
+        "transactions",
+        {"charge_point_id": charge_point_id, "transaction_id": transaction_id},
+    )
+    if "error" in result:
+        st.error(result["error"], icon=":material/ev_station:")
+        return
+    show_transaction_summary(result["summary"])
+    show_transaction_charts(result["series"])
@@ -0,0 +1,206 @@
+import asyncio
+import collections
+from enum import Enum
+from typing import List, Optional, Tuple
+
+import websockets
+
+# (charge point id or None for relay wide events, serialized event)
+Entry = Tuple[Optional[str], str]
+
+
+class OverflowPolicy(str, Enum):
+    DROP_OLDEST = "drop-oldest"
+    DROP_NEW = "drop-new"
+    DISCONNECT = "disconnect"
+
+
+class SubscriptionClosed(Exception):
+    pass
+
+
+class Subscription:
+    def __init__(
+        self,
+        bus: "EventBus",
+        policy: OverflowPolicy,
+        charge_point_id: Optional[str] = None,
+    ):
+        self.bus = bus
+        self.policy = policy
+        self.charge_point_id = charge_point_id
+        self.cursor = bus.head
+        self.delivered = 0
+        self.dropped = 0
+        self.closed = False
+        self.close_reason = None
+        self._wakeup = asyncio.Event()
+        # Only used by DROP_NEW subscribers that fell behind, holds the unread window they still get to see
+        self._backlog: Optional[collections.deque] = None
+
+    @property
+    def lag(self) -> int:
+        if self._backlog is not None:
+            return len(self._backlog)
+        return self.bus.head - self.cursor
+
+    def _take_available(self, max_items: int) -> List[Entry]:
+        entries = []
+        if self._backlog is not None:
+            while self._backlog and len(entries) < max_items:
+                entries.append(self._backlog.popleft())
+            if self._backlog:
+                return self._filter(entries)
+            # Everything published while the backlog was held has been dropped, resume at the live head
+            self._backlog = None
+            self.cursor = self.bus.head
+        while self.cursor < self.bus.head and len(entries) < max_items:
+            entries.append(self.bus.at(self.cursor))
+            self.cursor += 1
+        return self._filter(entries)
+
+    def _filter(self, entries: List[Entry]) -> List[Entry]:
+        if self.charge_point_id is not None:
+            # Events without a charge point (e.g. relay wide ones) are delivered to every subscriber
+            entries = [
+                entry
+                for entry in entries
+                if entry[0] is None or entry[0] == self.charge_point_id
+            ]
+        self.delivered += len(entries)
+        return entries
+
+    async def get_entries(self, max_items: int = 256) -> List[Entry]:
+        while True:
+            if self.closed:
+                raise SubscriptionClosed(self.close_reason)
+            entries = self._take_available(max_items)
+            if entries:
+                return entries
+            if self.lag:
+                # Everything available was filtered out, look at the next batch straight away
+                continue
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    async def get_batch(self, max_items: int = 256) -> List[str]:
+        return [message for _, message in await self.get_entries(max_items)]
+
+    async def get(self) -> str:
+        return (await self.get_batch(max_items=1))[0]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        try:
+            return await self.get()
+        except SubscriptionClosed:
+            raise StopAsyncIteration
+
+    def close(self, reason: str = "Unsubscribed"):
+        if not self.closed:
+            self.closed = True
+            self.close_reason = reason
+            self.bus._subscribers.discard(self)
+            self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.policy.value,
+            "lag": self.lag,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "closed": self.closed,
+        }
+
+
+class EventBus:
+    """Fan-out of relay events over a fixed-size ring buffer, each subscriber reads with its own cursor."""
+
+    def __init__(
+        self,
+        capacity: int = 4096,
+        overflow_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+    ):
+        self.capacity = capacity
+        self.overflow_policy = OverflowPolicy(overflow_policy)
+        self.head = 0
+        self.disconnected = 0
+        self._ring = [None] * capacity
+        self._subscribers = set()
+
+    def at(self, seq: int) -> Entry:
+        return self._ring[seq % self.capacity]
+
+    @property
+    def depth(self) -> int:
+        return min(self.head, self.capacity)
+
+    def subscribe(
+        self,
+        overflow_policy: Optional[OverflowPolicy] = None,
+        charge_point_id: Optional[str] = None,
+    ) -> Subscription:
+        subscription = Subscription(
+            self,
+            OverflowPolicy(overflow_policy or self.overflow_policy),
+            charge_point_id=charge_point_id,
+        )
+        self._subscribers.add(subscription)
+        return subscription
+
+    def publish(self, message: str, charge_point_id: Optional[str] = None):
+        for subscription in tuple(self._subscribers):
+            if subscription._backlog is not None:
+                subscription.dropped += 1
+            elif self.head - subscription.cursor >= self.capacity:
+                # The slot about to be overwritten is still unread by this subscriber
+                if subscription.policy is OverflowPolicy.DROP_OLDEST:
+                    subscription.cursor += 1
+                    subscription.dropped += 1
+                elif subscription.policy is OverflowPolicy.DROP_NEW:
+                    subscription._backlog = collections.deque(
+                        self.at(seq) for seq in range(subscription.cursor, self.head)
+                    )
+                    subscription.dropped += 1
+                else:
+                    self.disconnected += 1
+                    subscription.close(
+                        f"Subscriber fell behind by more than {self.capacity} events"
+                    )
+                    continue
+            subscription._wakeup.set()
+        self._ring[self.head % self.capacity] = (charge_point_id, message)
+        self.head += 1
+
+    @property
+    def has_subscribers(self) -> bool:
+        return bool(self._subscribers)
+
+    @property
+    def subscribers(self) -> List[Subscription]:
+        return list(self._subscribers)
+
+    def stats(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "depth": self.depth,
+            "published": self.head,
+            "disconnected": self.disconnected,
+            "subscribers": [subscription.stats() for subscription in self._subscribers],
+        }
+
+
+async def stream_subscription(ws, subscription: Subscription, logger):
+    try:
+        while True:
+            for message in await subscription.get_batch():
+                await ws.send(message)
+    except SubscriptionClosed as e:
+        logger.warning(f"Disconnecting slow event subscriber: {e}")
+        await ws.close(code=1013, reason="Subscriber too slow")
+    except websockets.exceptions.ConnectionClosed:
+        logger.info(f"Event subscriber detached: {subscription.stats()}")
+    finally:
+        subscription.close()
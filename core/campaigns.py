@@ -0,0 +1,539 @@
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import math
+import random
+import re
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import websockets
+
+from core.frames import CALL
+from core.injection import InjectionClient, InjectionRejected
+from core.sessions import DIRECTIONS
+
+_PLACEHOLDER = re.compile(r"{{\s*(\w+)(?::([^}]*))?\s*}}")
+
+
+class CampaignError(ValueError):
+    pass
+
+
+# Numeric settings of a CampaignSpec: integer or not, None allowed or not
+_NUMBERS = {
+    "rate": (False, False),
+    "count": (True, True),
+    "duration": (False, True),
+    "concurrency": (True, False),
+    "concurrency_per_charge_point": (True, False),
+    "timeout": (False, False),
+}
+
+
+def _generator(name: str, argument: Optional[str]) -> Callable[[dict], object]:
+    if name in ("seq", "charge_point_id", "message_id", "counter"):
+        return lambda context: context[name]
+    if name == "now":
+        return lambda context: datetime.now(timezone.utc).isoformat(
+            timespec="milliseconds"
+        )
+    if name == "uuid":
+        return lambda context: str(uuid.uuid4())
+    try:
+        if name == "randint":
+            low, high = (int(value) for value in argument.split(":"))
+            return lambda context: random.randint(low, high)
+        if name == "uniform":
+            low, high = (float(value) for value in argument.split(":"))
+            return lambda context: round(random.uniform(low, high), 3)
+        if name == "choice":
+            choices = argument.split("|")
+            return lambda context: random.choice(choices)
+    except (AttributeError, ValueError):
+        raise CampaignError(f"Invalid arguments of {{{{{name}}}}}: {argument!r}")
+    raise CampaignError(f"Unknown placeholder {{{{{name}}}}}")
+
+
+def compile_template(template) -> Callable[[dict], object]:
+    """
+    Compiles a payload template once, so that rendering it per call only runs the generators. A string that is just
+    a placeholder (e.g. "{{randint:1:4}}") renders to the generated value itself, other strings are formatted.
+    Placeholders: seq, counter (per ChargePoint), charge_point_id, message_id, now, uuid, randint:a:b, uniform:a:b,
+    choice:a|b|c.
+    """
+    if isinstance(template, dict):
+        items = [(key, compile_template(value)) for key, value in template.items()]
+        return lambda context: {key: render(context) for key, render in items}
+    if isinstance(template, list):
+        renders = [compile_template(value) for value in template]
+        return lambda context: [render(context) for render in renders]
+    if isinstance(template, str) and "{{" in template:
+        whole = _PLACEHOLDER.fullmatch(template)
+        if whole:
+            return _generator(*whole.groups())
+        parts, position = [], 0
+        for match in _PLACEHOLDER.finditer(template):
+            literal = template[position : match.start()]
+            parts.append(lambda context, literal=literal: literal)
+            parts.append(_generator(*match.groups()))
+            position = match.end()
+        literal = template[position:]
+        parts.append(lambda context: literal)
+        return lambda context: "".join(str(part(context)) for part in parts)
+    return lambda context: template
+
+
+@dataclass
+class CampaignSpec:
+    action: str
+    payload: dict = field(default_factory=dict)
+    direction: str = "csms-cp"
+    # None targets every ChargePoint connected when the campaign starts
+    charge_point_ids: Optional[List[str]] = None
+    # Calls per second over all targets, `schedule` steps of [seconds since start, rate] override it from their offset
+    rate: float = 10.0
+    schedule: List[Tuple[float, float]] = field(default_factory=list)
+    # The campaign ends after `count` calls or `duration` seconds, whichever comes first
+    count: Optional[int] = None
+    duration: Optional[float] = None
+    concurrency: int = 100
+    # OCPP-J allows a single outstanding CALL per direction and connection
+    concurrency_per_charge_point: int = 1
+    timeout: float = 30.0
+    name: str = "campaign"
+
+    @classmethod
+    def from_dict(cls, spec: dict) -> "CampaignSpec":
+        if not isinstance(spec, dict):
+            raise CampaignError(f"A campaign is a JSON object, got {spec!r}")
+        try:
+            spec = cls(**spec)
+        except TypeError as e:
+            raise CampaignError(str(e))
+        if not isinstance(spec.action, str) or not spec.action:
+            raise CampaignError(f"Invalid action: {spec.action!r}")
+        if spec.direction not in DIRECTIONS:
+            raise CampaignError(f"Unknown direction: {spec.direction}")
+        if spec.charge_point_ids is not None and not (
+            isinstance(spec.charge_point_ids, list)
+            and all(isinstance(target, str) for target in spec.charge_point_ids)
+        ):
+            raise CampaignError("charge_point_ids must be a list of ChargePoint ids")
+        for name, (integer, optional) in _NUMBERS.items():
+            value = getattr(spec, name)
+            if value is None and optional:
+                continue
+            if isinstance(value, bool) or not isinstance(
+                value, int if integer else (int, float)
+            ):
+                kind = "an integer" if integer else "a number"
+                raise CampaignError(f"{name} must be {kind}, got {value!r}")
+            # A rate of 0 waits for the next step of the schedule
+            if not 0 <= value < math.inf or (value == 0 and name != "rate"):
+                raise CampaignError(f"{name} must be positive, got {value!r}")
+        if spec.count is None and spec.duration is None:
+            raise CampaignError("A campaign needs a count or a duration")
+        try:
+            schedule = sorted((float(at), float(rate)) for at, rate in spec.schedule)
+        except (TypeError, ValueError):
+            schedule = None
+        if schedule is None or any(
+            not 0 <= at < math.inf or not 0 <= rate < math.inf for at, rate in schedule
+        ):
+            raise CampaignError(
+                f"schedule must be a list of [seconds, rate] steps, got {spec.schedule!r}"
+            )
+        spec.schedule = schedule
+        if spec.rate <= 0 and not spec.schedule:
+            raise CampaignError("A campaign needs a positive rate or a schedule")
+        return spec
+
+    def to_dict(self) -> dict:
+        return {
+            "action": self.action,
+            "payload": self.payload,
+            "direction": self.direction,
+            "charge_point_ids": self.charge_point_ids,
+            "rate": self.rate,
+            "schedule": self.schedule,
+            "count": self.count,
+            "duration": self.duration,
+            "concurrency": self.concurrency,
+            "concurrency_per_charge_point": self.concurrency_per_charge_point,
+            "timeout": self.timeout,
+            "name": self.name,
+        }
+
+    def rate_at(self, offset: float) -> float:
+        rate = self.rate
+        for at, step_rate in self.schedule:
+            if at > offset:
+                break
+            rate = step_rate
+        return rate
+
+    def next_step(self, offset: float) -> Optional[float]:
+        return next((at for at, _ in self.schedule if at > offset), None)
+
+    def planned_duration(self) -> float:
+        """Seconds from the start until the last call is due, by the count, duration and rates of the campaign."""
+        remaining = self.count if self.count is not None else math.inf
+        offset = 0.0
+        while True:
+            rate, step = self.rate_at(offset), self.next_step(offset)
+            end = min(
+                step if step is not None else math.inf,
+                self.duration if self.duration is not None else math.inf,
+            )
+            if rate > 0 and offset + remaining / rate <= end:
+                return offset + remaining / rate
+            if step is None or end < step:
+                return end if rate > 0 else offset
+            remaining -= (step - offset) * rate
+            offset = step
+
+    def split(self, shares: Sequence[List[str]]) -> List[Optional["CampaignSpec"]]:
+        """
+        One campaign per group of targets, with its share of the rate and count, None for a group that gets no call.
+        Counts are split by the largest remainder, so they add up to the campaign's count, and rates in the same
+        proportion, so all shares take as long as the campaign.
+        """
+        total = sum(len(targets) for targets in shares)
+        fractions = [len(targets) / total for targets in shares]
+        counts = [None] * len(shares)
+        if self.count is not None:
+            exact = [self.count * fraction for fraction in fractions]
+            counts = [math.floor(count) for count in exact]
+            by_remainder = sorted(
+                range(len(shares)), key=lambda i: counts[i] - exact[i]
+            )
+            for i in by_remainder[: self.count - sum(counts)]:
+                counts[i] += 1
+            fractions = [count / self.count for count in counts]
+        specs = []
+        for targets, fraction, count in zip(shares, fractions, counts):
+            if count == 0:
+                specs.append(None)
+                continue
+            spec = CampaignSpec.from_dict(
+                {
+                    **self.to_dict(),
+                    "charge_point_ids": targets,
+                    "rate": self.rate * fraction,
+                    "schedule": [(at, rate * fraction) for at, rate in self.schedule],
+                    "count": count,
+                }
+            )
+            specs.append(spec)
+        return specs
+
+
+class LogHistogram:
+    """Mergeable histogram with buckets 2% apart, so percentiles are within 2% whatever the range."""
+
+    GROWTH = 1.02
+    MINIMUM = 1e-6
+
+    def __init__(self, counts: Optional[Dict[int, int]] = None, maximum: float = 0.0):
+        self.counts: Dict[int, int] = collections.Counter(counts or {})
+        self.maximum = maximum
+
+    def observe(self, value: float):
+        bucket = (
+            int(math.log(value / self.MINIMUM, self.GROWTH))
+            if value > self.MINIMUM
+            else -1
+        )
+        self.counts[bucket] += 1
+        self.maximum = max(self.maximum, value)
+
+    def merge(self, other: "LogHistogram"):
+        self.counts.update(other.counts)
+        self.maximum = max(self.maximum, other.maximum)
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts.values())
+
+    def percentile(self, percentile: float) -> float:
+        rank, seen = self.count * percentile / 100, 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return (
+                    0.0
+                    if bucket < 0
+                    else min(self.MINIMUM * self.GROWTH ** (bucket + 1), self.maximum)
+                )
+        return 0.0
+
+    def summary(self) -> dict:
+        return {
+            "p50_ms": self.percentile(50) * 1000,
+            "p90_ms": self.percentile(90) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": self.maximum * 1000,
+        }
+
+    def to_dict(self) -> dict:
+        return {"counts": dict(self.counts), "max": self.maximum}
+
+    @classmethod
+    def from_dict(cls, histogram: dict) -> "LogHistogram":
+        return cls(
+            {int(bucket): count for bucket, count in histogram["counts"].items()},
+            histogram["max"],
+        )
+
+
+@dataclass
+class CampaignReport:
+    name: str
+    action: str
+    target_rate: float
+    charge_points: int = 0
+    sent: int = 0
+    rejected: int = 0
+    duration: float = 0.0
+    # Until the last call was sent, the rest of `duration` is spent waiting for responses
+    send_duration: float = 0.0
+    outcomes: Dict[str, int] = field(default_factory=collections.Counter)
+    # How late each call was sent compared to its schedule, and its round trip through the relay
+    drift: LogHistogram = field(default_factory=LogHistogram)
+    latency: LogHistogram = field(default_factory=LogHistogram)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "action": self.action,
+            "charge_points": self.charge_points,
+            "sent": self.sent,
+            "rejected": self.rejected,
+            "duration_s": self.duration,
+            "send_duration_s": self.send_duration,
+            "target_rate_per_s": self.target_rate,
+            "achieved_rate_per_s": (
+                (self.sent + self.rejected) / self.send_duration
+                if self.send_duration
+                else 0.0
+            ),
+            "outcomes": dict(self.outcomes),
+            "drift": self.drift.summary(),
+            "latency": self.latency.summary(),
+            "histograms": {
+                "drift": self.drift.to_dict(),
+                "latency": self.latency.to_dict(),
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, report: dict) -> "CampaignReport":
+        return cls(
+            name=report["name"],
+            action=report["action"],
+            target_rate=report["target_rate_per_s"],
+            charge_points=report["charge_points"],
+            sent=report["sent"],
+            rejected=report["rejected"],
+            duration=report["duration_s"],
+            send_duration=report["send_duration_s"],
+            outcomes=collections.Counter(report["outcomes"]),
+            drift=LogHistogram.from_dict(report["histograms"]["drift"]),
+            latency=LogHistogram.from_dict(report["histograms"]["latency"]),
+        )
+
+    @classmethod
+    def merge(cls, reports: Sequence["CampaignReport"]) -> "CampaignReport":
+        """Combines the reports of a campaign split across relay workers."""
+        merged = cls(reports[0].name, reports[0].action, target_rate=0.0)
+        for report in reports:
+            merged.target_rate += report.target_rate
+            merged.charge_points += report.charge_points
+            merged.sent += report.sent
+            merged.rejected += report.rejected
+            merged.duration = max(merged.duration, report.duration)
+            merged.send_duration = max(merged.send_duration, report.send_duration)
+            merged.outcomes.update(report.outcomes)
+            merged.drift.merge(report.drift)
+            merged.latency.merge(report.latency)
+        return merged
+
+    def format(self) -> str:
+        report = self.to_dict()
+        drift, latency = report["drift"], report["latency"]
+        return "\n".join(
+            [
+                f"Campaign {report['name']}: {report['sent']} {report['action']} calls to {report['charge_points']} "
+                f"ChargePoints in {report['duration_s']:.2f} s ({report['achieved_rate_per_s']:.1f} calls/s, "
+                f"target {report['target_rate_per_s']:.1f}, rejected: {report['rejected']})",
+                "Outcomes: "
+                + ", ".join(
+                    f"{outcome} {count}"
+                    for outcome, count in sorted(report["outcomes"].items())
+                ),
+                f"Send drift p50 {drift['p50_ms']:.2f} ms, p99 {drift['p99_ms']:.2f} ms, max {drift['max_ms']:.2f} ms",
+                f"Response latency p50 {latency['p50_ms']:.2f} ms, p90 {latency['p90_ms']:.2f} ms, "
+                f"p99 {latency['p99_ms']:.2f} ms, max {latency['max_ms']:.2f} ms",
+            ]
+        )
+
+
+class Campaign:
+    """
+    Injects templated calls on a schedule kept by the event loop: call `i` is due at an absolute time derived from
+    the rate in force, so a late call doesn't delay the following ones. Calls go round-robin to the targets, bounded
+    overall and per ChargePoint.
+    """
+
+    def __init__(self, spec: CampaignSpec, inject_call, charge_point_ids: List[str]):
+        self.spec = spec
+        self.inject_call = inject_call
+        self.charge_point_ids = charge_point_ids
+        self.render = compile_template(spec.payload)
+        self.run_id = uuid.uuid4().hex[:8]
+        self.report = CampaignReport(
+            spec.name,
+            spec.action,
+            target_rate=spec.rate_at(0),
+            charge_points=len(charge_point_ids),
+        )
+        self.logger = logging.getLogger(Campaign.__qualname__)
+        self._in_flight = asyncio.Semaphore(spec.concurrency)
+        self._per_charge_point = {
+            charge_point_id: asyncio.Semaphore(spec.concurrency_per_charge_point)
+            for charge_point_id in charge_point_ids
+        }
+        self._counters = collections.Counter()
+
+    def _schedule(self):
+        """Offsets from the start at which the calls are due."""
+        spec, offset, sent = self.spec, 0.0, 0
+        while spec.count is None or sent < spec.count:
+            rate = spec.rate_at(offset)
+            if rate <= 0:
+                offset = spec.next_step(offset)
+                if offset is None:
+                    return
+                continue
+            if spec.duration is not None and offset >= spec.duration:
+                return
+            yield offset
+            sent += 1
+            offset += 1 / rate
+
+    async def _call(self, seq, charge_point_id, due, started):
+        loop = asyncio.get_running_loop()
+        try:
+            async with self._per_charge_point[charge_point_id]:
+                self._counters[charge_point_id] += 1
+                message_id = f"{self.spec.name}-{self.run_id}-{seq}"
+                context = {
+                    "seq": seq,
+                    "counter": self._counters[charge_point_id],
+                    "charge_point_id": charge_point_id,
+                    "message_id": message_id,
+                }
+                frame = json.dumps(
+                    [CALL, message_id, self.spec.action, self.render(context)]
+                )
+                sent_at = loop.time()
+                self.report.drift.observe(max(0.0, sent_at - started - due))
+                try:
+                    exchange = await self.inject_call(
+                        self.spec.direction, charge_point_id, frame, self.spec.timeout
+                    )
+                except (InjectionRejected, websockets.exceptions.ConnectionClosed):
+                    # E.g. the ChargePoint disconnected meanwhile
+                    self.report.rejected += 1
+                    return
+                self.report.sent += 1
+                if exchange is None:
+                    self.report.outcomes["timeout"] += 1
+                else:
+                    self.report.outcomes[exchange.outcome] += 1
+                    if exchange.round_trip is not None:
+                        self.report.latency.observe(exchange.round_trip)
+        finally:
+            self._in_flight.release()
+
+    async def run(self) -> CampaignReport:
+        loop = asyncio.get_running_loop()
+        if not self.charge_point_ids:
+            return self.report
+        self.logger.info(
+            f"Starting campaign {self.spec.name} ({self.run_id}): {self.spec.action} to "
+            f"{len(self.charge_point_ids)} ChargePoints at {self.spec.rate_at(0)} calls/s"
+        )
+        tasks = set()
+        started = loop.time()
+        scheduled, planned = 0, 0.0
+        try:
+            for seq, due in enumerate(self._schedule()):
+                delay = started + due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self._in_flight.acquire()
+                task = asyncio.create_task(
+                    self._call(
+                        seq,
+                        self.charge_point_ids[seq % len(self.charge_point_ids)],
+                        due,
+                        started,
+                    )
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                scheduled, planned = seq + 1, due + 1 / self.spec.rate_at(due)
+            self.report.send_duration = loop.time() - started
+            if scheduled:
+                self.report.target_rate = scheduled / planned
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.report.duration = loop.time() - started
+        self.logger.info(
+            f"Campaign {self.spec.name} ({self.run_id}) done: {self.report.format()}"
+        )
+        return self.report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run an injection campaign through a relay's injection channel"
+    )
+    parser.add_argument(
+        "spec", help="Campaign json file, see core.campaigns.CampaignSpec"
+    )
+    parser.add_argument("--relay-url", default="ws://localhost:8500")
+    parser.add_argument("--json", action="store_true", help="Print the report as json")
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="Seconds to wait for the report, by default the campaign's planned duration plus a margin",
+    )
+    args = parser.parse_args()
+
+    with open(args.spec) as f:
+        spec = CampaignSpec.from_dict(json.load(f))
+
+    async def run():
+        async with InjectionClient(args.relay_url) as client:
+            return await client.campaign(spec.to_dict(), timeout=args.timeout)
+
+    reply = asyncio.run(run())
+    if reply["outcome"] != "campaign":
+        raise SystemExit(f"Campaign {reply['outcome']}: {reply.get('reason')}")
+    report = CampaignReport.from_dict(reply["report"])
+    print(json.dumps(reply["report"], indent=2) if args.json else report.format())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,792 @@
+import asyncio
+import bisect
+import heapq
+import itertools
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from core.frames import Frame, FrameError
+
+DIRECTION_CODES = {"cp-csms": 0, "csms-cp": 1}
+DIRECTION_NAMES = {code: name for name, code in DIRECTION_CODES.items()}
+
+# Data record: header, then charge point id, message id, action and the raw frame (all utf-8)
+_RECORD = struct.Struct("<IdBBHHH")
+# Side index entry per record: timestamp, offset, record length, crc32 of charge point id, crc32 of message id
+_INDEX = struct.Struct("<dQIII")
+# Term index entry: crc32 of `field=value`, position of the record in its segment
+_TERM = struct.Struct("<II")
+# Sorted lookups of a complete segment: the number of charge point, message id and term keys, then the keys of each
+# lookup in ascending order, a key is `hash << 32 | position` (uint64, little-endian)
+_SORTED = struct.Struct("<QQQ")
+_SEGMENT_SUFFIXES = (".cap", ".idx", ".trm", ".srt")
+_SEGMENT = re.compile(r"(?P<stream>.+)-(?P<seq>\d{8})\.cap$")
+
+
+def _crc(value: str) -> int:
+    return zlib.crc32(value.encode())
+
+
+# Payload keys whose values are indexed, by the field they are searched as. OCPP 1.6 and 2.0.1 names are merged,
+# e.g. `idToken` is searched as idTag and `evse.id` as evseId.
+TERM_KEYS = {
+    "idTag": "idTag",
+    "idToken": "idTag",
+    "transactionId": "transactionId",
+    "evseId": "evseId",
+    "connectorId": "connectorId",
+    "status": "status",
+    "connectorStatus": "status",
+}
+TERM_FIELDS = ("action", "idTag", "transactionId", "evseId", "connectorId", "status")
+# Bounds the work per frame, e.g. for large MeterValues
+_MAX_TERM_DEPTH = 4
+_MAX_TERMS = 32
+
+
+def _payload_terms(value, terms: Set[Tuple[str, str]], depth: int):
+    if depth > _MAX_TERM_DEPTH or len(terms) >= _MAX_TERMS:
+        return
+    items = value.items() if isinstance(value, dict) else enumerate(value)
+    for key, item in items:
+        if isinstance(item, (dict, list)):
+            if key == "evse" and isinstance(item, dict) and "id" in item:
+                terms.add(("evseId", str(item["id"])))
+            _payload_terms(item, terms, depth + 1)
+        elif key in TERM_KEYS and not isinstance(item, bool) and item is not None:
+            terms.add((TERM_KEYS[key], str(item)))
+
+
+def frame_terms(frame: Frame) -> Set[Tuple[str, str]]:
+    """The (field, value) pairs a frame is found by, see TERM_FIELDS."""
+    terms = set()
+    if frame.action:
+        terms.add(("action", frame.action))
+    try:
+        payload = frame.payload
+    except (ValueError, IndexError):
+        return terms
+    if isinstance(payload, (dict, list)):
+        _payload_terms(payload, terms, 0)
+    return terms
+
+
+def _term_hash(field: str, value: str) -> int:
+    return _crc(f"{field}={value}")
+
+
+def parse_search(text: str) -> Dict[str, str]:
+    """Parses a search like `idTag=04A2 transactionId=1234`, fields are TERM_FIELDS, charge_point_id and message_id."""
+    terms = {}
+    for token in text.split():
+        field, separator, value = token.partition("=")
+        if not separator or not value:
+            raise ValueError(f"Expected field=value, got {token!r}")
+        if field not in TERM_FIELDS and field not in ("charge_point_id", "message_id"):
+            raise ValueError(
+                f"Unknown field {field!r}, one of: "
+                + ", ".join(TERM_FIELDS + ("charge_point_id", "message_id"))
+            )
+        terms[field] = value
+    return terms
+
+
+@dataclass
+class CaptureRecord:
+    timestamp: float
+    charge_point_id: str
+    direction: str
+    message_type: int
+    message_id: str
+    action: str
+    frame: str
+
+
+def _encode(timestamp, charge_point_id, direction, frame: Frame):
+    cp = charge_point_id.encode()
+    message_id = (frame.message_id or "").encode()
+    action = (frame.action or "").encode()
+    raw = frame.raw if isinstance(frame.raw, bytes) else frame.raw.encode()
+    body_length = len(cp) + len(message_id) + len(action) + len(raw)
+    header = _RECORD.pack(
+        body_length,
+        timestamp,
+        frame.message_type or 0,
+        DIRECTION_CODES[direction],
+        len(cp),
+        len(message_id),
+        len(action),
+    )
+    return (
+        b"".join((header, cp, message_id, action, raw)),
+        _crc(charge_point_id),
+        _crc(frame.message_id or ""),
+    )
+
+
+def _decode(buffer, offset) -> Optional[CaptureRecord]:
+    """The record at `offset`, None if it is corrupt, e.g. an index entry pointing past or into the middle of one."""
+    try:
+        (
+            body_length,
+            timestamp,
+            message_type,
+            direction,
+            cp_length,
+            id_length,
+            action_length,
+        ) = _RECORD.unpack_from(buffer, offset)
+        position = offset + _RECORD.size
+        frame_length = body_length - cp_length - id_length - action_length
+        if (
+            frame_length < 0
+            or position + body_length > len(buffer)
+            or direction not in DIRECTION_NAMES
+        ):
+            return None
+        fields = []
+        for length in (cp_length, id_length, action_length):
+            fields.append(bytes(buffer[position : position + length]).decode())
+            position += length
+        frame = bytes(buffer[position : position + frame_length]).decode()
+    except (struct.error, UnicodeDecodeError):
+        return None
+    return CaptureRecord(
+        timestamp=timestamp,
+        charge_point_id=fields[0],
+        direction=DIRECTION_NAMES[direction],
+        message_type=message_type,
+        message_id=fields[1],
+        action=fields[2],
+        frame=frame,
+    )
+
+
+def _lookup_keys(path: Path) -> List[array]:
+    index = path.with_suffix(".idx").read_bytes()
+    index = index[: len(index) - len(index) % _INDEX.size]
+    by_charge_point, by_message_id, by_term = array("Q"), array("Q"), array("Q")
+    for position, (_, _, _, cp_hash, id_hash) in enumerate(_INDEX.iter_unpack(index)):
+        by_charge_point.append(cp_hash << 32 | position)
+        by_message_id.append(id_hash << 32 | position)
+    terms_path = path.with_suffix(".trm")
+    if terms_path.exists():
+        terms = terms_path.read_bytes()
+        terms = terms[: len(terms) - len(terms) % _TERM.size]
+        by_term.extend(
+            term_hash << 32 | position
+            for term_hash, position in _TERM.iter_unpack(terms)
+        )
+    return [by_charge_point, by_message_id, by_term]
+
+
+def _seal_segment(path: Path):
+    """
+    Writes the sorted lookups of a complete segment (.srt), searching it then bisects them memory-mapped instead of
+    loading its index.
+    """
+    lookups = [array("Q", sorted(keys)) for keys in _lookup_keys(path)]
+    if not lookups[0]:
+        return
+    temporary = path.with_suffix(".tmp")
+    with open(temporary, "wb") as f:
+        f.write(_SORTED.pack(*map(len, lookups)))
+        for keys in lookups:
+            if sys.byteorder != "little":
+                keys.byteswap()
+            keys.tofile(f)
+    os.replace(temporary, path.with_suffix(".srt"))
+
+
+class CaptureWriter:
+    """
+    Appends relayed frames to segmented capture files. The relay only buffers records in memory, encoding and writing
+    happens in batches on a dedicated thread.
+    """
+
+    def __init__(
+        self,
+        directory,
+        stream: Optional[str] = None,
+        segment_size: int = 64 * 2**20,
+        max_segments: Optional[int] = None,
+        flush_interval: float = 0.2,
+        max_buffered: int = 100_000,
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.stream = stream or f"relay{os.getpid()}"
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.written = 0
+        self.dropped = 0
+        self.logger = logging.getLogger(CaptureWriter.__qualname__)
+        self._buffer = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Capture")
+        self._flusher: Optional[asyncio.Task] = None
+        self._closed = False
+        # A stream restarted with the same name, e.g. the relay of a restarted container (pid 1), continues after
+        # its last segment rather than appending to segments already indexed
+        self._seq = max(
+            (
+                int(match["seq"])
+                for match in map(_SEGMENT.match, os.listdir(self.directory))
+                if match and match["stream"] == self.stream
+            ),
+            default=-1,
+        )
+        self._data = self._index = self._terms = None
+        # Records in the current segment, the position of the next one
+        self._entries = 0
+        self._open_next_segment()
+
+    def _segment_path(self, seq, suffix):
+        return self.directory / f"{self.stream}-{seq:08d}{suffix}"
+
+    def _close_segment(self):
+        self._data.close()
+        self._index.close()
+        self._terms.close()
+        try:
+            _seal_segment(self._segment_path(self._seq, ".cap"))
+        except OSError as e:
+            # Searches still work, readers load the segment's index or seal it themselves
+            self.logger.warning(f"Sealing the capture segment failed: {e}")
+
+    def _open_next_segment(self):
+        if self._data is not None:
+            self._close_segment()
+        self._seq += 1
+        # A leftover of a segment of the same name would hide the records written now
+        self._segment_path(self._seq, ".srt").unlink(missing_ok=True)
+        self._data = open(self._segment_path(self._seq, ".cap"), "ab")
+        self._index = open(self._segment_path(self._seq, ".idx"), "ab")
+        self._terms = open(self._segment_path(self._seq, ".trm"), "ab")
+        self._entries = self._index.tell() // _INDEX.size
+        if self.max_segments is not None and self._seq >= self.max_segments:
+            for suffix in _SEGMENT_SUFFIXES:
+                self._segment_path(self._seq - self.max_segments, suffix).unlink(
+                    missing_ok=True
+                )
+
+    def append(self, timestamp: float, charge_point_id: str, direction: str, frame):
+        if self._closed:
+            # Frames still relayed while the relay shuts down
+            return
+        if len(self._buffer) >= self.max_buffered:
+            # Never apply backpressure to relaying, losing capture records is preferable
+            self.dropped += 1
+            return
+        self._buffer.append((timestamp, charge_point_id, direction, frame))
+        if self._flusher is None:
+            self._flusher = asyncio.get_running_loop().create_task(self._run())
+
+    def _write_batch(self, batch):
+        data, index, terms = [], [], []
+        offset = self._data.tell()
+        for timestamp, charge_point_id, direction, frame in batch:
+            if offset >= self.segment_size:
+                self._commit(data, index, terms)
+                data, index, terms = [], [], []
+                self._open_next_segment()
+                offset = self._data.tell()
+            record, cp_hash, id_hash = _encode(
+                timestamp, charge_point_id, direction, frame
+            )
+            data.append(record)
+            index.append(_INDEX.pack(timestamp, offset, len(record), cp_hash, id_hash))
+            # The payload is only decoded here, on the capture thread
+            position = self._entries + len(index) - 1
+            terms.extend(
+                _TERM.pack(_term_hash(field, value), position)
+                for field, value in frame_terms(frame)
+            )
+            offset += len(record)
+        self._commit(data, index, terms)
+
+    def _commit(self, data, index, terms):
+        # Data goes first, an index entry never points past the end of its data file
+        self._data.write(b"".join(data))
+        self._data.flush()
+        self._index.write(b"".join(index))
+        self._index.flush()
+        self._terms.write(b"".join(terms))
+        self._terms.flush()
+        self._entries += len(index)
+        self.written += len(index)
+
+    async def flush(self):
+        batch, self._buffer = self._buffer, []
+        if batch:
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._write_batch, batch
+            )
+
+    async def _run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        except asyncio.CancelledError:
+            await self.flush()
+            raise
+        except Exception:
+            self.logger.exception("Writing capture records failed")
+            raise
+
+    async def close(self):
+        self._closed = True
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._close_segment
+        )
+        self._executor.shutdown()
+
+    def stats(self) -> dict:
+        return {
+            "segment": str(self._segment_path(self._seq, ".cap")),
+            "buffered": len(self._buffer),
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+
+class _Lookup:
+    """
+    Record positions by hash, kept as sorted runs of `hash << 32 | position` keys which are bisected for a hash. A run
+    is merged with the runs before it as long as it is at least as large, so there are few runs to bisect.
+    """
+
+    def __init__(self, runs: Optional[List[Sequence[int]]] = None):
+        self.runs = runs or []
+
+    def extend(self, keys):
+        if not keys:
+            return
+        run = array("Q", sorted(keys))
+        while self.runs and len(self.runs[-1]) <= len(run):
+            run = array("Q", sorted(self.runs.pop() + run))
+        self.runs.append(run)
+
+    def _ranges(self, value_hash: int):
+        for run in self.runs:
+            low = bisect.bisect_left(run, value_hash << 32)
+            yield run, low, bisect.bisect_left(run, (value_hash + 1) << 32, low)
+
+    def count(self, value_hash: int) -> int:
+        return sum(high - low for _, low, high in self._ranges(value_hash))
+
+    def get(self, value_hash: int) -> Sequence[int]:
+        ranges = [
+            (run, low, high)
+            for run, low, high in self._ranges(value_hash)
+            if high > low
+        ]
+        if len(ranges) == 1:
+            return _Positions(*ranges[0])
+        # Runs are in capture order, so the positions are ascending
+        positions = []
+        for run, low, high in ranges:
+            positions.extend(key & 0xFFFFFFFF for key in run[low:high])
+        return positions
+
+    def contains(self, value_hash: int, position: int) -> bool:
+        key = value_hash << 32 | position
+        for run in self.runs:
+            i = bisect.bisect_left(run, key)
+            if i < len(run) and run[i] == key:
+                return True
+        return False
+
+
+class _Positions:
+    """The positions of a range of lookup keys, read on access, e.g. the frequent terms of a sealed segment."""
+
+    def __init__(self, run: Sequence[int], low: int, high: int):
+        self.run, self.low, self.high = run, low, high
+
+    def __len__(self):
+        return self.high - self.low
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, _ = i.indices(len(self))
+            return _Positions(self.run, self.low + start, self.low + max(start, stop))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.run[self.low + i] & 0xFFFFFFFF
+
+
+class _Column:
+    """A field of the memory-mapped index entries, read on access (e.g. to bisect timestamps)."""
+
+    def __init__(self, buffer, field: int, length: int):
+        self.buffer, self.field, self.length = buffer, field, length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self.length
+        if not 0 <= position < self.length:
+            raise IndexError(position)
+        return _INDEX.unpack_from(self.buffer, position * _INDEX.size)[self.field]
+
+
+class _Segment:
+    def __init__(self, stream: str, seq: int, path: Path, lookups: bool = True):
+        self.stream, self.seq, self.path = stream, seq, path
+        # Without lookups, only the timestamps, offsets and charge points of the records are indexed
+        self.lookups = lookups
+        self.index_path = path.with_suffix(".idx")
+        self.terms_path = path.with_suffix(".trm")
+        self.sorted_path = path.with_suffix(".srt")
+        # Complete segments are searched through their memory-mapped index and sorted lookups, see _seal_segment()
+        self.sealed = False
+        self.entries = 0
+        self.timestamps: Sequence[float] = array("d")
+        self.offsets: Sequence[int] = array("Q")
+        self.by_charge_point = _Lookup()
+        self.by_message_id = _Lookup()
+        self.by_term = _Lookup()
+        self.has_terms = False
+        self._term_entries = 0
+        self._data = None
+        self._size = 0
+        self._mapped = []
+
+    def refresh(self):
+        if self.sealed:
+            return
+        if self.sorted_path.exists() and sys.byteorder == "little":
+            self._map_sealed()
+            return
+        # Segments are append-only, only index entries added since the last refresh are loaded
+        with open(self.index_path, "rb") as f:
+            f.seek(self.entries * _INDEX.size)
+            tail = f.read()
+        tail = tail[: len(tail) - len(tail) % _INDEX.size]
+        by_charge_point, by_message_id = array("Q"), array("Q")
+        for timestamp, offset, _, cp_hash, id_hash in _INDEX.iter_unpack(tail):
+            position = self.entries
+            self.timestamps.append(timestamp)
+            self.offsets.append(offset)
+            by_charge_point.append(cp_hash << 32 | position)
+            by_message_id.append(id_hash << 32 | position)
+            self.entries += 1
+        self.by_charge_point.extend(by_charge_point)
+        if self.lookups:
+            self.by_message_id.extend(by_message_id)
+        # Captures written before the term index existed have none, they are searched by decoding every record
+        self.has_terms = self.lookups and self.terms_path.exists()
+        if self.has_terms:
+            with open(self.terms_path, "rb") as f:
+                f.seek(self._term_entries * _TERM.size)
+                tail = f.read()
+            tail = tail[: len(tail) - len(tail) % _TERM.size]
+            self.by_term.extend(
+                [
+                    term_hash << 32 | position
+                    for term_hash, position in _TERM.iter_unpack(tail)
+                ]
+            )
+            self._term_entries += len(tail) // _TERM.size
+
+    def _map_sealed(self):
+        with open(self.index_path, "rb") as f:
+            index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.sorted_path, "rb") as f:
+            lookups = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped = [index, lookups]
+        self.entries = len(index) // _INDEX.size
+        self.timestamps = _Column(index, 0, self.entries)
+        self.offsets = _Column(index, 1, self.entries)
+        runs, start = [], _SORTED.size
+        for count in _SORTED.unpack_from(lookups):
+            runs.append(memoryview(lookups)[start : start + count * 8].cast("Q"))
+            start += count * 8
+        self.by_charge_point, self.by_message_id, self.by_term = (
+            _Lookup([run]) for run in runs
+        )
+        self.has_terms = self.terms_path.exists()
+        self.sealed = True
+
+    def data(self):
+        size = self.path.stat().st_size
+        if self._data is None or size != self._size:
+            if self._data is not None:
+                self._data.close()
+            with open(self.path, "rb") as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._size = size
+        return self._data
+
+    def positions(
+        self, charge_point_id=None, message_id=None, start=None, end=None, terms=None
+    ):
+        low = bisect.bisect_left(self.timestamps, start) if start is not None else 0
+        high = (
+            bisect.bisect_right(self.timestamps, end)
+            if end is not None
+            else self.entries
+        )
+        criteria = [
+            (lookup, _crc(value))
+            for lookup, value in (
+                (self.by_message_id, message_id),
+                (self.by_charge_point, charge_point_id),
+            )
+            if value is not None
+        ]
+        if self.has_terms:
+            criteria += [
+                (self.by_term, _term_hash(field, value))
+                for field, value in (terms or {}).items()
+            ]
+        if not criteria:
+            return range(low, high)
+        # Only the shortest posting list is read, the others are bisected for its positions, so a selective term
+        # answers quickly
+        criteria.sort(key=lambda criterion: criterion[0].count(criterion[1]))
+        lookup, value_hash = criteria[0]
+        shortest = lookup.get(value_hash)
+        candidates = shortest[
+            bisect.bisect_left(shortest, low) : bisect.bisect_left(shortest, high)
+        ]
+        for lookup, value_hash in criteria[1:]:
+            candidates = [
+                position
+                for position in candidates
+                if lookup.contains(value_hash, position)
+            ]
+        return candidates
+
+    def read(self, position) -> Optional[CaptureRecord]:
+        return _decode(self.data(), self.offsets[position])
+
+    def close(self):
+        for lookup in (self.by_charge_point, self.by_message_id, self.by_term):
+            for run in lookup.runs:
+                if isinstance(run, memoryview):
+                    run.release()
+        for buffer in self._mapped + [self._data]:
+            if buffer is not None:
+                buffer.close()
+
+
+class CaptureReader:
+    """Memory-mapped, index backed access to the capture files of a directory."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.logger = logging.getLogger(CaptureReader.__qualname__)
+        # Records skipped because they can't be decoded
+        self.corrupt = 0
+        self._segments: Dict[Path, _Segment] = {}
+
+    def segments(self) -> List[_Segment]:
+        for path in [path for path in self._segments if not path.exists()]:
+            # Removed by the writer's retention
+            self._segments.pop(path).close()
+        for path in self.directory.glob("*.cap"):
+            match = _SEGMENT.match(path.name)
+            if match and path not in self._segments:
+                self._segments[path] = _Segment(
+                    match["stream"], int(match["seq"]), path
+                )
+        segments = sorted(
+            self._segments.values(), key=lambda segment: (segment.stream, segment.seq)
+        )
+        for segment, following in zip(segments, segments[1:] + [None]):
+            if not segment.index_path.exists():
+                continue
+            if (
+                not segment.sealed
+                and following is not None
+                and following.stream == segment.stream
+                and not segment.sorted_path.exists()
+            ):
+                # Complete but not sealed by its writer, e.g. captured by an older version or a relay that crashed
+                try:
+                    _seal_segment(segment.path)
+                except OSError as e:
+                    self.logger.warning(f"Sealing {segment.path} failed: {e}")
+            segment.refresh()
+        return [segment for segment in segments if segment.entries]
+
+    def _matching(
+        self,
+        segment: _Segment,
+        charge_point_id=None,
+        message_id=None,
+        start=None,
+        end=None,
+        terms=None,
+        newest_first=False,
+    ) -> Iterator[CaptureRecord]:
+        terms = dict(terms or {})
+        payload_terms = {
+            (field, str(value)) for field, value in terms.items() if field != "action"
+        }
+        action = terms.get("action")
+        if start is not None and segment.timestamps[-1] < start:
+            return
+        if end is not None and segment.timestamps[0] > end:
+            return
+        positions = segment.positions(charge_point_id, message_id, start, end, terms)
+        for position in reversed(positions) if newest_first else positions:
+            record = segment.read(position)
+            if record is None:
+                self._skip_corrupt(segment)
+                continue
+            # The index holds hashes, so collisions are filtered out on the decoded record
+            if (
+                charge_point_id is not None
+                and record.charge_point_id != charge_point_id
+            ):
+                continue
+            if message_id is not None and record.message_id != message_id:
+                continue
+            if action is not None and record.action != action:
+                continue
+            if payload_terms:
+                try:
+                    frame = Frame.parse(record.frame)
+                except FrameError:
+                    self._skip_corrupt(segment)
+                    continue
+                if not payload_terms <= frame_terms(frame):
+                    continue
+            yield record
+
+    def _skip_corrupt(self, segment: _Segment):
+        self.corrupt += 1
+        if self.corrupt == 1:
+            self.logger.warning(
+                f"Skipping corrupt records, the first in {segment.path}"
+            )
+
+    def query(
+        self,
+        charge_point_id: Optional[str] = None,
+        message_id: Optional[str] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        action: Optional[str] = None,
+        terms: Optional[Dict[str, str]] = None,
+        newest_first: bool = False,
+    ) -> Iterator[CaptureRecord]:
+        """Records matching all the given criteria, `terms` are payload fields (see TERM_FIELDS) and their values."""
+        terms = dict(terms or {})
+        if action is not None:
+            terms["action"] = action
+
+        streams: Dict[str, List[_Segment]] = {}
+        for segment in self.segments():
+            streams.setdefault(segment.stream, []).append(segment)
+        # Each stream (one per relay process) is ordered in time, merging them keeps the whole capture ordered
+        iterators = [
+            (
+                record
+                for segment in (reversed(segments) if newest_first else segments)
+                for record in self._matching(
+                    segment,
+                    charge_point_id,
+                    message_id,
+                    start,
+                    end,
+                    terms,
+                    newest_first,
+                )
+            )
+            for segments in streams.values()
+        ]
+        return heapq.merge(
+            *iterators, key=lambda record: record.timestamp, reverse=newest_first
+        )
+
+    def _scan_stream(self, stream: str, paths: List[Tuple[int, Path]], **criteria):
+        for seq, path in sorted(paths):
+            segment = _Segment(stream, seq, path, lookups=False)
+            try:
+                segment.refresh()
+            except FileNotFoundError:
+                # Not indexed yet or removed by the writer's retention meanwhile
+                continue
+            try:
+                if segment.entries:
+                    yield from self._matching(segment, **criteria)
+            finally:
+                segment.close()
+
+    def scan(
+        self,
+        charge_point_id: Optional[str] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        action: Optional[str] = None,
+    ) -> Iterator[CaptureRecord]:
+        """
+        Records matching the criteria in capture order, like query(), for reading through large captures: only the
+        index of the current segment of every stream is loaded, without the message id and term lookups, so memory
+        doesn't grow with the capture.
+        """
+        streams: Dict[str, List[Tuple[int, Path]]] = {}
+        for path in self.directory.glob("*.cap"):
+            match = _SEGMENT.match(path.name)
+            if match:
+                streams.setdefault(match["stream"], []).append(
+                    (int(match["seq"]), path)
+                )
+        terms = {"action": action} if action is not None else None
+        return heapq.merge(
+            *(
+                self._scan_stream(
+                    stream,
+                    paths,
+                    charge_point_id=charge_point_id,
+                    start=start,
+                    end=end,
+                    terms=terms,
+                )
+                for stream, paths in streams.items()
+            ),
+            key=lambda record: record.timestamp,
+        )
+
+    def search(self, text: str, limit: int = 100) -> List[CaptureRecord]:
+        """The newest records matching a search, see parse_search()."""
+        terms = parse_search(text)
+        records = self.query(
+            charge_point_id=terms.pop("charge_point_id", None),
+            message_id=terms.pop("message_id", None),
+            terms=terms,
+            newest_first=True,
+        )
+        return list(itertools.islice(records, limit))
+
+    def count(self) -> int:
+        return sum(segment.entries for segment in self.segments())
+
+    def close(self):
+        for segment in self._segments.values():
+            segment.close()
+        self._segments.clear()
@@ -0,0 +1,160 @@
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from websockets.extensions.permessage_deflate import (
+    ClientPerMessageDeflateFactory,
+    PerMessageDeflate,
+    ServerPerMessageDeflateFactory,
+)
+
+# The relay's legs: towards the ChargePoints (the relay is the server) and towards the CSMS (the relay is the client)
+LEGS = ("cp", "csms")
+
+
+@dataclass
+class CompressionConfig:
+    """permessage-deflate settings of a leg, the defaults are those of websockets."""
+
+    enabled: bool = True
+    # LZ77 window of both sides in bits (8-15), None for websockets' default
+    window_bits: Optional[int] = None
+    # zlib memory level (1-9) and compression level (0-9, None for zlib's default) of the relay's side
+    memory_level: int = 5
+    level: Optional[int] = None
+    # Reset the compression context after every message, on both sides, saving memory per connection
+    no_context_takeover: bool = False
+
+    @classmethod
+    def parse(cls, text: str) -> "CompressionConfig":
+        """Parses `off`, `on` or comma separated settings, e.g. `window_bits=10,level=1,no_context_takeover`."""
+        if text in ("off", "on"):
+            return cls(enabled=text == "on")
+        config = cls()
+        for setting in text.split(","):
+            name, _, value = setting.partition("=")
+            if name == "no_context_takeover" and not value:
+                config.no_context_takeover = True
+            elif name in ("window_bits", "memory_level", "level") and value:
+                setattr(config, name, int(value))
+            else:
+                raise ValueError(f"Unknown compression setting: {setting}")
+        if config.window_bits is not None and not 8 <= config.window_bits <= 15:
+            raise ValueError("window_bits must be between 8 and 15")
+        if not 1 <= config.memory_level <= 9:
+            raise ValueError("memory_level must be between 1 and 9")
+        if config.level is not None and not 0 <= config.level <= 9:
+            raise ValueError("level must be between 0 and 9")
+        return config
+
+    def _compress_settings(self) -> dict:
+        settings = {"memLevel": self.memory_level}
+        if self.level is not None:
+            settings["level"] = self.level
+        return settings
+
+    def server_options(self) -> dict:
+        """Options of websockets.serve()."""
+        if not self.enabled:
+            return {"compression": None}
+        return {
+            "compression": None,
+            "extensions": [
+                ServerPerMessageDeflateFactory(
+                    server_no_context_takeover=self.no_context_takeover,
+                    client_no_context_takeover=self.no_context_takeover,
+                    server_max_window_bits=self.window_bits or 12,
+                    client_max_window_bits=self.window_bits or 12,
+                    compress_settings=self._compress_settings(),
+                )
+            ],
+        }
+
+    def client_options(self) -> dict:
+        """Options of websockets.connect()."""
+        if not self.enabled:
+            return {"compression": None}
+        return {
+            "compression": None,
+            "extensions": [
+                ClientPerMessageDeflateFactory(
+                    server_no_context_takeover=self.no_context_takeover,
+                    client_no_context_takeover=self.no_context_takeover,
+                    server_max_window_bits=self.window_bits,
+                    client_max_window_bits=self.window_bits or True,
+                    compress_settings=self._compress_settings(),
+                )
+            ],
+        }
+
+
+class CompressionStats:
+    """Bytes of the frames of a connection as sent over the wire and as (de)compressed, and the time spent on it."""
+
+    __slots__ = ("wire_in", "payload_in", "wire_out", "payload_out", "seconds")
+
+    def __init__(self):
+        self.wire_in = self.payload_in = self.wire_out = self.payload_out = 0
+        self.seconds = 0.0
+
+    def add(self, other: "CompressionStats"):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    @property
+    def ratio(self) -> Optional[float]:
+        """Wire bytes per payload byte, both directions."""
+        payload = self.payload_in + self.payload_out
+        return (self.wire_in + self.wire_out) / payload if payload else None
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def format(self) -> str:
+        ratio = self.ratio
+        return (
+            f"{self.payload_in + self.payload_out} bytes as "
+            f"{self.wire_in + self.wire_out} on the wire"
+            + (f" ({ratio:.0%})" if ratio is not None else "")
+            + f", {self.seconds * 1000:.1f} ms"
+        )
+
+
+class MeteredDeflate:
+    """Wraps the negotiated permessage-deflate extension of a connection, counting bytes and time into its stats."""
+
+    def __init__(self, extension: PerMessageDeflate, stats: CompressionStats):
+        self.extension = extension
+        self.stats = stats
+        self.name = extension.name
+
+    def decode(self, frame, *, max_size=None):
+        started = time.perf_counter()
+        decoded = self.extension.decode(frame, max_size=max_size)
+        stats = self.stats
+        stats.seconds += time.perf_counter() - started
+        stats.wire_in += len(frame.data)
+        stats.payload_in += len(decoded.data)
+        return decoded
+
+    def encode(self, frame):
+        started = time.perf_counter()
+        encoded = self.extension.encode(frame)
+        stats = self.stats
+        stats.seconds += time.perf_counter() - started
+        stats.payload_out += len(frame.data)
+        stats.wire_out += len(encoded.data)
+        return encoded
+
+    def __getattr__(self, name):
+        return getattr(self.extension, name)
+
+
+def meter(ws) -> Optional[CompressionStats]:
+    """Starts counting the compression of a connection, None if it didn't negotiate permessage-deflate."""
+    for i, extension in enumerate(ws.extensions):
+        if isinstance(extension, PerMessageDeflate):
+            stats = CompressionStats()
+            ws.extensions[i] = MeteredDeflate(extension, stats)
+            return stats
+    return None
@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+from typing import Dict, Mapping, Optional
+
+ENV_PREFIX = "OCPP_RELAY_"
+CONFIG_ENV = ENV_PREFIX + "CONFIG"
+
+# Settings of the relay that can be given in a config file or as OCPP_RELAY_<NAME> environment variables, named like
+# its command line options (e.g. `capture_dir` for --capture-dir), and their types. Lists are comma separated in the
+# environment, booleans are 1/0, true/false, yes/no or on/off.
+SETTINGS = {
+    "host": str,
+    "port": int,
+    "workers": int,
+    "csms_url": str,
+    "csms_id": str,
+    "csms_password": str,
+    "csms_cafile": str,
+    "capture_dir": str,
+    "capture_max_segments": int,
+    "metrics": bool,
+    "link_high_water": int,
+    "link_policy": list,
+    "link_stall_timeout": float,
+    "cp_compression": str,
+    "csms_compression": str,
+    "validate": bool,
+    "validate_sample": list,
+    "validation_workers": int,
+    "rules": str,
+    "meter_values": bool,
+}
+_TRUE, _FALSE = {"1", "true", "yes", "on"}, {"0", "false", "no", "off"}
+_TYPE_NAMES = {
+    str: "a string",
+    int: "an integer",
+    float: "a number",
+    bool: "a boolean",
+    list: "a list",
+}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class ListSetting(argparse.Action):
+    """
+    Appends the values of a repeatable option, the list of the config file, environment or default is replaced by
+    the first one given on the command line rather than appended to.
+    """
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        items = getattr(namespace, self.dest, None)
+        if items is None or items is self.default:
+            items = []
+        setattr(namespace, self.dest, [*items, values])
+
+
+def _convert(name: str, value):
+    type_ = SETTINGS[name]
+    if not isinstance(value, str):
+        if type_ is float and isinstance(value, int):
+            return float(value)
+        if not isinstance(value, type_) or (type_ is int and isinstance(value, bool)):
+            raise ConfigError(f"{name} must be {_TYPE_NAMES[type_]}, got {value!r}")
+        return value
+    if type_ is bool:
+        if value.lower() not in _TRUE | _FALSE:
+            raise ConfigError(f"{name} must be {_TYPE_NAMES[bool]}, got {value!r}")
+        return value.lower() in _TRUE
+    if type_ is list:
+        return [item.strip() for item in value.split(",") if item.strip()]
+    try:
+        return type_(value)
+    except ValueError:
+        raise ConfigError(f"{name} must be {_TYPE_NAMES[type_]}, got {value!r}")
+
+
+def load_config(
+    path: Optional[str] = None, environ: Mapping[str, str] = os.environ
+) -> Dict[str, object]:
+    """
+    The settings of a JSON config file (`path`, or the file named by OCPP_RELAY_CONFIG), overridden by the
+    OCPP_RELAY_* environment variables. Only settings that are given are returned, keyed by their name.
+    """
+    settings = {}
+    path = path or environ.get(CONFIG_ENV)
+    if path:
+        try:
+            with open(path) as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ConfigError(f"Cannot read the config file {path}: {e}")
+        if not isinstance(config, dict):
+            raise ConfigError(f"The config file {path} must hold a JSON object")
+        for name, value in config.items():
+            if name not in SETTINGS:
+                raise ConfigError(f"Unknown setting in {path}: {name}")
+            settings[name] = _convert(name, value)
+    for name in SETTINGS:
+        value = environ.get(ENV_PREFIX + name.upper())
+        if value is not None:
+            settings[name] = _convert(name, value)
+    return settings
+
+
+def csms_info(settings: Mapping[str, object]) -> Optional[dict]:
+    """The CSMS to relay to as configured, in the form the UI hands it to the relay, None without a csms_url."""
+    if not settings.get("csms_url"):
+        return None
+    return {
+        "url": settings["csms_url"].rstrip("/"),
+        "id": settings.get("csms_id") or "",
+        "pass": settings.get("csms_password") or "",
+    }
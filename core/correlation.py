@@ -0,0 +1,182 @@
+import collections
+import json
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Union
+
+from core.frames import CALLRESULT, Frame
+from core.sessions import DIRECTIONS, OPPOSITE_DIRECTIONS
+
+# Outcomes of an exchange that never got its response
+TIMEOUT, CLOSED = "timeout", "closed"
+
+
+@dataclass
+class Exchange:
+    """A CALL and its CALLRESULT/CALLERROR as relayed, direction is the one of the CALL."""
+
+    charge_point_id: str
+    direction: str
+    message_id: str
+    action: str
+    request: Union[str, bytes]
+    requested_at: float
+    injected: bool = False
+    response: Optional[Union[str, bytes]] = None
+    # CALLRESULT, CALLERROR, timeout or closed
+    outcome: str = TIMEOUT
+    round_trip: Optional[float] = None
+
+    @property
+    def answered(self) -> bool:
+        return self.response is not None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def to_event(self) -> str:
+        # Both frames are embedded as they were relayed, only the small header is serialized here
+        header = json.dumps(
+            {
+                "charge_point_id": self.charge_point_id,
+                "direction": self.direction,
+                "message_id": self.message_id,
+                "action": self.action,
+                "requested_at": self.requested_at,
+                "injected": self.injected,
+                "outcome": self.outcome,
+                "round_trip": self.round_trip,
+            }
+        )
+        request, response = (
+            frame.decode() if isinstance(frame, bytes) else frame
+            for frame in (self.request, self.response or "null")
+        )
+        return (
+            f'{{"event": "Exchange", "payload": {header[:-1]}, '
+            f'"request": {request}, "response": {response}}}}}'
+        )
+
+
+class _PendingCall:
+    __slots__ = ("action", "request", "sent_at", "requested_at", "injected")
+
+    def __init__(self, action, request, sent_at, requested_at, injected):
+        self.action = action
+        self.request = request
+        self.sent_at = sent_at
+        self.requested_at = requested_at
+        self.injected = injected
+
+
+class CallCorrelator:
+    """
+    Pending CALLs of one ChargePoint per direction, matched with their CALLRESULT/CALLERROR into exchanges.
+    Calls that are not answered within `timeout` seconds complete as timed out.
+    """
+
+    def __init__(
+        self,
+        charge_point_id: str,
+        timeout: float = 60.0,
+        max_pending: int = 1024,
+        clock=time.perf_counter,
+    ):
+        self.charge_point_id = charge_point_id
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.clock = clock
+        # direction -> message id -> pending call, in the order the calls were relayed and so in deadline order
+        self._pending: Dict[str, "collections.OrderedDict[str, _PendingCall]"] = {
+            direction: collections.OrderedDict() for direction in DIRECTIONS
+        }
+
+    def _exchange(self, direction, message_id, call: _PendingCall) -> Exchange:
+        return Exchange(
+            charge_point_id=self.charge_point_id,
+            direction=direction,
+            message_id=message_id,
+            action=call.action,
+            request=call.request,
+            requested_at=call.requested_at,
+            injected=call.injected,
+        )
+
+    def request(
+        self,
+        direction: str,
+        frame: Frame,
+        at: Optional[float] = None,
+        injected: bool = False,
+        requested_at: Optional[float] = None,
+    ) -> List[Exchange]:
+        """Records a relayed CALL, returns the exchanges that timed out meanwhile. `requested_at` defaults to now."""
+        at = self.clock() if at is None else at
+        expired = self.expire(at)
+        pending = self._pending[direction]
+        if len(pending) >= self.max_pending:
+            message_id, call = pending.popitem(last=False)
+            expired.append(self._exchange(direction, message_id, call))
+        pending.pop(frame.message_id, None)
+        pending[frame.message_id] = _PendingCall(
+            frame.action,
+            frame.raw,
+            at,
+            time.time() if requested_at is None else requested_at,
+            injected,
+        )
+        return expired
+
+    def response(
+        self, direction: str, frame: Frame, at: Optional[float] = None
+    ) -> Optional[Exchange]:
+        """Matches a relayed CALLRESULT/CALLERROR, `direction` being the one of the response."""
+        at = self.clock() if at is None else at
+        call_direction = OPPOSITE_DIRECTIONS[direction]
+        call = self._pending[call_direction].pop(frame.message_id, None)
+        if call is None:
+            # Never seen (e.g. relayed before a reconnect) or answered after its timeout
+            return None
+        exchange = self._exchange(call_direction, frame.message_id, call)
+        exchange.response = frame.raw
+        exchange.outcome = (
+            "CALLRESULT" if frame.message_type == CALLRESULT else "CALLERROR"
+        )
+        exchange.round_trip = at - call.sent_at
+        return exchange
+
+    def discard(self, direction: str, message_id: str) -> bool:
+        """Forgets an injected CALL that couldn't be sent, it doesn't complete as an exchange."""
+        pending = self._pending[direction]
+        call = pending.get(message_id)
+        if call is None or not call.injected:
+            return False
+        del pending[message_id]
+        return True
+
+    def expire(self, now: Optional[float] = None) -> List[Exchange]:
+        now = self.clock() if now is None else now
+        expired = []
+        for direction, pending in self._pending.items():
+            while pending:
+                message_id, call = next(iter(pending.items()))
+                if call.sent_at + self.timeout > now:
+                    break
+                del pending[message_id]
+                expired.append(self._exchange(direction, message_id, call))
+        return expired
+
+    def close(self) -> List[Exchange]:
+        """Ends all pending calls, as the connection they were sent on is gone."""
+        closed = []
+        for direction, pending in self._pending.items():
+            for message_id, call in pending.items():
+                exchange = self._exchange(direction, message_id, call)
+                exchange.outcome = CLOSED
+                closed.append(exchange)
+            pending.clear()
+        return closed
+
+    @property
+    def pending(self) -> int:
+        return sum(len(pending) for pending in self._pending.values())
@@ -0,0 +1,204 @@
+import bisect
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Event attribute per indexed field
+FIELDS = {
+    "action": "message_name",
+    "charge_point_id": "charge_point_id",
+    "direction": "direction",
+    "injected": "injected",
+}
+
+
+@dataclass
+class EventFilter:
+    action: Optional[str] = None
+    charge_point_id: Optional[str] = None
+    direction: Optional[str] = None
+    injected_only: bool = False
+    # Unix timestamps, both inclusive
+    since: Optional[float] = None
+    until: Optional[float] = None
+
+    def terms(self) -> List[Tuple[str, object]]:
+        terms = [
+            (field, getattr(self, field))
+            for field in ("action", "charge_point_id", "direction")
+            if getattr(self, field) is not None
+        ]
+        if self.injected_only:
+            terms.append(("injected", True))
+        return terms
+
+    def matches(self, event) -> bool:
+        return all(
+            getattr(event, FIELDS[field]) == value for field, value in self.terms()
+        ) and (
+            (self.since is None or event.timestamp >= self.since)
+            and (self.until is None or event.timestamp <= self.until)
+        )
+
+
+@dataclass
+class EventPage:
+    events: List[Tuple[str, object]]
+    # Pass as `before` for the next (older) page, None on the last page
+    next_cursor: Optional[int]
+    # Upper bound of the matching events, exact without filters
+    total: int
+
+
+class EventIndex:
+    """
+    Events by arrival sequence, with posting lists of sequences per indexed field value. Events are evicted oldest
+    first, so the live sequences are always a contiguous range and posting lists only ever need their prefix dropped.
+    A page is answered from the shortest posting list of the filter, newest first, so its cost doesn't depend on
+    how many events are kept.
+    """
+
+    def __init__(self):
+        self._base = 0
+        self._first = 0
+        # sequence - base -> event id, and the running maximum of the timestamps for time range lookups
+        self._ids: List[str] = []
+        self._max_timestamps: List[float] = []
+        self._sequences: Dict[str, int] = {}
+        self._events: Dict[str, object] = {}
+        # field -> value -> ascending sequences (an updated event may also be listed under its previous value)
+        self._postings: Dict[str, Dict[object, List[int]]] = {
+            field: {} for field in FIELDS
+        }
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def _post(self, field, value, sequence):
+        postings = self._postings[field].setdefault(value, [])
+        if not postings or postings[-1] < sequence:
+            postings.append(sequence)
+            return
+        position = bisect.bisect_left(postings, sequence)
+        if position == len(postings) or postings[position] != sequence:
+            postings.insert(position, sequence)
+
+    def add(self, event_id: str, event):
+        """Indexes a new event, or re-indexes an updated one keeping its position."""
+        sequence = self._sequences.get(event_id)
+        if sequence is None:
+            sequence = self._sequences[event_id] = self._base + len(self._ids)
+            self._ids.append(event_id)
+            previous = self._max_timestamps[-1] if self._max_timestamps else 0
+            self._max_timestamps.append(max(previous, event.timestamp))
+            previous_event = None
+        else:
+            previous_event = self._events[event_id]
+        self._events[event_id] = event
+        for field, attribute in FIELDS.items():
+            value = getattr(event, attribute)
+            if previous_event is None or getattr(previous_event, attribute) != value:
+                self._post(field, value, sequence)
+
+    def evict(self, event_id: str):
+        """Drops the oldest event."""
+        sequence = self._sequences.pop(event_id)
+        del self._events[event_id]
+        self._first = sequence + 1
+        # Compacted once half of the kept sequences are dead, so amortized O(1) per event
+        if self._first - self._base > max(len(self._events), 1024):
+            self._compact()
+
+    def _compact(self):
+        dead = self._first - self._base
+        del self._ids[:dead]
+        del self._max_timestamps[:dead]
+        for values in self._postings.values():
+            for value in list(values):
+                postings = values[value]
+                del postings[: bisect.bisect_left(postings, self._first)]
+                if not postings:
+                    del values[value]
+        self._base = self._first
+
+    def values(self, field: str) -> List:
+        """The values of a field that live events have, e.g. for filter choices."""
+        first = self._first
+        return sorted(
+            (
+                value
+                for value, postings in self._postings[field].items()
+                if postings[-1] >= first
+            ),
+            key=str,
+        )
+
+    def _bounds(self, event_filter: EventFilter) -> Tuple[int, int]:
+        """Sequence range [low, high) that may hold events of the filter's time range."""
+        low, high = self._first, self._base + len(self._ids)
+        # Timestamps are those of arrival, up to a few out of order ones, hence the running maximum
+        if event_filter.since is not None:
+            low = max(
+                low,
+                self._base
+                + bisect.bisect_left(self._max_timestamps, event_filter.since),
+            )
+        if event_filter.until is not None:
+            high = min(
+                high,
+                self._base
+                + bisect.bisect_right(self._max_timestamps, event_filter.until),
+            )
+        return low, high
+
+    def _candidates(self, event_filter: EventFilter, low, high, before):
+        """Sequences that may match, newest first, and how many there are at most."""
+        high = high if before is None else min(high, before)
+        postings = [
+            self._postings[field].get(value, [])
+            for field, value in event_filter.terms()
+        ]
+        if not postings:
+            return (
+                (
+                    self._ids[sequence - self._base]
+                    for sequence in range(high - 1, low - 1, -1)
+                ),
+                max(high - low, 0),
+            )
+        shortest = min(postings, key=len)
+        start = bisect.bisect_left(shortest, low)
+        end = bisect.bisect_left(shortest, high)
+        return (
+            (
+                self._ids[shortest[i] - self._base]
+                for i in range(end - 1, start - 1, -1)
+            ),
+            end - start,
+        )
+
+    def _newest_first(
+        self, event_filter: EventFilter, before
+    ) -> Iterator[Tuple[int, str, object]]:
+        low, high = self._bounds(event_filter)
+        candidates, _ = self._candidates(event_filter, low, high, before)
+        for event_id in candidates:
+            event = self._events.get(event_id)
+            if event is not None and event_filter.matches(event):
+                yield self._sequences[event_id], event_id, event
+
+    def page(
+        self,
+        event_filter: Optional[EventFilter] = None,
+        before: Optional[int] = None,
+        limit: int = 50,
+    ) -> EventPage:
+        event_filter = event_filter or EventFilter()
+        low, high = self._bounds(event_filter)
+        _, total = self._candidates(event_filter, low, high, None)
+        events, sequences = [], []
+        for sequence, event_id, event in self._newest_first(event_filter, before):
+            if len(events) == limit:
+                return EventPage(events, next_cursor=sequences[-1], total=total)
+            events.append((event_id, event))
+            sequences.append(sequence)
+        return EventPage(events, next_cursor=None, total=total)
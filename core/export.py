@@ -0,0 +1,307 @@
+import argparse
+import csv
+import io
+import json
+import math
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional
+
+from core.capture import CaptureReader, CaptureRecord
+from core.correlation import CallCorrelator, Exchange
+from core.frames import CALL, Frame
+
+FORMATS = ("jsonl", "csv", "parquet")
+MIME_TYPES = {
+    "jsonl": "application/jsonl",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+# Rows written at once, a Parquet row group each
+CHUNK_SIZE = 65_536
+CSV_COLUMNS = (
+    "requested_at",
+    "charge_point_id",
+    "direction",
+    "action",
+    "message_id",
+    "outcome",
+    "latency_ms",
+    "error_code",
+    "request",
+    "response",
+)
+
+
+@dataclass
+class ExportFilter:
+    charge_point_id: Optional[str] = None
+    action: Optional[str] = None
+    # Unix timestamps, both inclusive
+    start: Optional[float] = None
+    end: Optional[float] = None
+
+
+def parse_time(text: str) -> float:
+    """An ISO 8601 time as a unix timestamp, UTC unless it has an offset."""
+    moment = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def _iso(timestamp: float) -> str:
+    return (
+        datetime.fromtimestamp(timestamp, timezone.utc)
+        .isoformat(timespec="milliseconds")
+        .replace("+00:00", "Z")
+    )
+
+
+def export_frames(
+    reader: CaptureReader, export_filter: ExportFilter
+) -> Iterator[CaptureRecord]:
+    """The captured frames matching the filter, in capture order."""
+    return reader.scan(
+        export_filter.charge_point_id,
+        export_filter.start,
+        export_filter.end,
+        export_filter.action,
+    )
+
+
+def export_exchanges(
+    reader: CaptureReader, export_filter: ExportFilter, timeout: float = 60.0
+) -> Iterator[Exchange]:
+    """
+    The captured CALLs matching the filter with their CALLRESULT/CALLERROR, in the order they complete. Responses are
+    looked for up to `timeout` seconds after the end of the range, calls without one complete as timed out.
+    """
+    end = export_filter.end
+    correlators: Dict[str, CallCorrelator] = {}
+    for record in reader.scan(
+        export_filter.charge_point_id,
+        export_filter.start,
+        end + timeout if end is not None else None,
+    ):
+        calls = correlators.get(record.charge_point_id)
+        if calls is None:
+            calls = correlators[record.charge_point_id] = CallCorrelator(
+                record.charge_point_id, timeout=timeout
+            )
+        if record.message_type == CALL:
+            if (end is not None and record.timestamp > end) or (
+                export_filter.action is not None
+                and record.action != export_filter.action
+            ):
+                continue
+            yield from calls.request(
+                record.direction,
+                Frame.parse(record.frame),
+                at=record.timestamp,
+                requested_at=record.timestamp,
+            )
+        else:
+            exchange = calls.response(
+                record.direction, Frame.parse(record.frame), at=record.timestamp
+            )
+            if exchange is not None:
+                yield exchange
+    for calls in correlators.values():
+        yield from calls.expire(math.inf)
+
+
+def write_jsonl(
+    records: Iterable[CaptureRecord], out: BinaryIO, chunk_size: int = CHUNK_SIZE
+) -> int:
+    """One JSON object per captured frame, the frame as it was relayed in `frame`."""
+    count, lines = 0, []
+    for record in records:
+        lines.append(
+            json.dumps(
+                {
+                    "timestamp": record.timestamp,
+                    "charge_point_id": record.charge_point_id,
+                    "direction": record.direction,
+                    "message_type": record.message_type,
+                    "message_id": record.message_id,
+                    "action": record.action or None,
+                    "frame": record.frame,
+                }
+            )
+        )
+        if len(lines) == chunk_size:
+            out.write(("\n".join(lines) + "\n").encode())
+            count += len(lines)
+            lines = []
+    if lines:
+        out.write(("\n".join(lines) + "\n").encode())
+        count += len(lines)
+    return count
+
+
+def _error_code(exchange: Exchange) -> str:
+    if exchange.outcome != "CALLERROR":
+        return ""
+    try:
+        return json.loads(exchange.response)[2]
+    except (ValueError, IndexError, TypeError):
+        return ""
+
+
+def write_csv(
+    exchanges: Iterable[Exchange], out: BinaryIO, chunk_size: int = CHUNK_SIZE
+) -> int:
+    """One row per exchange with its outcome and latency, the frames as relayed in the request/response columns."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    count = 0
+    for exchange in exchanges:
+        writer.writerow(
+            (
+                _iso(exchange.requested_at),
+                exchange.charge_point_id,
+                exchange.direction,
+                exchange.action,
+                exchange.message_id,
+                exchange.outcome,
+                (
+                    f"{exchange.round_trip * 1000:.3f}"
+                    if exchange.round_trip is not None
+                    else ""
+                ),
+                _error_code(exchange),
+                exchange.request,
+                exchange.response or "",
+            )
+        )
+        count += 1
+        if count % chunk_size == 0:
+            out.write(buffer.getvalue().encode())
+            buffer.seek(0)
+            buffer.truncate()
+    out.write(buffer.getvalue().encode())
+    return count
+
+
+def write_parquet(
+    records: Iterable[CaptureRecord], out: BinaryIO, chunk_size: int = CHUNK_SIZE
+) -> int:
+    """The captured frames as columns, a row group per chunk."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError(
+            "Exporting Parquet needs pyarrow, pip install pyarrow or poetry install --extras parquet"
+        )
+
+    schema = pa.schema(
+        [
+            ("timestamp", pa.timestamp("us", tz="UTC")),
+            ("charge_point_id", pa.string()),
+            ("direction", pa.string()),
+            ("message_type", pa.int8()),
+            ("message_id", pa.string()),
+            ("action", pa.string()),
+            ("frame", pa.string()),
+        ]
+    )
+    columns = {name: [] for name in schema.names}
+    count = 0
+    with pq.ParquetWriter(out, schema, compression="zstd") as writer:
+
+        def write_chunk():
+            writer.write_table(pa.table(columns, schema=schema))
+            for values in columns.values():
+                values.clear()
+
+        for record in records:
+            columns["timestamp"].append(int(record.timestamp * 1_000_000))
+            columns["charge_point_id"].append(record.charge_point_id)
+            columns["direction"].append(record.direction)
+            columns["message_type"].append(record.message_type)
+            columns["message_id"].append(record.message_id)
+            columns["action"].append(record.action or None)
+            columns["frame"].append(record.frame)
+            count += 1
+            if count % chunk_size == 0:
+                write_chunk()
+        if count % chunk_size or not count:
+            write_chunk()
+    return count
+
+
+def export(
+    reader: CaptureReader,
+    export_filter: ExportFilter,
+    format: str,
+    out: BinaryIO,
+    chunk_size: int = CHUNK_SIZE,
+    timeout: float = 60.0,
+) -> int:
+    """Writes an export of the capture to `out`, returns the number of rows: frames, or exchanges for CSV."""
+    if format == "jsonl":
+        return write_jsonl(export_frames(reader, export_filter), out, chunk_size)
+    elif format == "csv":
+        return write_csv(
+            export_exchanges(reader, export_filter, timeout), out, chunk_size
+        )
+    elif format == "parquet":
+        return write_parquet(export_frames(reader, export_filter), out, chunk_size)
+    raise ValueError(f"Unknown export format: {format}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export captured traffic as JSONL or Parquet (frames) or CSV (exchanges)"
+    )
+    parser.add_argument("--capture-dir", required=True, help="Relay capture directory")
+    parser.add_argument("--format", choices=FORMATS, default="jsonl")
+    parser.add_argument(
+        "--output", "-o", default="-", help="File to write, stdout by default"
+    )
+    parser.add_argument("--charge-point-id", help="Only export this ChargePoint")
+    parser.add_argument("--action", help="Only export this action")
+    parser.add_argument("--start", help="ISO 8601 time to export from, UTC by default")
+    parser.add_argument("--end", help="ISO 8601 time to export until, UTC by default")
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60.0,
+        help="Seconds after which a CALL without a response is exported as timed out (CSV)",
+    )
+    args = parser.parse_args()
+
+    try:
+        export_filter = ExportFilter(
+            charge_point_id=args.charge_point_id,
+            action=args.action,
+            start=parse_time(args.start) if args.start else None,
+            end=parse_time(args.end) if args.end else None,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    reader = CaptureReader(args.capture_dir)
+    started = time.perf_counter()
+    if args.output == "-":
+        count = export(
+            reader, export_filter, args.format, sys.stdout.buffer, timeout=args.timeout
+        )
+    else:
+        with open(args.output, "wb") as out:
+            count = export(
+                reader, export_filter, args.format, out, timeout=args.timeout
+            )
+    rows = "exchanges" if args.format == "csv" else "frames"
+    print(
+        f"Exported {count} {rows} in {time.perf_counter() - started:.1f} s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import json
+import re
+from typing import Optional, Union
+
+CALL, CALLRESULT, CALLERROR = 2, 3, 4
+
+# Matches only the head of an OCPP-J frame, e.g. `[2, "<id>", "<action>", ...` or `[3, "<id>", ...`.
+# The payload is never looked at, so the cost is independent of the frame size.
+_HEADER = re.compile(
+    r'\s*\[\s*([234])\s*,\s*"([^"\\]*(?:\\.[^"\\]*)*)"(?:\s*,\s*"([^"\\]*(?:\\.[^"\\]*)*)")?'
+)
+_MESSAGE_TYPES = {"2": CALL, "3": CALLRESULT, "4": CALLERROR}
+
+
+class FrameError(ValueError):
+    pass
+
+
+def _unescape(value: str) -> str:
+    return json.loads(f'"{value}"')
+
+
+class Frame:
+    """An OCPP-J frame of which only the header (type, id, action) is decoded eagerly."""
+
+    __slots__ = ("raw", "message_type", "message_id", "action", "_json")
+
+    def __init__(
+        self,
+        raw: Union[str, bytes],
+        message_type: Optional[int],
+        message_id: Optional[str],
+        action: Optional[str],
+    ):
+        self.raw = raw
+        self.message_type = message_type
+        self.message_id = message_id
+        self.action = action
+        self._json = None
+
+    @classmethod
+    def parse(cls, raw: Union[str, bytes]) -> "Frame":
+        text = raw.decode("utf-8", "replace") if isinstance(raw, bytes) else raw
+        match = _HEADER.match(text)
+        if match is None:
+            raise FrameError(f"Not an OCPP-J frame: {text[:64]!r}")
+        message_type, message_id, action = match.groups()
+        message_type = _MESSAGE_TYPES[message_type]
+        if message_type != CALL:
+            action = None
+        elif action is None:
+            raise FrameError(f"CALL frame without an action: {text[:64]!r}")
+        elif "\\" in action:
+            action = _unescape(action)
+        if "\\" in message_id:
+            message_id = _unescape(message_id)
+        return cls(raw, message_type, message_id, action)
+
+    @classmethod
+    def parse_or_none(cls, raw: Union[str, bytes]) -> Optional["Frame"]:
+        try:
+            return cls.parse(raw)
+        except FrameError:
+            return None
+
+    @property
+    def json(self) -> list:
+        # Full decode, only paid for by consumers that need the payload
+        if self._json is None:
+            self._json = json.loads(self.raw)
+        return self._json
+
+    @property
+    def payload(self):
+        return self.json[-1]
+
+    @property
+    def is_call(self) -> bool:
+        return self.message_type == CALL
+
+    def __repr__(self):
+        return f"Frame(message_type={self.message_type}, message_id={self.message_id!r}, action={self.action!r}, size={len(self.raw)})"
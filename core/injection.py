@@ -0,0 +1,307 @@
+import asyncio
+import itertools
+import json
+from typing import Dict, Optional
+
+import websockets
+
+from core.correlation import Exchange
+from core.tracking import InjectionKey
+
+# Outcome of injections the relay refused to send, next to those of core.correlation.Exchange
+REJECTED = "rejected"
+# Outcome of a finished campaign, replied with its report
+CAMPAIGN = "campaign"
+
+
+class InjectionRejected(Exception):
+    def __init__(self, reason: str, code: int = 1008):
+        super().__init__(reason)
+        self.reason = reason
+        # Close code of a single-shot /inject connection
+        self.code = code
+
+
+class PendingInjections:
+    """Futures of the injected calls whose exchange someone waits for, e.g. an injection channel."""
+
+    def __init__(self):
+        self._futures: Dict[InjectionKey, asyncio.Future] = {}
+
+    def expect(self, key: InjectionKey):
+        if key in self._futures:
+            raise InjectionRejected(f"Message id {key[2]} is already in flight")
+        self._futures[key] = asyncio.get_running_loop().create_future()
+
+    def resolve(self, exchange: Exchange) -> bool:
+        future = self._futures.get(
+            (exchange.charge_point_id, exchange.direction, exchange.message_id)
+        )
+        if future is None or future.done():
+            return False
+        future.set_result(exchange)
+        return True
+
+    def discard(self, key: InjectionKey):
+        future = self._futures.pop(key, None)
+        if future is not None:
+            future.cancel()
+
+    async def result(self, key: InjectionKey, timeout: float) -> Optional[Exchange]:
+        """The exchange of an expected call, None if it didn't complete within `timeout` seconds."""
+        try:
+            return await asyncio.wait_for(self._futures[key], timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._futures.pop(key, None)
+
+    def __bool__(self) -> bool:
+        return bool(self._futures)
+
+    def __len__(self) -> int:
+        return len(self._futures)
+
+
+def reply(
+    tag,
+    charge_point_id: Optional[str],
+    direction: Optional[str],
+    message_id: Optional[str],
+    outcome: str,
+    response=None,
+    round_trip: Optional[float] = None,
+    reason: Optional[str] = None,
+) -> str:
+    header = json.dumps(
+        {
+            "tag": tag,
+            "charge_point_id": charge_point_id,
+            "direction": direction,
+            "message_id": message_id,
+            "outcome": outcome,
+            "round_trip": round_trip,
+            "reason": reason,
+        }
+    )
+    if isinstance(response, bytes):
+        response = response.decode()
+    # The response frame is embedded as relayed
+    return f'{header[:-1]}, "response": {response or "null"}}}'
+
+
+def exchange_reply(tag, exchange: Exchange) -> str:
+    return reply(
+        tag,
+        exchange.charge_point_id,
+        exchange.direction,
+        exchange.message_id,
+        exchange.outcome,
+        exchange.response,
+        exchange.round_trip,
+    )
+
+
+async def _inject_one(ws, inject_call, request: dict, timeout: float):
+    tag = request.get("tag")
+    charge_point_id = request.get("charge_point_id")
+    direction = request.get("direction")
+    message = request.get("message")
+    message_id = message[1] if isinstance(message, list) and len(message) > 1 else None
+    # The channel's timeout is an upper bound of the requested one
+    requested = request.get("timeout")
+    if isinstance(requested, (int, float)) and 0 < requested < timeout:
+        timeout = requested
+    try:
+        exchange = await inject_call(
+            direction,
+            charge_point_id,
+            message if isinstance(message, str) else json.dumps(message),
+            timeout,
+        )
+        if exchange is None:
+            response = reply(tag, charge_point_id, direction, message_id, "timeout")
+        else:
+            response = exchange_reply(tag, exchange)
+    except InjectionRejected as e:
+        response = reply(
+            tag, charge_point_id, direction, message_id, REJECTED, reason=e.reason
+        )
+    except websockets.exceptions.ConnectionClosed:
+        response = reply(
+            tag,
+            charge_point_id,
+            direction,
+            message_id,
+            "closed",
+            reason="Target connection closed",
+        )
+    try:
+        await ws.send(response)
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
+
+async def _run_campaign(ws, run_campaign, request: dict, logger):
+    tag = request.get("tag")
+    try:
+        report = await run_campaign(request["campaign"])
+        response = json.dumps({"tag": tag, "outcome": CAMPAIGN, "report": report})
+    except ValueError as e:
+        response = reply(tag, None, None, None, REJECTED, reason=str(e))
+    except Exception as e:
+        # The client waits for a reply in any case
+        logger.exception("Running a campaign failed")
+        response = reply(
+            tag, None, None, None, REJECTED, reason=f"Campaign failed: {e!r}"
+        )
+    try:
+        await ws.send(response)
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
+
+async def serve_injection_channel(
+    ws,
+    inject_call,
+    logger,
+    timeout: float = 60.0,
+    max_in_flight: int = 1024,
+    run_campaign=None,
+):
+    """
+    Serves a long-lived injection channel. Every request is a JSON object with the target `charge_point_id`, the
+    `direction`, the CALL `message` and an optional `tag` and `timeout`. It is answered with the CALLRESULT/CALLERROR
+    as `response` once relayed, or with a timeout, closed or rejected outcome. Requests are served concurrently, in
+    flight ones are bounded so that a fast client is slowed down by the websocket's flow control.
+    A request with a `campaign` (see core.campaigns.CampaignSpec) instead is answered with its report once done.
+    """
+    in_flight = asyncio.Semaphore(max_in_flight)
+    tasks = set()
+    served = 0
+    logger.info("Injection channel attached")
+    try:
+        async for text in ws:
+            try:
+                request = json.loads(text)
+                if not isinstance(request, dict):
+                    raise ValueError("Not a JSON object")
+            except ValueError as e:
+                await ws.send(reply(None, None, None, None, REJECTED, reason=str(e)))
+                continue
+            if "campaign" in request and run_campaign is not None:
+                task = asyncio.create_task(
+                    _run_campaign(ws, run_campaign, request, logger)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                continue
+            await in_flight.acquire()
+            task = asyncio.create_task(_inject_one(ws, inject_call, request, timeout))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda _: in_flight.release())
+            served += 1
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        logger.info(f"Injection channel detached after {served} injections")
+
+
+class InjectionClient:
+    """
+    Client of a relay's injection channel for scripts, many calls can be awaited concurrently on one connection:
+
+        async with InjectionClient("ws://localhost:8500") as client:
+            reply = await client.call("CP_1", "csms-cp", [2, "1", "Reset", {"type": "Soft"}])
+    """
+
+    def __init__(self, relay_url: str, timeout: float = 60.0):
+        self.url = f"{relay_url.rstrip('/')}/inject"
+        self.timeout = timeout
+        self._ws = None
+        self._reader: Optional[asyncio.Task] = None
+        self._tags = itertools.count()
+        self._replies: Dict[int, asyncio.Future] = {}
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        self._ws = await websockets.connect(self.url, max_queue=None)
+        self._reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        try:
+            async for text in self._ws:
+                response = json.loads(text)
+                future = self._replies.pop(response.get("tag"), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            for future in self._replies.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Injection channel closed"))
+            self._replies.clear()
+
+    async def call(
+        self,
+        charge_point_id: str,
+        direction: str,
+        message,
+        timeout: Optional[float] = None,
+    ) -> dict:
+        """Injects a CALL, returns the relay's reply with `outcome` and the `response` frame."""
+        tag = next(self._tags)
+        future = self._replies[tag] = asyncio.get_running_loop().create_future()
+        timeout = timeout or self.timeout
+        await self._ws.send(
+            json.dumps(
+                {
+                    "tag": tag,
+                    "charge_point_id": charge_point_id,
+                    "direction": direction,
+                    "message": message,
+                    "timeout": timeout,
+                }
+            )
+        )
+        # The relay answers timed out calls itself, the margin only covers a relay that went away
+        try:
+            return await asyncio.wait_for(future, timeout + 5.0)
+        finally:
+            self._replies.pop(tag, None)
+
+    async def campaign(self, spec: dict, timeout: Optional[float] = None) -> dict:
+        """
+        Runs a campaign on the relay, returns its reply with the `report` once it is done. Raises asyncio.TimeoutError
+        without a reply within `timeout` seconds, by default the campaign's planned duration and call timeout, plus
+        the client's timeout as a margin for ChargePoints slowing it down.
+        """
+        if timeout is None:
+            # core.campaigns builds on this module
+            from core.campaigns import CampaignSpec
+
+            planned = CampaignSpec.from_dict(spec)
+            timeout = planned.planned_duration() + planned.timeout + self.timeout
+        tag = next(self._tags)
+        future = self._replies[tag] = asyncio.get_running_loop().create_future()
+        await self._ws.send(json.dumps({"tag": tag, "campaign": spec}))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._replies.pop(tag, None)
+
+    async def close(self):
+        if self._ws is not None:
+            await self._ws.close()
+        if self._reader is not None:
+            await self._reader
@@ -0,0 +1,85 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional
+
+from websockets.legacy.framing import prepare_data
+
+
+class LinkPolicy(str, Enum):
+    # Stop reading from the source until the peer caught up, the default and the only lossless one
+    PAUSE = "pause"
+    # Drop frames while the peer is behind
+    DROP = "drop"
+    # Close the slow peer's connection
+    CLOSE = "close"
+
+
+@dataclass
+class LinkConfig:
+    high_water: int = 2**16
+    policy: LinkPolicy = LinkPolicy.PAUSE
+    # With PAUSE, a peer that is stalled for longer is closed, None waits forever
+    stall_timeout: Optional[float] = None
+
+
+class LinkOverflow(Exception):
+    pass
+
+
+class OutboundLink:
+    """
+    The sending side of one direction of a session. Frames are written to the websocket's transport straight away,
+    its write buffer is the link's outbound buffer, and what happens once the buffer is above the high-water mark
+    is up to the policy. Only the session this link belongs to is affected by a slow peer.
+    """
+
+    def __init__(self, ws, direction: str, config: LinkConfig, metrics=None):
+        self.ws = ws
+        self.direction = direction
+        self.config = config
+        self.metrics = metrics
+        self.stalled_since: Optional[float] = None
+        ws.transport.set_write_buffer_limits(high=config.high_water)
+
+    @property
+    def buffered(self) -> int:
+        return self.ws.transport.get_write_buffer_size()
+
+    async def send(self, message) -> bool:
+        """Sends a frame unless the policy drops it, raises LinkOverflow when the policy closes the link."""
+        config = self.config
+        if self.buffered > config.high_water:
+            if config.policy is LinkPolicy.DROP:
+                if self.metrics is not None:
+                    self.metrics.link_dropped(self.direction, len(message))
+                return False
+            # Other senders of the link, e.g. injections, queue up behind the stalled one
+            await self._overflow()
+        # Raises ConnectionClosed like websockets' send()
+        await self.ws.ensure_open()
+        self.ws.write_frame_sync(True, *prepare_data(message))
+        if self.buffered > config.high_water and config.policy is not LinkPolicy.DROP:
+            await self._overflow()
+        return True
+
+    async def _overflow(self):
+        config = self.config
+        if config.policy is LinkPolicy.CLOSE:
+            raise LinkOverflow(f"{self.buffered} bytes buffered for the peer")
+        started = time.perf_counter()
+        if self.stalled_since is None:
+            self.stalled_since = started
+        try:
+            await asyncio.wait_for(self.ws.drain(), config.stall_timeout)
+        except asyncio.TimeoutError:
+            raise LinkOverflow(f"Peer stalled for {config.stall_timeout} s")
+        finally:
+            if self.metrics is not None:
+                self.metrics.link_stalled(self.direction, time.perf_counter() - started)
+            self.stalled_since = None
+
+    def close(self, reason: str):
+        """Closes the peer's connection without waiting for the closing handshake, which a stalled peer wouldn't read."""
+        self.ws.fail_connection(1013, reason[:120])
@@ -0,0 +1,417 @@
+import asyncio
+import collections
+import logging
+import math
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from core.frames import Frame
+
+# Columns of a transaction's series besides the timestamp, and the measurand each is read from
+COLUMNS = ("energy", "power", "current", "soc")
+MEASURANDS = {
+    "Energy.Active.Import.Register": "energy",
+    "Power.Active.Import": "power",
+    "Current.Import": "current",
+    "SoC": "soc",
+}
+# Units the columns are kept in: Wh, W, A and %
+_UNIT_SCALES = {"kWh": 1000.0, "kW": 1000.0, "Wh": 1.0, "W": 1.0, "A": 1.0}
+# Phase values are combined when a frame has no total: energy and power add up, the current is the highest phase's
+_PHASES = {"L1", "L2", "L3", "L1-N", "L2-N", "L3-N"}
+# CP → CSMS actions carrying meter values
+ACTIONS = {"MeterValues", "TransactionEvent", "StopTransaction"}
+
+TransactionKey = Tuple[str, str]
+
+
+def _timestamp(text) -> float:
+    return datetime.fromisoformat(text.replace("Z", "+00:00")).timestamp()
+
+
+def parse_meter_value(meter_value: dict) -> Tuple[float, Dict[str, float]]:
+    """The timestamp and column values of an OCPP 1.6 or 2.0.1 MeterValue, phase values combined."""
+    totals, phases = {}, {}
+    for sampled in meter_value.get("sampledValue", ()):
+        column = MEASURANDS.get(
+            sampled.get("measurand", "Energy.Active.Import.Register")
+        )
+        if column is None:
+            continue
+        unit = sampled.get("unitOfMeasure")
+        if unit is not None:
+            # OCPP 2.0.1: {"unit": "kWh", "multiplier": 0}
+            scale = _UNIT_SCALES.get(unit.get("unit"), 1.0) * 10 ** unit.get(
+                "multiplier", 0
+            )
+        else:
+            scale = _UNIT_SCALES.get(sampled.get("unit"), 1.0)
+        # Values are strings in OCPP 1.6 and numbers in 2.0.1
+        value = float(sampled["value"]) * scale
+        phase = sampled.get("phase")
+        if phase is None:
+            totals[column] = value
+        elif phase in _PHASES:
+            phases.setdefault(column, []).append(value)
+    for column, values in phases.items():
+        if column not in totals:
+            totals[column] = max(values) if column == "current" else sum(values)
+    return _timestamp(meter_value["timestamp"]), totals
+
+
+class TransactionSeries:
+    """
+    The meter values of one transaction as columns of doubles (NaN where a sample has no value of the column) and
+    the running summary, both updated in O(1) per sample.
+    """
+
+    def __init__(
+        self,
+        charge_point_id: str,
+        transaction_id: str,
+        evse_id: Optional[int] = None,
+        max_samples: int = 100_000,
+    ):
+        self.charge_point_id = charge_point_id
+        self.transaction_id = transaction_id
+        self.evse_id = evse_id
+        self.max_samples = max_samples
+        self.timestamps = array("d")
+        self.columns = {column: array("d") for column in COLUMNS}
+        self.started_at: Optional[float] = None
+        self.ended_at: Optional[float] = None
+        self.samples = 0
+        self.energy_min = math.inf
+        self.energy_max = -math.inf
+        self.power_max = -math.inf
+        self.soc_first: Optional[float] = None
+        self.soc_last: Optional[float] = None
+        self.updated_at = time.time()
+
+    @property
+    def active(self) -> bool:
+        return self.ended_at is None
+
+    @property
+    def truncated(self) -> bool:
+        return self.samples > len(self.timestamps)
+
+    def add(self, timestamp: float, values: Dict[str, float]):
+        self.samples += 1
+        self.updated_at = time.time()
+        if self.started_at is None or timestamp < self.started_at:
+            self.started_at = timestamp
+        energy = values.get("energy")
+        if energy is not None:
+            self.energy_min = min(self.energy_min, energy)
+            self.energy_max = max(self.energy_max, energy)
+        power = values.get("power")
+        if power is not None:
+            self.power_max = max(self.power_max, power)
+        soc = values.get("soc")
+        if soc is not None:
+            if self.soc_first is None:
+                self.soc_first = soc
+            self.soc_last = soc
+        # The summary keeps going after the series is full, only the columns stop growing
+        if len(self.timestamps) < self.max_samples:
+            self.timestamps.append(timestamp)
+            for column, samples in self.columns.items():
+                samples.append(values.get(column, math.nan))
+
+    def end(self, timestamp: float):
+        self.ended_at = timestamp
+        self.updated_at = time.time()
+
+    def summary(self) -> dict:
+        energy = (
+            self.energy_max - self.energy_min
+            if self.energy_max >= self.energy_min
+            else None
+        )
+        end = self.ended_at if self.ended_at is not None else self._last_timestamp()
+        duration = (
+            end - self.started_at
+            if end is not None and self.started_at is not None
+            else None
+        )
+        return {
+            "charge_point_id": self.charge_point_id,
+            "transaction_id": self.transaction_id,
+            "evse_id": self.evse_id,
+            "active": self.active,
+            "started_at": self.started_at,
+            "ended_at": self.ended_at,
+            "duration": duration,
+            "samples": self.samples,
+            "truncated": self.truncated,
+            "energy_wh": energy,
+            "power_max_w": self.power_max if self.power_max > -math.inf else None,
+            "power_avg_w": (
+                energy * 3600 / duration if energy is not None and duration else None
+            ),
+            "soc_start": self.soc_first,
+            "soc_end": self.soc_last,
+        }
+
+    def _last_timestamp(self) -> Optional[float]:
+        return self.timestamps[-1] if self.timestamps else self.started_at
+
+    def series(self) -> Dict[str, List[Optional[float]]]:
+        """The columns as lists, missing values as None, ready to be serialized or charted."""
+        series = {"timestamp": self.timestamps.tolist()}
+        for column, samples in self.columns.items():
+            series[column] = [None if value != value else value for value in samples]
+        return series
+
+
+class MeterValueAggregator:
+    """
+    Groups the meter values relayed from the ChargePoints by transaction as they pass, OCPP 1.6 (StartTransaction,
+    MeterValues, StopTransaction) and 2.0.1 (TransactionEvent, MeterValues). Meter values without a transaction id
+    are added to the transaction active on their connector/EVSE. The least recently updated transactions are
+    forgotten beyond `max_transactions`.
+    """
+
+    def __init__(self, max_transactions: int = 10_000, max_samples: int = 100_000):
+        self.max_transactions = max_transactions
+        self.max_samples = max_samples
+        self._transactions: (
+            "collections.OrderedDict[TransactionKey, TransactionSeries]"
+        ) = collections.OrderedDict()
+        # (charge point, connector/EVSE id) -> transaction id running on it
+        self._active: Dict[Tuple[str, int], str] = {}
+        self.samples = 0
+        self.unassigned = 0
+        self.malformed = 0
+
+    def _transaction(
+        self, charge_point_id: str, transaction_id, evse_id: Optional[int] = None
+    ) -> TransactionSeries:
+        key = (charge_point_id, str(transaction_id))
+        series = self._transactions.get(key)
+        if series is None:
+            series = TransactionSeries(
+                charge_point_id, key[1], evse_id, self.max_samples
+            )
+            self._transactions[key] = series
+            while len(self._transactions) > self.max_transactions:
+                (cp, transaction), evicted = self._transactions.popitem(last=False)
+                if self._active.get((cp, evicted.evse_id)) == transaction:
+                    del self._active[(cp, evicted.evse_id)]
+        else:
+            self._transactions.move_to_end(key)
+        if evse_id is not None and series.active:
+            series.evse_id = evse_id
+            self._active[(charge_point_id, evse_id)] = series.transaction_id
+        return series
+
+    def _add(self, series: TransactionSeries, meter_values: Iterable[dict]):
+        for meter_value in meter_values:
+            series.add(*parse_meter_value(meter_value))
+            self.samples += 1
+
+    def _end(self, series: TransactionSeries, timestamp: float):
+        series.end(timestamp)
+        if self._active.get((series.charge_point_id, series.evse_id)) == (
+            series.transaction_id
+        ):
+            del self._active[(series.charge_point_id, series.evse_id)]
+
+    def feed(self, charge_point_id: str, frame: Frame):
+        """Aggregates a CP → CSMS CALL, only decoding the payload of the actions carrying meter values."""
+        if frame.action not in ACTIONS:
+            return
+        try:
+            payload = frame.payload
+            if frame.action == "TransactionEvent":
+                self._transaction_event(charge_point_id, payload)
+            elif frame.action == "MeterValues":
+                self._meter_values(charge_point_id, payload)
+            else:
+                self._stop_transaction(charge_point_id, payload)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            self.malformed += 1
+
+    def feed_exchange(self, exchange):
+        """Aggregates an answered OCPP 1.6 StartTransaction, whose transaction id is only in the response."""
+        if (
+            exchange.action != "StartTransaction"
+            or exchange.direction != "cp-csms"
+            or exchange.outcome != "CALLRESULT"
+        ):
+            return
+        try:
+            request = Frame.parse(exchange.request).payload
+            response = Frame.parse(exchange.response).payload
+            series = self._transaction(
+                exchange.charge_point_id,
+                response["transactionId"],
+                request["connectorId"],
+            )
+            series.add(
+                _timestamp(request["timestamp"]),
+                {"energy": float(request["meterStart"])},
+            )
+            self.samples += 1
+        except (KeyError, TypeError, ValueError, AttributeError):
+            self.malformed += 1
+
+    def _transaction_event(self, charge_point_id: str, payload: dict):
+        evse = payload.get("evse")
+        series = self._transaction(
+            charge_point_id,
+            payload["transactionInfo"]["transactionId"],
+            evse["id"] if evse else None,
+        )
+        timestamp = _timestamp(payload["timestamp"])
+        if series.started_at is None or timestamp < series.started_at:
+            series.started_at = timestamp
+        self._add(series, payload.get("meterValue", ()))
+        if payload["eventType"] == "Ended":
+            self._end(series, timestamp)
+
+    def _meter_values(self, charge_point_id: str, payload: dict):
+        # OCPP 1.6 has the connector and an optional transaction id, 2.0.1 only the EVSE
+        evse_id = payload.get("connectorId", payload.get("evseId"))
+        transaction_id = payload.get("transactionId")
+        if transaction_id is None:
+            transaction_id = self._active.get((charge_point_id, evse_id))
+            if transaction_id is None:
+                self.unassigned += len(payload["meterValue"])
+                return
+        self._add(
+            self._transaction(charge_point_id, transaction_id, evse_id),
+            payload["meterValue"],
+        )
+
+    def _stop_transaction(self, charge_point_id: str, payload: dict):
+        series = self._transaction(charge_point_id, payload["transactionId"])
+        timestamp = _timestamp(payload["timestamp"])
+        self._add(series, payload.get("transactionData", ()))
+        series.add(timestamp, {"energy": float(payload["meterStop"])})
+        self.samples += 1
+        self._end(series, timestamp)
+
+    def get(
+        self, charge_point_id: str, transaction_id: str
+    ) -> Optional[TransactionSeries]:
+        return self._transactions.get((charge_point_id, transaction_id))
+
+    def describe(self, charge_point_id: str, transaction_id: str) -> Optional[dict]:
+        """The summary and series of a transaction, None if it is unknown."""
+        series = self.get(charge_point_id, transaction_id)
+        if series is None:
+            return None
+        return {"summary": series.summary(), "series": series.series()}
+
+    def transactions(self, charge_point_id: Optional[str] = None) -> List[dict]:
+        """Summaries of the transactions (of a ChargePoint), most recently updated first."""
+        return [
+            series.summary()
+            for series in reversed(self._transactions.values())
+            if charge_point_id is None or series.charge_point_id == charge_point_id
+        ]
+
+    def stats(self) -> dict:
+        return {
+            "transactions": len(self._transactions),
+            "active": len(self._active),
+            "samples": self.samples,
+            "unassigned": self.unassigned,
+            "malformed": self.malformed,
+        }
+
+
+class MeterValueFeed:
+    """
+    Feeds relayed frames to a MeterValueAggregator in batches on a dedicated thread, so their payloads are only
+    decoded after forwarding and off the event loop. Queries of the aggregator run on the same thread. Like capture
+    records, frames are dropped rather than slowing down relaying once `max_buffered` are waiting.
+    """
+
+    def __init__(
+        self,
+        aggregator: Optional[MeterValueAggregator] = None,
+        flush_interval: float = 0.2,
+        max_buffered: int = 10_000,
+    ):
+        self.aggregator = aggregator or MeterValueAggregator()
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.dropped = 0
+        self.logger = logging.getLogger(MeterValueFeed.__qualname__)
+        # (charge point id, frame), or (None, exchange) of an answered StartTransaction
+        self._buffer = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Meter")
+        self._flusher: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def feed(self, charge_point_id: str, frame: Frame):
+        if frame.action in ACTIONS:
+            self._append((charge_point_id, frame))
+
+    def feed_exchange(self, exchange):
+        if exchange.action == "StartTransaction":
+            self._append((None, exchange))
+
+    def _append(self, item):
+        if self._closed:
+            return
+        if len(self._buffer) >= self.max_buffered:
+            self.dropped += 1
+            return
+        self._buffer.append(item)
+        if self._flusher is None:
+            self._flusher = asyncio.get_running_loop().create_task(self._run())
+
+    def _feed_batch(self, batch):
+        for charge_point_id, item in batch:
+            if charge_point_id is None:
+                self.aggregator.feed_exchange(item)
+            else:
+                self.aggregator.feed(charge_point_id, item)
+
+    async def flush(self):
+        batch, self._buffer = self._buffer, []
+        if batch:
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._feed_batch, batch
+            )
+
+    async def _run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logger.exception("Aggregating meter values failed")
+            raise
+
+    async def query(self, method, *args):
+        """Runs `method(*args)` of the aggregator on its thread, after the frames fed so far."""
+        await self.flush()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, getattr(self.aggregator, method), *args
+        )
+
+    async def close(self):
+        """Aggregates the frames still buffered and stops the feed's thread, on shutdown."""
+        self._closed = True
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        await self.flush()
+        self._executor.shutdown()
+
+    def stats(self) -> dict:
+        return {
+            **self.aggregator.stats(),
+            "buffered": len(self._buffer),
+            "dropped": self.dropped,
+        }
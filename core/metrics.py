@@ -0,0 +1,335 @@
+import bisect
+import collections
+import http
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from core.compression import LEGS, CompressionStats
+from core.frames import CALL, CALLERROR, CALLRESULT
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+MESSAGE_TYPE_NAMES = {CALL: "CALL", CALLRESULT: "CALLRESULT", CALLERROR: "CALLERROR"}
+
+# Actions of OCPP 1.6 (with the security extensions) and 2.0.1, any other action is labelled "other", so a ChargePoint
+# sending made-up actions can't add series without bound
+OCPP_ACTIONS = frozenset("""
+    Authorize BootNotification CancelReservation CertificateSigned ChangeAvailability ChangeConfiguration
+    ClearCache ClearChargingProfile ClearDisplayMessage ClearVariableMonitoring ClearedChargingLimit CostUpdated
+    CustomerInformation DataTransfer DeleteCertificate DiagnosticsStatusNotification ExtendedTriggerMessage
+    FirmwareStatusNotification Get15118EVCertificate GetBaseReport GetCertificateStatus GetChargingProfiles
+    GetCompositeSchedule GetConfiguration GetDiagnostics GetDisplayMessages GetInstalledCertificateIds
+    GetLocalListVersion GetLog GetMonitoringReport GetReport GetTransactionStatus GetVariables Heartbeat
+    InstallCertificate LogStatusNotification MeterValues NotifyChargingLimit NotifyCustomerInformation
+    NotifyDisplayMessages NotifyEVChargingNeeds NotifyEVChargingSchedule NotifyEvent NotifyMonitoringReport
+    NotifyReport PublishFirmware PublishFirmwareStatusNotification RemoteStartTransaction RemoteStopTransaction
+    ReportChargingProfiles RequestStartTransaction RequestStopTransaction ReservationStatusUpdate ReserveNow
+    Reset SecurityEventNotification SendLocalList SetChargingProfile SetDisplayMessage SetMonitoringBase
+    SetMonitoringLevel SetNetworkProfile SetVariableMonitoring SetVariables SignCertificate
+    SignedFirmwareStatusNotification SignedUpdateFirmware StartTransaction StatusNotification StopTransaction
+    TransactionEvent TriggerMessage UnlockConnector UnpublishFirmware UpdateFirmware
+    """.split())
+
+# Seconds, forwarding a frame is expected to take well below a millisecond
+FORWARDING_BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+)
+ROUND_TRIP_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+STALL_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+CONNECT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# (name suffix, labels, value)
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def action_label(action: str) -> str:
+    return action if not action or action in OCPP_ACTIONS else "other"
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Iterable[float]):
+        self.bounds = tuple(bounds)
+        # One slot per bucket and a last one for +Inf, only made cumulative when rendered
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, labels: Dict[str, str]) -> List[Sample]:
+        samples, cumulative = [], 0
+        for bound, count in zip((*self.bounds, "+Inf"), self.counts):
+            cumulative += count
+            samples.append(("_bucket", {**labels, "le": str(bound)}, cumulative))
+        samples.append(("_sum", labels, self.sum))
+        samples.append(("_count", labels, self.count))
+        return samples
+
+
+class MetricFamily:
+    def __init__(self, name: str, type_: str, help_: str, samples=None):
+        self.name = name
+        self.type = type_
+        self.help = help_
+        self.samples: List[Sample] = samples or []
+
+    def add(self, value: float, **labels):
+        self.samples.append(("", labels, value))
+        return self
+
+    def add_histogram(self, histogram: Histogram, **labels):
+        self.samples.extend(histogram.samples(labels))
+        return self
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render(
+    families: Iterable[MetricFamily], constant_labels: Optional[Dict[str, str]] = None
+) -> str:
+    """Prometheus text exposition format, only ever run at scrape time."""
+    lines = []
+    for family in families:
+        lines.append(f"# HELP {family.name} {family.help}")
+        lines.append(f"# TYPE {family.name} {family.type}")
+        for suffix, labels, value in family.samples:
+            labels = {**(constant_labels or {}), **labels}
+            label_text = ",".join(
+                f'{key}="{_escape(label)}"' for key, label in labels.items()
+            )
+            lines.append(
+                f"{family.name}{suffix}{{{label_text}}} {value}"
+                if label_text
+                else f"{family.name}{suffix} {value}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def merge(expositions: Iterable[str]) -> str:
+    """Merges the expositions of several processes, each family is declared once with the samples of all of them."""
+    families: Dict[str, List[str]] = {}
+    current = None
+    for exposition in expositions:
+        for line in exposition.splitlines():
+            if line.startswith("# HELP "):
+                current = families.setdefault(line.split(" ", 3)[2], [])
+                if not current:
+                    current.append(line)
+            elif line.startswith("# TYPE "):
+                if len(current) == 1:
+                    current.append(line)
+            elif line and current is not None:
+                current.append(line)
+    return "\n".join(line for lines in families.values() for line in lines) + "\n"
+
+
+def http_response(body: str):
+    return (
+        http.HTTPStatus.OK,
+        [("Content-Type", CONTENT_TYPE)],
+        body.encode(),
+    )
+
+
+class RelayMetrics:
+    """
+    Counters updated on the relay's hot path. They are plain ints and dicts owned by the event loop thread, so no
+    locks are needed, and nothing is formatted before a scrape.
+    """
+
+    def __init__(self):
+        # direction -> (message type, action) -> count
+        self.frames: Dict[str, Dict[Tuple[int, str], int]] = {}
+        self.bytes: Dict[str, Dict[Tuple[int, str], int]] = {}
+        self.malformed: Dict[str, int] = collections.defaultdict(int)
+        self.unmatched: Dict[str, int] = collections.defaultdict(int)
+        self.forwarding: Dict[str, Histogram] = {}
+        self.round_trip: Dict[Tuple[str, str], Histogram] = {}
+        self.unanswered: Dict[Tuple[str, str, str], int] = collections.defaultdict(int)
+        self.connect = {
+            phase: Histogram(CONNECT_BUCKETS)
+            for phase in ("dns", "tcp", "tls", "upgrade", "total")
+        }
+        self.sessions_opened = 0
+        # Per direction, about the outbound links whose peer reads too slowly
+        self.link_stalls: Dict[str, Histogram] = {}
+        self.link_dropped_frames: Dict[str, int] = collections.defaultdict(int)
+        self.link_dropped_bytes: Dict[str, int] = collections.defaultdict(int)
+        self.link_overflows: Dict[str, int] = collections.defaultdict(int)
+        # leg -> compression of the sessions that ended, those of live sessions are added on a scrape
+        self.compression = {leg: CompressionStats() for leg in LEGS}
+
+    def relayed(
+        self,
+        direction: str,
+        message_type: int,
+        action: str,
+        size: int,
+        forwarding_time: Optional[float] = None,
+    ):
+        frames = self.frames.get(direction)
+        if frames is None:
+            frames = self.frames[direction] = collections.defaultdict(int)
+            self.bytes[direction] = collections.defaultdict(int)
+            self.forwarding[direction] = Histogram(FORWARDING_BUCKETS)
+        key = (message_type, action_label(action))
+        frames[key] += 1
+        # Text frames are counted in characters, the same as bytes for the ASCII JSON of OCPP-J
+        self.bytes[direction][key] += size
+        if forwarding_time is not None:
+            self.forwarding[direction].observe(forwarding_time)
+
+    def exchanged(self, exchange):
+        key = (exchange.direction, action_label(exchange.action))
+        if exchange.round_trip is None:
+            self.unanswered[(*key, exchange.outcome)] += 1
+            return
+        histogram = self.round_trip.get(key)
+        if histogram is None:
+            histogram = self.round_trip[key] = Histogram(ROUND_TRIP_BUCKETS)
+        histogram.observe(exchange.round_trip)
+
+    def link_stalled(self, direction: str, seconds: float):
+        histogram = self.link_stalls.get(direction)
+        if histogram is None:
+            histogram = self.link_stalls[direction] = Histogram(STALL_BUCKETS)
+        histogram.observe(seconds)
+
+    def link_dropped(self, direction: str, size: int):
+        self.link_dropped_frames[direction] += 1
+        self.link_dropped_bytes[direction] += size
+
+    def connected(self, timings):
+        self.sessions_opened += 1
+        for phase, histogram in self.connect.items():
+            histogram.observe(getattr(timings, phase))
+
+    def collect(self) -> List[MetricFamily]:
+        frames = MetricFamily(
+            "ocpp_relay_frames_total", "counter", "OCPP-J frames relayed"
+        )
+        sizes = MetricFamily(
+            "ocpp_relay_frame_bytes_total",
+            "counter",
+            "Size of the OCPP-J frames relayed",
+        )
+        for direction, counts in self.frames.items():
+            for (message_type, action), count in list(counts.items()):
+                labels = {
+                    "direction": direction,
+                    "type": MESSAGE_TYPE_NAMES.get(message_type, "unknown"),
+                    "action": action,
+                }
+                frames.add(count, **labels)
+                sizes.add(self.bytes[direction][(message_type, action)], **labels)
+        malformed = MetricFamily(
+            "ocpp_relay_malformed_frames_total",
+            "counter",
+            "Frames relayed that are not OCPP-J",
+        )
+        for direction, count in self.malformed.items():
+            malformed.add(count, direction=direction)
+        unmatched = MetricFamily(
+            "ocpp_relay_unmatched_responses_total",
+            "counter",
+            "CALLRESULT/CALLERROR frames without a pending CALL, e.g. answered after the timeout",
+        )
+        for direction, count in self.unmatched.items():
+            unmatched.add(count, direction=direction)
+        forwarding = MetricFamily(
+            "ocpp_relay_forwarding_seconds",
+            "histogram",
+            "Time from receiving a frame to having it sent on the other leg",
+        )
+        for direction, histogram in self.forwarding.items():
+            forwarding.add_histogram(histogram, direction=direction)
+        round_trip = MetricFamily(
+            "ocpp_relay_call_round_trip_seconds",
+            "histogram",
+            "Time from relaying a CALL to relaying its CALLRESULT/CALLERROR, direction is the one of the CALL",
+        )
+        for (direction, action), histogram in list(self.round_trip.items()):
+            round_trip.add_histogram(histogram, direction=direction, action=action)
+        unanswered = MetricFamily(
+            "ocpp_relay_calls_unanswered_total",
+            "counter",
+            "CALLs that timed out or whose connection closed before the response",
+        )
+        for (direction, action, outcome), count in list(self.unanswered.items()):
+            unanswered.add(count, direction=direction, action=action, outcome=outcome)
+        connect = MetricFamily(
+            "ocpp_relay_upstream_connect_seconds",
+            "histogram",
+            "Time to open the CSMS connection of a ChargePoint, per phase",
+        )
+        for phase, histogram in self.connect.items():
+            connect.add_histogram(histogram, phase=phase)
+        stalls = MetricFamily(
+            "ocpp_relay_link_stall_seconds",
+            "histogram",
+            "Time reading from the source was paused until the peer caught up, direction is the one of the frames",
+        )
+        for direction, histogram in self.link_stalls.items():
+            stalls.add_histogram(histogram, direction=direction)
+        dropped_frames = MetricFamily(
+            "ocpp_relay_link_dropped_frames_total",
+            "counter",
+            "Frames dropped as the peer was above the high-water mark",
+        )
+        dropped_bytes = MetricFamily(
+            "ocpp_relay_link_dropped_bytes_total",
+            "counter",
+            "Size of the frames dropped as the peer was above the high-water mark",
+        )
+        for direction, count in self.link_dropped_frames.items():
+            dropped_frames.add(count, direction=direction)
+            dropped_bytes.add(self.link_dropped_bytes[direction], direction=direction)
+        overflows = MetricFamily(
+            "ocpp_relay_link_overflows_total",
+            "counter",
+            "Sessions closed as a peer was above the high-water mark or stalled too long",
+        )
+        for direction, count in self.link_overflows.items():
+            overflows.add(count, direction=direction)
+        return [
+            frames,
+            sizes,
+            malformed,
+            unmatched,
+            forwarding,
+            round_trip,
+            unanswered,
+            connect,
+            stalls,
+            dropped_frames,
+            dropped_bytes,
+            overflows,
+        ]
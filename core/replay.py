@@ -0,0 +1,444 @@
+import argparse
+import asyncio
+import json
+import logging
+import re
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import websockets
+
+from core.capture import CaptureReader
+from core.frames import CALL, CALLERROR, CALLRESULT, Frame
+
+# Payload fields holding a point in time, e.g. `timestamp` (StatusNotification, MeterValues) or `startTime`
+_TIMESTAMP_KEY = re.compile(r"(?:^|[a-z])(?:[Tt]imestamp|Time)$")
+
+
+@dataclass
+class ReplayMessage:
+    timestamp: float
+    charge_point_id: str
+    action: str
+    payload: dict
+
+
+def messages_from_capture(
+    directory,
+    charge_point_id: Optional[str] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    action: Optional[str] = None,
+) -> Iterator[ReplayMessage]:
+    """CP → CSMS CALLs of a relay capture (see `relay.py --capture-dir`), in the order they were relayed."""
+    reader = CaptureReader(directory)
+    try:
+        for record in reader.query(
+            charge_point_id=charge_point_id, start=start, end=end, action=action
+        ):
+            if record.direction != "cp-csms" or record.message_type != CALL:
+                continue
+            yield ReplayMessage(
+                timestamp=record.timestamp,
+                charge_point_id=record.charge_point_id,
+                action=record.action,
+                payload=Frame.parse(record.frame).payload,
+            )
+    finally:
+        reader.close()
+
+
+def _load_events(path: Path) -> Iterable[dict]:
+    with path.open() as f:
+        content = json.load(f)
+    if isinstance(content, list):
+        return content
+    if "request" in content:
+        return [content]
+    # A dump of AppState.events, keyed by event id
+    return content.values()
+
+
+def messages_from_events(
+    paths: Iterable, default_charge_point_id: str = "CP00000001"
+) -> Iterator[ReplayMessage]:
+    """Requests of `state.Event` records stored as json, either single events, lists of them or an events dict."""
+    files = []
+    for path in map(Path, paths):
+        files.extend(sorted(path.glob("*.json")) if path.is_dir() else [path])
+    events = [event for path in files for event in _load_events(path)]
+    for event in sorted(events, key=lambda event: event["timestamp"]):
+        frame = Frame.parse(event["request"])
+        if not frame.is_call:
+            continue
+        yield ReplayMessage(
+            timestamp=float(event["timestamp"]),
+            charge_point_id=event.get("charge_point_id") or default_charge_point_id,
+            action=frame.action,
+            payload=frame.payload,
+        )
+
+
+def _shift_timestamp(value: str, delta: float) -> str:
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return value
+    shifted = parsed + timedelta(seconds=delta)
+    if value.endswith("Z"):
+        return shifted.astimezone(timezone.utc).replace(tzinfo=None).isoformat() + "Z"
+    return shifted.isoformat()
+
+
+def rewrite_timestamps(payload, delta: float):
+    """Moves every timestamp of a payload by `delta` seconds, keeping the offsets between them as recorded."""
+    if isinstance(payload, dict):
+        return {
+            key: (
+                _shift_timestamp(value, delta)
+                if isinstance(value, str) and _TIMESTAMP_KEY.search(key)
+                else rewrite_timestamps(value, delta)
+            )
+            for key, value in payload.items()
+        }
+    if isinstance(payload, list):
+        return [rewrite_timestamps(item, delta) for item in payload]
+    return payload
+
+
+def _percentile(ordered: List[float], percentile: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+@dataclass
+class ActionStats:
+    sent: int = 0
+    results: int = 0
+    errors: int = 0
+    timeouts: int = 0
+    latencies: List[float] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        ordered = sorted(self.latencies)
+        return {
+            "sent": self.sent,
+            "results": self.results,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "p50_ms": _percentile(ordered, 50) * 1000,
+            "p90_ms": _percentile(ordered, 90) * 1000,
+            "p99_ms": _percentile(ordered, 99) * 1000,
+            "max_ms": (ordered[-1] if ordered else 0.0) * 1000,
+        }
+
+
+@dataclass
+class ReplayReport:
+    speed: Optional[float]
+    duration: float = 0.0
+    sessions: int = 0
+    connect_failures: int = 0
+    unsent: int = 0
+    actions: Dict[str, ActionStats] = field(default_factory=dict)
+    # How late each message was sent compared to its schedule
+    lateness: List[float] = field(default_factory=list)
+
+    def action(self, action: str) -> ActionStats:
+        if action not in self.actions:
+            self.actions[action] = ActionStats()
+        return self.actions[action]
+
+    def to_dict(self) -> dict:
+        sent = sum(stats.sent for stats in self.actions.values())
+        lateness = sorted(self.lateness)
+        return {
+            "speed": self.speed or "max",
+            "duration_s": self.duration,
+            "sessions": self.sessions,
+            "connect_failures": self.connect_failures,
+            "unsent": self.unsent,
+            "sent": sent,
+            "rate_per_s": sent / self.duration if self.duration else 0.0,
+            "lateness_p50_ms": _percentile(lateness, 50) * 1000,
+            "lateness_p99_ms": _percentile(lateness, 99) * 1000,
+            "actions": {
+                action: stats.to_dict()
+                for action, stats in sorted(self.actions.items())
+            },
+        }
+
+    def format(self) -> str:
+        report = self.to_dict()
+        lines = [
+            f"Replayed {report['sent']} calls over {report['sessions']} sessions in {report['duration_s']:.2f} s "
+            f"({report['rate_per_s']:.1f} calls/s, speed: {report['speed']}, connect failures: {report['connect_failures']}, "
+            f"unsent: {report['unsent']})",
+            f"Send lateness p50 {report['lateness_p50_ms']:.2f} ms, p99 {report['lateness_p99_ms']:.2f} ms",
+            f"{'action':<32}{'sent':>8}{'results':>9}{'errors':>8}{'timeouts':>10}"
+            f"{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+        ]
+        for action, stats in report["actions"].items():
+            lines.append(
+                f"{action:<32}{stats['sent']:>8}{stats['results']:>9}{stats['errors']:>8}{stats['timeouts']:>10}"
+                f"{stats['p50_ms']:>10.2f}{stats['p90_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}"
+            )
+        return "\n".join(lines)
+
+
+class ReplaySession:
+    """One replayed ChargePoint connection, sends its calls in order and matches the CSMS responses."""
+
+    def __init__(self, replayer: "Replayer", charge_point_id: str):
+        self.replayer = replayer
+        self.charge_point_id = charge_point_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=replayer.queue_size)
+        # At most `window` outstanding calls, OCPP-J allows only a single one per direction
+        self.window = asyncio.Semaphore(replayer.window)
+        self.pending: Dict[str, tuple] = {}
+        self.ws = None
+        self.closed = False
+        self.logger = logging.getLogger(ReplaySession.__qualname__)
+
+    async def run(self):
+        replayer = self.replayer
+        try:
+            self.ws = await websockets.connect(
+                f"{replayer.url}/{self.charge_point_id}",
+                subprotocols=[replayer.subprotocol],
+                extra_headers=replayer.extra_headers,
+                max_size=None,
+            )
+        except (OSError, asyncio.TimeoutError, websockets.InvalidHandshake) as e:
+            self.logger.error(f"{self.charge_point_id}: connecting failed: {e!r}")
+            replayer.report.connect_failures += 1
+            return self._close()
+
+        receiver = asyncio.create_task(self._receive())
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is None:
+                    break
+                due, message = item
+                await self.window.acquire()
+                await self._send(due, message)
+            # Wait for the outstanding responses before closing
+            for _ in range(replayer.window):
+                await self.window.acquire()
+        except websockets.exceptions.ConnectionClosed:
+            self.logger.warning(f"{self.charge_point_id}: connection closed by CSMS")
+        finally:
+            receiver.cancel()
+            for timeout in [timeout for *_, timeout in self.pending.values()]:
+                timeout.cancel()
+            self._close()
+            await self.ws.close()
+
+    def _close(self):
+        self.closed = True
+        # Unblocks the dispatcher if it is waiting on a full queue, messages of a closed session are not sent
+        while not self.queue.empty():
+            if self.queue.get_nowait() is not None:
+                self.replayer.report.unsent += 1
+
+    async def _send(self, due: float, message: ReplayMessage):
+        replayer = self.replayer
+        loop = asyncio.get_running_loop()
+        message_id = str(uuid.uuid4())
+        payload = message.payload
+        if replayer.rewrite_timestamps:
+            payload = rewrite_timestamps(payload, time.time() - message.timestamp)
+        frame = json.dumps([CALL, message_id, message.action, payload])
+        stats = replayer.report.action(message.action)
+        stats.sent += 1
+        sent_at = loop.time()
+        replayer.report.lateness.append(max(0.0, sent_at - due))
+        self.pending[message_id] = (
+            message.action,
+            sent_at,
+            loop.call_later(replayer.timeout, self._timed_out, message_id),
+        )
+        await self.ws.send(frame)
+
+    def _timed_out(self, message_id: str):
+        action, *_ = self.pending.pop(message_id)
+        self.replayer.report.action(action).timeouts += 1
+        self.window.release()
+
+    async def _receive(self):
+        loop = asyncio.get_running_loop()
+        async for raw in self.ws:
+            received_at = loop.time()
+            frame = Frame.parse_or_none(raw)
+            if frame is None:
+                continue
+            if frame.is_call:
+                # Calls initiated by the CSMS (e.g. TriggerMessage) are not part of the replay
+                await self.ws.send(
+                    json.dumps(
+                        [
+                            CALLERROR,
+                            frame.message_id,
+                            "NotImplemented",
+                            "Not supported during replay",
+                            {},
+                        ]
+                    )
+                )
+                continue
+            pending = self.pending.pop(frame.message_id, None)
+            if pending is None:
+                continue
+            action, sent_at, timeout = pending
+            timeout.cancel()
+            stats = self.replayer.report.action(action)
+            stats.latencies.append(received_at - sent_at)
+            if frame.message_type == CALLRESULT:
+                stats.results += 1
+            else:
+                stats.errors += 1
+            self.window.release()
+
+
+class Replayer:
+    """
+    Replays recorded CP → CSMS calls against a CSMS (or relay) with the recorded pacing scaled by `speed`, or as fast
+    as possible if `speed` is None. Every ChargePoint gets its own connection, `clones` > 1 multiplies them.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        speed: Optional[float] = 1.0,
+        clones: int = 1,
+        subprotocol: str = "ocpp2.0.1",
+        extra_headers=None,
+        timeout: float = 30.0,
+        window: int = 1,
+        rewrite_timestamps: bool = True,
+        queue_size: int = 1024,
+    ):
+        self.url = url.rstrip("/")
+        self.speed = speed
+        self.clones = clones
+        self.subprotocol = subprotocol
+        self.extra_headers = extra_headers or []
+        self.timeout = timeout
+        self.window = window
+        self.rewrite_timestamps = rewrite_timestamps
+        self.queue_size = queue_size
+        self.report = ReplayReport(speed=speed)
+        self.logger = logging.getLogger(Replayer.__qualname__)
+
+    def _session_ids(self, charge_point_id: str) -> List[str]:
+        if self.clones == 1:
+            return [charge_point_id]
+        return [f"{charge_point_id}-{clone}" for clone in range(self.clones)]
+
+    async def run(self, messages: Iterable[ReplayMessage]) -> ReplayReport:
+        loop = asyncio.get_running_loop()
+        sessions: Dict[str, ReplaySession] = {}
+        tasks = []
+        started = loop.time()
+        first = None
+        for message in messages:
+            if first is None:
+                first = message.timestamp
+            due = loop.time()
+            if self.speed:
+                due = started + (message.timestamp - first) / self.speed
+                if due > loop.time():
+                    await asyncio.sleep(due - loop.time())
+            for session_id in self._session_ids(message.charge_point_id):
+                session = sessions.get(session_id)
+                if session is None:
+                    # Connected on its first message, like the recorded ChargePoint did
+                    session = sessions[session_id] = ReplaySession(self, session_id)
+                    tasks.append(asyncio.create_task(session.run()))
+                if session.closed:
+                    self.report.unsent += 1
+                    continue
+                await session.queue.put((due, message))
+        for session in sessions.values():
+            if not session.closed:
+                await session.queue.put(None)
+        await asyncio.gather(*tasks)
+        self.report.duration = loop.time() - started
+        self.report.sessions = len(sessions)
+        return self.report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay recorded CP → CSMS traffic against a CSMS"
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--capture-dir", help="Relay capture directory to replay")
+    source.add_argument(
+        "--events",
+        nargs="+",
+        help="Event json files, or directories of them, to replay",
+    )
+    parser.add_argument("--url", default="ws://localhost:9000")
+    parser.add_argument(
+        "--speed",
+        default="1",
+        help="Pacing relative to the recording, e.g. 1, 10 or max",
+    )
+    parser.add_argument(
+        "--clones",
+        type=int,
+        default=1,
+        help="Sessions per recorded ChargePoint",
+    )
+    parser.add_argument("--subprotocol", default="ocpp2.0.1")
+    parser.add_argument("--charge-point-id", help="Only replay this ChargePoint")
+    parser.add_argument("--action", help="Only replay this action")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=1,
+        help="Outstanding calls per session",
+    )
+    parser.add_argument(
+        "--keep-timestamps",
+        action="store_true",
+        help="Send payload timestamps as recorded",
+    )
+    parser.add_argument("--json", action="store_true", help="Print the report as json")
+    args = parser.parse_args()
+
+    if args.capture_dir:
+        messages = messages_from_capture(
+            args.capture_dir, charge_point_id=args.charge_point_id, action=args.action
+        )
+    else:
+        messages = (
+            message
+            for message in messages_from_events(args.events)
+            if args.charge_point_id in (None, message.charge_point_id)
+            and args.action in (None, message.action)
+        )
+    replayer = Replayer(
+        args.url,
+        speed=None if args.speed == "max" else float(args.speed),
+        clones=args.clones,
+        subprotocol=args.subprotocol,
+        timeout=args.timeout,
+        window=args.window,
+        rewrite_timestamps=not args.keep_timestamps,
+    )
+    report = asyncio.run(replayer.run(messages))
+    print(json.dumps(report.to_dict(), indent=2) if args.json else report.format())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
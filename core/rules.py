@@ -0,0 +1,381 @@
+import copy
+import fnmatch
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from core.frames import CALL, CALLERROR, CALLRESULT, Frame
+from core.sessions import DIRECTIONS
+
+MESSAGE_TYPES = {"CALL": CALL, "CALLRESULT": CALLRESULT, "CALLERROR": CALLERROR}
+EFFECTS = ("drop", "delay", "rewrite", "duplicate")
+_FIELDS = {
+    "name",
+    "charge_point_id",
+    "direction",
+    "message_type",
+    "action",
+    "match",
+    "drop",
+    "delay",
+    "set",
+    "remove",
+    "clamp",
+    "duplicate",
+}
+# Key of the rules of frames whose action no rule names or isn't known, e.g. responses to calls relayed before a
+# reconnect
+_ANY_ACTION = object()
+_MISSING = object()
+
+
+class RuleError(ValueError):
+    pass
+
+
+def _as_list(spec: dict, name: str, default):
+    value = spec.get(name)
+    if value is None:
+        return default
+    return value if isinstance(value, list) else [value]
+
+
+def _path(path: str) -> List[object]:
+    """A dotted path into a payload, e.g. `idTagInfo.status` or `meterValue.0.sampledValue`."""
+    if not isinstance(path, str) or not path:
+        raise RuleError(f"Not a payload path: {path!r}")
+    return [int(part) if part.isdigit() else part for part in path.split(".")]
+
+
+def _get(payload, path):
+    for part in path:
+        try:
+            payload = payload[part]
+        except (KeyError, IndexError, TypeError):
+            return _MISSING
+    return payload
+
+
+def _parent(payload, path, create: bool):
+    for part in path[:-1]:
+        try:
+            payload = payload[part]
+        except (KeyError, IndexError, TypeError):
+            if not create or not isinstance(payload, dict):
+                return None
+            payload[part] = {}
+            payload = payload[part]
+    return payload
+
+
+def _setter(path, value) -> Callable[[object], None]:
+    def set_(payload):
+        parent = _parent(payload, path, create=True)
+        try:
+            # Values are copied, a later rewrite of the frame mustn't change the rule
+            parent[path[-1]] = copy.deepcopy(value)
+        except (IndexError, TypeError):
+            pass
+
+    return set_
+
+
+def _remover(path) -> Callable[[object], None]:
+    def remove(payload):
+        parent = _parent(payload, path, create=False)
+        try:
+            del parent[path[-1]]
+        except (KeyError, IndexError, TypeError):
+            pass
+
+    return remove
+
+
+def _clamper(path, low, high) -> Callable[[object], None]:
+    def clamp(payload):
+        parent = _parent(payload, path, create=False)
+        try:
+            value = parent[path[-1]]
+        except (KeyError, IndexError, TypeError):
+            return
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return
+        if low is not None and value < low:
+            parent[path[-1]] = low
+        elif high is not None and value > high:
+            parent[path[-1]] = high
+
+    return clamp
+
+
+def _charge_point_matcher(patterns: List[str]) -> Callable[[str], bool]:
+    exact = {pattern for pattern in patterns if not re.search(r"[*?\[]", pattern)}
+    globbed = [pattern for pattern in patterns if pattern not in exact]
+    if not globbed:
+        return exact.__contains__
+    regex = re.compile("|".join(fnmatch.translate(pattern) for pattern in globbed))
+    return lambda charge_point_id: (
+        charge_point_id in exact or regex.match(charge_point_id) is not None
+    )
+
+
+@dataclass(eq=False)
+class Rule:
+    """A compiled rule, see RuleSet for the fields of its spec."""
+
+    name: str
+    # None matches every ChargePoint
+    charge_point_id: Optional[Callable[[str], bool]] = None
+    # (payload path, value) the payload must hold
+    conditions: List[Tuple[list, object]] = field(default_factory=list)
+    drop: bool = False
+    delay: float = 0.0
+    rewrites: List[Callable[[object], None]] = field(default_factory=list)
+    duplicate: int = 0
+
+    @classmethod
+    def compile(cls, spec: dict, index: int) -> "Rule":
+        if not isinstance(spec, dict):
+            raise RuleError(f"Rule {index} isn't an object")
+        name = str(spec.get("name") or f"rule-{index}")
+        unknown = set(spec) - _FIELDS
+        if unknown:
+            raise RuleError(
+                f"Unknown fields of rule {name}: {', '.join(sorted(unknown))}"
+            )
+        rule = cls(name)
+        try:
+            patterns = _as_list(spec, "charge_point_id", None)
+            if patterns is not None:
+                rule.charge_point_id = _charge_point_matcher(patterns)
+            rule.conditions = [
+                (_path(path), value) for path, value in spec.get("match", {}).items()
+            ]
+            for path, value in spec.get("set", {}).items():
+                rule.rewrites.append(_setter(_path(path), value))
+            for path in _as_list(spec, "remove", []):
+                rule.rewrites.append(_remover(_path(path)))
+            for path, (low, high) in spec.get("clamp", {}).items():
+                if not all(
+                    bound is None or isinstance(bound, (int, float))
+                    for bound in (low, high)
+                ):
+                    raise RuleError(f"Clamp bounds of {path} must be numbers or null")
+                rule.rewrites.append(_clamper(_path(path), low, high))
+            rule.drop = bool(spec.get("drop", False))
+            rule.delay = float(spec.get("delay", 0.0))
+            rule.duplicate = int(spec.get("duplicate", 0))
+        except (AttributeError, TypeError, ValueError) as e:
+            raise RuleError(f"Invalid rule {name}: {e}")
+        if rule.delay < 0 or rule.duplicate < 0:
+            raise RuleError(
+                f"Invalid rule {name}: delay and duplicate can't be negative"
+            )
+        if not (rule.drop or rule.delay or rule.rewrites or rule.duplicate):
+            raise RuleError(
+                f"Rule {name} does nothing, give it a drop, delay, set, remove, clamp or duplicate"
+            )
+        return rule
+
+    @property
+    def effects(self) -> List[str]:
+        return [
+            effect
+            for effect, applies in zip(
+                EFFECTS, (self.drop, self.delay, self.rewrites, self.duplicate)
+            )
+            if applies
+        ]
+
+    def matches(self, charge_point_id: str, payload) -> bool:
+        if self.charge_point_id is not None and not self.charge_point_id(
+            charge_point_id
+        ):
+            return False
+        return all(_get(payload, path) == value for path, value in self.conditions)
+
+
+@dataclass
+class Verdict:
+    """What to forward instead of a frame: `copies` times `message` (none if dropped), after `delay` seconds."""
+
+    message: object
+    copies: int = 1
+    delay: float = 0.0
+    rules: List[Rule] = field(default_factory=list)
+
+
+class RuleSet:
+    """
+    Rules patching relayed frames, compiled once into dispatch tables keyed by (direction, message type) and action.
+    A rule spec matches on `charge_point_id` (ids or globs), `direction`, `message_type` (CALL, CALLRESULT, CALLERROR)
+    and `action`, each a value or a list and all of them if left out, and on payload fields given in `match` as
+    {"<path>": <value>}. It then does any of `drop`, `delay` (seconds), `set` ({"<path>": <value>}), `remove`
+    ([<path>]), `clamp` ({"<path>": [<min>, <max>]}) and `duplicate` (extra copies). All rules matching a frame apply,
+    in the order they are given.
+    """
+
+    def __init__(self, specs: List[dict] = ()):
+        self.rules = [Rule.compile(spec, index) for index, spec in enumerate(specs)]
+        tables: Dict[Tuple[str, int], Dict[object, List[Rule]]] = {}
+        for spec, rule in zip(specs, self.rules):
+            directions = _as_list(spec, "direction", list(DIRECTIONS))
+            message_types = _as_list(spec, "message_type", list(MESSAGE_TYPES))
+            actions = _as_list(spec, "action", [_ANY_ACTION])
+            for direction in directions:
+                if not isinstance(direction, str) or direction not in DIRECTIONS:
+                    raise RuleError(
+                        f"Unknown direction of rule {rule.name}: {direction}"
+                    )
+                for message_type in message_types:
+                    if (
+                        not isinstance(message_type, str)
+                        or message_type not in MESSAGE_TYPES
+                    ):
+                        raise RuleError(
+                            f"Unknown message type of rule {rule.name}: {message_type}"
+                        )
+                    table = tables.setdefault(
+                        (direction, MESSAGE_TYPES[message_type]), {}
+                    )
+                    for action in actions:
+                        if action is not _ANY_ACTION and not isinstance(action, str):
+                            raise RuleError(
+                                f"Not an action of rule {rule.name}: {action!r}"
+                            )
+                        table.setdefault(action, []).append(rule)
+        # Rules without an action are merged into the list of every action in rule order, so a frame only ever
+        # looks up the list of its action, or that of _ANY_ACTION for actions no rule names
+        self._tables: Dict[Tuple[str, int], Dict[object, Tuple[Rule, ...]]] = {}
+        for key, table in tables.items():
+            any_action = table.get(_ANY_ACTION, [])
+            self._tables[key] = {
+                action: tuple(sorted({*rules, *any_action}, key=self.rules.index))
+                for action, rules in table.items()
+            }
+
+    def lookup(self, direction: str, message_type: int, action) -> Tuple[Rule, ...]:
+        table = self._tables.get((direction, message_type))
+        if table is None:
+            return ()
+        rules = table.get(action)
+        if rules is None:
+            return table.get(_ANY_ACTION, ())
+        return rules
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+
+class RuleEngine:
+    """
+    Applies a RuleSet to the frames a relay forwards, reloaded from its JSON file when the file changes. A reload
+    swaps the compiled rules between two frames, sessions carry on; a file that doesn't compile keeps the previous
+    rules in place.
+    """
+
+    def __init__(self, path: Optional[str] = None, rules: Optional[RuleSet] = None):
+        self.path = path
+        self.logger = logging.getLogger(RuleEngine.__qualname__)
+        self.rules = rules or RuleSet()
+        self.reloads = 0
+        self.reload_errors = 0
+        # (rule name, effect) -> frames the rule applied to
+        self.applied: Dict[Tuple[str, str], int] = {}
+        self._mtime = None
+        if path is not None:
+            # Taken before loading, a change while loading is picked up by the next reload
+            self._mtime = self._modified(path)
+            self.rules = self.load(path)
+
+    @staticmethod
+    def _modified(path: str) -> Optional[int]:
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    @staticmethod
+    def load(path: str) -> RuleSet:
+        try:
+            with open(path) as f:
+                specs = json.load(f)
+        except (OSError, ValueError) as e:
+            raise RuleError(f"Cannot read the rules file {path}: {e}")
+        if isinstance(specs, dict):
+            specs = specs.get("rules")
+        if not isinstance(specs, list):
+            raise RuleError(f"The rules file {path} must hold a list of rules")
+        return RuleSet(specs)
+
+    def reload(self) -> bool:
+        """Recompiles the rules if their file changed since they were loaded, returns whether they were swapped."""
+        mtime = self._modified(self.path)
+        if mtime is None or mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        try:
+            rules = self.load(self.path)
+        except RuleError as e:
+            self.reload_errors += 1
+            self.logger.error(f"Keeping the previous {len(self.rules)} rules: {e}")
+            return False
+        self.rules = rules
+        self.reloads += 1
+        self.logger.info(f"Reloaded {len(rules)} rules from {self.path}")
+        return True
+
+    def apply(
+        self, charge_point_id: str, direction: str, frame: Frame, action, message
+    ) -> Optional[Verdict]:
+        """The verdict of the rules on a frame about to be forwarded, None if no rule applies."""
+        rules = self.rules.lookup(direction, frame.message_type, action or _ANY_ACTION)
+        if not rules:
+            return None
+        # The payload is only decoded for rules of the frame's kind, and as a copy the other consumers don't see
+        frame_json = None
+        verdict = Verdict(message)
+        for rule in rules:
+            if (rule.conditions or rule.rewrites) and frame_json is None:
+                try:
+                    frame_json = json.loads(frame.raw)
+                except ValueError:
+                    # Relayed as is, like any frame whose payload the relay can't decode
+                    return None
+            if not rule.matches(
+                charge_point_id, frame_json[-1] if frame_json else None
+            ):
+                continue
+            verdict.rules.append(rule)
+            for effect in ["drop"] if rule.drop else rule.effects:
+                key = (rule.name, effect)
+                self.applied[key] = self.applied.get(key, 0) + 1
+            if rule.drop:
+                verdict.copies = 0
+                return verdict
+            verdict.delay += rule.delay
+            verdict.copies += rule.duplicate
+            if rule.rewrites:
+                for rewrite in rule.rewrites:
+                    rewrite(frame_json[-1])
+                verdict.message = None
+        if not verdict.rules:
+            return None
+        if verdict.message is None:
+            verdict.message = json.dumps(
+                frame_json, separators=(",", ":"), ensure_ascii=False
+            )
+            if isinstance(message, bytes):
+                verdict.message = verdict.message.encode()
+        return verdict
+
+    def stats(self) -> dict:
+        return {
+            "rules": len(self.rules),
+            "reloads": self.reloads,
+            "reload_errors": self.reload_errors,
+            "applied": dict(self.applied),
+        }
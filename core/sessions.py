@@ -0,0 +1,88 @@
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, Optional, Union
+
+DIRECTIONS = ("csms-cp", "cp-csms")
+OPPOSITE_DIRECTIONS = {"csms-cp": "cp-csms", "cp-csms": "csms-cp"}
+
+
+@dataclass(eq=False)
+class ChargePointSession:
+    charge_point_id: str
+    cp_ws: object
+    ws_subprotocol: str
+    csms_ws: object = None
+    upstream_timings: object = None
+    connected_at: float = field(default_factory=time.time)
+    # core.correlation.CallCorrelator of the session's calls
+    calls: object = None
+    # direction -> core.links.OutboundLink, once both legs are connected
+    links: Dict[str, object] = field(default_factory=dict)
+    # leg -> core.compression.CompressionStats, for the legs that negotiated permessage-deflate
+    compression: Dict[str, object] = field(default_factory=dict)
+
+    def __post_init__(self):
+        # The UI envelope prefixes are built once per session, so wrapping a relayed frame is a plain concatenation
+        self._envelope_prefixes = {
+            direction: (
+                '{"event": "Message", "payload": {"charge_point_id": '
+                f'{json.dumps(self.charge_point_id)}, "direction": "{direction}", "message": '
+            )
+            for direction in DIRECTIONS
+        }
+
+    def envelope(self, message: Union[str, bytes], direction: str) -> str:
+        if isinstance(message, bytes):
+            # Binary frames are relayed as is, the UI gets them as text like Frame.parse reads them
+            message = message.decode("utf-8", "replace")
+        return self._envelope_prefixes[direction] + message + "}}"
+
+    def target(self, direction: str):
+        if direction == "csms-cp":
+            return self.cp_ws
+        elif direction == "cp-csms":
+            return self.csms_ws
+        raise ValueError(f"Unknown injection direction: {direction}")
+
+
+class SessionRegistry:
+    def __init__(self):
+        self._sessions: Dict[str, ChargePointSession] = {}
+
+    def register(self, session: ChargePointSession) -> Optional[ChargePointSession]:
+        previous = self._sessions.get(session.charge_point_id)
+        self._sessions[session.charge_point_id] = session
+        return previous
+
+    def unregister(self, session: ChargePointSession) -> bool:
+        # A reconnecting CP may already have replaced this session, in which case the newer one is kept
+        if self._sessions.get(session.charge_point_id) is session:
+            del self._sessions[session.charge_point_id]
+            return True
+        return False
+
+    def get(self, charge_point_id: str) -> Optional[ChargePointSession]:
+        return self._sessions.get(charge_point_id)
+
+    def resolve(
+        self, charge_point_id: Optional[str] = None
+    ) -> Optional[ChargePointSession]:
+        if charge_point_id:
+            return self._sessions.get(charge_point_id)
+        # Without an explicit target, only an unambiguous (single) session can be resolved
+        if len(self._sessions) == 1:
+            return next(iter(self._sessions.values()))
+        return None
+
+    def ids(self):
+        return list(self._sessions.keys())
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __iter__(self) -> Iterator[ChargePointSession]:
+        return iter(list(self._sessions.values()))
+
+    def __contains__(self, charge_point_id: str) -> bool:
+        return charge_point_id in self._sessions
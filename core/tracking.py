@@ -0,0 +1,83 @@
+import collections
+import time
+from typing import Callable, Tuple
+
+InjectionKey = Tuple[str, str, str]
+
+
+class InjectedMessageTracker:
+    """Injected CALLs awaiting their CALLRESULT/CALLERROR, keyed by (charge point, direction, message id)."""
+
+    def __init__(self, ttl: float = 300.0, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.injected = 0
+        self.completed = 0
+        self.expired = 0
+        self.discarded = 0
+        # Insertion order equals deadline order (constant TTL), so expiry only ever looks at the oldest entries
+        self._deadlines: "collections.OrderedDict[InjectionKey, float]" = (
+            collections.OrderedDict()
+        )
+
+    def add(self, charge_point_id: str, direction: str, message_id: str):
+        self.expire()
+        key = (charge_point_id, direction, message_id)
+        self._deadlines.pop(key, None)
+        self._deadlines[key] = self.clock() + self.ttl
+        self.injected += 1
+
+    def is_pending(self, charge_point_id: str, direction: str, message_id: str) -> bool:
+        deadline = self._deadlines.get((charge_point_id, direction, message_id))
+        return deadline is not None and deadline > self.clock()
+
+    def complete(self, charge_point_id: str, direction: str, message_id: str) -> bool:
+        deadline = self._deadlines.pop((charge_point_id, direction, message_id), None)
+        if deadline is None:
+            return False
+        if deadline <= self.clock():
+            self.expired += 1
+            return False
+        self.completed += 1
+        return True
+
+    def discard(self, charge_point_id: str, direction: str, message_id: str) -> bool:
+        """Forgets an injected CALL that couldn't be sent after all."""
+        if self._deadlines.pop((charge_point_id, direction, message_id), None) is None:
+            return False
+        self.discarded += 1
+        return True
+
+    def expire(self) -> int:
+        now, expired = self.clock(), 0
+        while self._deadlines:
+            key, deadline = next(iter(self._deadlines.items()))
+            if deadline > now:
+                break
+            del self._deadlines[key]
+            expired += 1
+        self.expired += expired
+        return expired
+
+    def discard_charge_point(self, charge_point_id: str) -> int:
+        keys = [key for key in self._deadlines if key[0] == charge_point_id]
+        for key in keys:
+            del self._deadlines[key]
+        return len(keys)
+
+    @property
+    def pending(self) -> int:
+        self.expire()
+        return len(self._deadlines)
+
+    def __len__(self) -> int:
+        return self.pending
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "injected": self.injected,
+            "completed": self.completed,
+            "expired": self.expired,
+            "discarded": self.discarded,
+        }
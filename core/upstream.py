@@ -0,0 +1,250 @@
+import asyncio
+import collections
+import logging
+import socket
+import ssl
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import websockets
+from websockets.legacy.client import WebSocketClientProtocol
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """SSLContext that offers the last TLS session of a server whenever a new connection to it is wrapped."""
+
+    def _remembered_sessions(self) -> Dict[str, ssl.SSLSession]:
+        if not hasattr(self, "_sessions"):
+            self._sessions = {}
+        return self._sessions
+
+    def remember(self, server_hostname: str, session: Optional[ssl.SSLSession]):
+        if session is not None:
+            self._remembered_sessions()[server_hostname] = session
+
+    def forget(self, server_hostname: str):
+        self._remembered_sessions().pop(server_hostname, None)
+
+    def wrap_bio(
+        self,
+        incoming,
+        outgoing,
+        server_side=False,
+        server_hostname=None,
+        session=None,
+    ):
+        # asyncio's SSL transport wraps every connection through here, but has no way to pass a session
+        if session is None and not server_side:
+            session = self._remembered_sessions().get(server_hostname)
+        return super().wrap_bio(
+            incoming,
+            outgoing,
+            server_side=server_side,
+            server_hostname=server_hostname,
+            session=session,
+        )
+
+
+def create_upstream_ssl_context(cafile: Optional[str] = None) -> ResumingSSLContext:
+    context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if cafile:
+        context.load_verify_locations(cafile=cafile)
+    else:
+        context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+    return context
+
+
+class DnsCache:
+    def __init__(self, ttl: float = 60.0):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[Tuple[str, int], Tuple[float, List]] = {}
+        self._inflight: Dict[Tuple[str, int], asyncio.Future] = {}
+
+    async def resolve(self, host: str, port: int) -> List:
+        key = (host, port)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+
+        # When a whole site reconnects at once, all ChargePoints share a single lookup
+        if key in self._inflight:
+            self.hits += 1
+            return await asyncio.shield(self._inflight[key])
+
+        self.misses += 1
+        lookup = asyncio.ensure_future(
+            asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        )
+        self._inflight[key] = lookup
+        try:
+            addresses = await asyncio.shield(lookup)
+        finally:
+            del self._inflight[key]
+        self._entries[key] = (time.monotonic() + self.ttl, addresses)
+        return addresses
+
+    def invalidate(self, host: str, port: int):
+        self._entries.pop((host, port), None)
+
+
+@dataclass
+class ConnectTimings:
+    url: str
+    address: str = ""
+    dns: float = 0.0
+    tcp: float = 0.0
+    tls: float = 0.0
+    upgrade: float = 0.0
+    total: float = 0.0
+    tls_resumed: bool = False
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class TimedClientProtocol(WebSocketClientProtocol):
+    def connection_made(self, transport):
+        # For wss:// this is only called once the TLS handshake has completed
+        self.transport_ready_at = time.perf_counter()
+        super().connection_made(transport)
+
+
+class UpstreamConnector:
+    """Opens the CSMS facing connections of one upstream, sharing its SSLContext, TLS sessions and DNS results."""
+
+    def __init__(
+        self,
+        base_url: str,
+        dns_ttl: float = 60.0,
+        cafile: Optional[str] = None,
+        history: int = 1024,
+    ):
+        self.base_url = base_url.rstrip("/")
+        url = urlsplit(self.base_url)
+        self.secure = url.scheme == "wss"
+        self.host = url.hostname
+        self.port = url.port or (443 if self.secure else 80)
+        self.ssl_context = create_upstream_ssl_context(cafile) if self.secure else None
+        self.dns = DnsCache(ttl=dns_ttl)
+        self.connections = 0
+        self.failures = 0
+        self.tls_resumed = 0
+        self.timings = collections.deque(maxlen=history)
+        self.logger = logging.getLogger(UpstreamConnector.__qualname__)
+
+    async def _open_socket(self, addresses) -> socket.socket:
+        loop = asyncio.get_running_loop()
+        last_error = None
+        for family, type_, proto, _, address in addresses:
+            sock = socket.socket(family, type_, proto)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, address)
+            except OSError as e:
+                sock.close()
+                last_error = e
+                continue
+            except asyncio.CancelledError:
+                # Timed out, see connect()
+                sock.close()
+                raise
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+        raise last_error or OSError(f"No address to connect to for {self.host}")
+
+    async def connect(
+        self, path: str, open_timeout: Optional[float] = 10, **connect_kwargs
+    ):
+        """
+        Connects to the upstream's `path`. `open_timeout` bounds the whole of it, resolving, connecting and the
+        (TLS and) websocket handshake, an unreachable CSMS fails with asyncio.TimeoutError.
+        """
+        url = f"{self.base_url}/{path}"
+        timings = ConnectTimings(url=url)
+        started = time.perf_counter()
+
+        def remaining():
+            if open_timeout is None:
+                return None
+            return max(open_timeout - (time.perf_counter() - started), 0)
+
+        try:
+            addresses = await asyncio.wait_for(
+                self.dns.resolve(self.host, self.port), remaining()
+            )
+            resolved = time.perf_counter()
+            try:
+                sock = await asyncio.wait_for(self._open_socket(addresses), remaining())
+            except OSError:
+                self.dns.invalidate(self.host, self.port)
+                raise
+            connected = time.perf_counter()
+            timings.address = str(sock.getpeername()[0])
+            handshake = None
+            try:
+                handshake = asyncio.ensure_future(
+                    websockets.connect(
+                        url,
+                        sock=sock,
+                        ssl=self.ssl_context,
+                        create_protocol=TimedClientProtocol,
+                        open_timeout=remaining(),
+                        **connect_kwargs,
+                    )
+                )
+                if not (await asyncio.wait({handshake}, timeout=remaining()))[0]:
+                    # After a failed handshake, websockets waits for the CSMS to close the connection for up to
+                    # close_timeout, which a CSMS that doesn't answer never does
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                ws = await handshake
+            except BaseException:
+                if handshake is not None:
+                    handshake.cancel()
+                sock.close()
+                raise
+        except Exception:
+            self.failures += 1
+            raise
+        upgraded = time.perf_counter()
+
+        timings.dns = resolved - started
+        timings.tcp = connected - resolved
+        if self.secure:
+            timings.tls = ws.transport_ready_at - connected
+            ssl_object = ws.transport.get_extra_info("ssl_object")
+            timings.tls_resumed = bool(ssl_object and ssl_object.session_reused)
+            self.remember_session(ws)
+        timings.upgrade = upgraded - (
+            ws.transport_ready_at if self.secure else connected
+        )
+        timings.total = upgraded - started
+        self.connections += 1
+        self.tls_resumed += timings.tls_resumed
+        self.timings.append(timings)
+        return ws, timings
+
+    def remember_session(self, ws):
+        # TLS 1.3 tickets arrive after the handshake, so this is also called once the connection is done
+        if self.secure and ws.transport is not None:
+            ssl_object = ws.transport.get_extra_info("ssl_object")
+            if ssl_object is not None:
+                self.ssl_context.remember(self.host, ssl_object.session)
+
+    def stats(self) -> dict:
+        return {
+            "url": self.base_url,
+            "connections": self.connections,
+            "failures": self.failures,
+            "tls_resumed": self.tls_resumed,
+            "dns_hits": self.dns.hits,
+            "dns_misses": self.dns.misses,
+            "recent": [timings.to_dict() for timings in list(self.timings)[-10:]],
+        }
@@ -0,0 +1,199 @@
+import asyncio
+import decimal
+import functools
+import json
+import logging
+import multiprocessing
+import zlib
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from core.frames import CALL, CALLRESULT, Frame
+
+# OCPP version of the schemas per websocket subprotocol
+SCHEMA_VERSIONS = {"ocpp1.6": "1.6", "ocpp2.0": "2.0", "ocpp2.0.1": "2.0.1"}
+# Errors reported per frame, the first ones are enough to tell what is wrong
+MAX_ERRORS = 5
+
+# OCPP 1.6 schemas with a multipleOf on floats, validated with decimals like the ocpp package does
+_DECIMAL_SCHEMAS = {
+    ("1.6", CALL, "SetChargingProfile"),
+    ("1.6", CALL, "RemoteStartTransaction"),
+    ("1.6", CALLRESULT, "GetCompositeSchedule"),
+}
+
+
+@dataclass
+class ValidationConfig:
+    # Share of the frames of an action that is validated, e.g. {"MeterValues": 0.1}, others use default_rate
+    sample_rates: Dict[str, float] = field(default_factory=dict)
+    default_rate: float = 1.0
+    workers: int = 1
+    flush_interval: float = 0.1
+    max_buffered: int = 50_000
+
+
+def _float_parser(version: str, message_type: int, action: str):
+    if (version, message_type, action) in _DECIMAL_SCHEMAS:
+        return decimal.Decimal
+    return float
+
+
+@functools.lru_cache(maxsize=None)
+def _validator(version: str, message_type: int, action: str):
+    """The compiled schema validator of a frame kind, None for actions without a schema. Cached per process."""
+    # The ocpp package pulls in jsonschema, only imported once there is something to validate
+    from ocpp.messages import get_validator
+
+    try:
+        return get_validator(
+            message_type,
+            action,
+            version,
+            parse_float=_float_parser(version, message_type, action),
+        )
+    except (OSError, ValueError):
+        return None
+
+
+def validate_frame(
+    version: str, message_type: int, action: str, raw
+) -> Optional[List[str]]:
+    """Schema violations of a frame, empty if it is valid and None if there is no schema to validate it with."""
+    validator = _validator(version, message_type, action)
+    if validator is None:
+        return None
+    try:
+        payload = json.loads(
+            raw, parse_float=_float_parser(version, message_type, action)
+        )[-1]
+    except (ValueError, IndexError) as e:
+        return [f"Not a valid JSON frame: {e}"]
+    errors = []
+    for error in validator.iter_errors(payload):
+        path = "/".join(str(part) for part in error.absolute_path)
+        errors.append(f"{path or '(payload)'}: {error.message}")
+        if len(errors) == MAX_ERRORS:
+            break
+    return errors
+
+
+def validate_batch(batch) -> List[Tuple[int, Optional[List[str]]]]:
+    """Runs in the pool, returns (index, errors) of the frames in the batch that aren't valid or have no schema."""
+    results = []
+    for index, (version, message_type, action, raw) in enumerate(batch):
+        errors = validate_frame(version, message_type, action, raw)
+        if errors is None or errors:
+            results.append((index, errors))
+    return results
+
+
+class FrameValidator:
+    """
+    Validates sampled frames against the OCPP schemas of their subprotocol. Submitting only appends the raw frame to a
+    buffer, frames are decoded and validated in batches by a pool of processes, so forwarding is never delayed by it.
+    Violations are reported through `on_violation(context, errors)` on the event loop.
+    """
+
+    def __init__(
+        self,
+        config: ValidationConfig,
+        on_violation: Callable[[object, List[str]], None],
+    ):
+        self.config = config
+        self.on_violation = on_violation
+        self.logger = logging.getLogger(FrameValidator.__qualname__)
+        self.validated = 0
+        self.violations = 0
+        self.sampled_out = 0
+        self.without_schema = 0
+        self.dropped = 0
+        self._buffer: List[Tuple[Tuple[str, int, str, object], object]] = []
+        self._flusher: Optional[asyncio.Task] = None
+        self._pool: Optional[Executor] = None
+
+    def _create_pool(self) -> Executor:
+        # Relay workers are daemon processes which can't have children, their validation runs on threads instead
+        if multiprocessing.current_process().daemon:
+            return ThreadPoolExecutor(
+                max_workers=self.config.workers, thread_name_prefix="Validate"
+            )
+        return ProcessPoolExecutor(
+            max_workers=self.config.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def sampled(self, action: str, message_id: str) -> bool:
+        rate = self.config.sample_rates.get(action, self.config.default_rate)
+        if rate >= 1.0:
+            return True
+        # Decided by the message id, so a sampled CALL gets its response validated as well
+        return zlib.crc32(message_id.encode()) % 10_000 < rate * 10_000
+
+    def submit(self, subprotocol: str, frame: Frame, action: str, context):
+        version = SCHEMA_VERSIONS.get(subprotocol)
+        if version is None or frame.message_type not in (CALL, CALLRESULT):
+            return
+        if not self.sampled(action, frame.message_id):
+            self.sampled_out += 1
+            return
+        if len(self._buffer) >= self.config.max_buffered:
+            # Validation falls behind rather than slowing down relaying
+            self.dropped += 1
+            return
+        self._buffer.append(((version, frame.message_type, action, frame.raw), context))
+        if self._flusher is None:
+            self._flusher = asyncio.get_running_loop().create_task(self._run())
+
+    async def flush(self):
+        batch, self._buffer = self._buffer, []
+        if not batch:
+            return
+        if self._pool is None:
+            self._pool = self._create_pool()
+        loop = asyncio.get_running_loop()
+        chunk = -(-len(batch) // self.config.workers)
+        chunks = [batch[i : i + chunk] for i in range(0, len(batch), chunk)]
+        results = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    self._pool, validate_batch, [frame for frame, _ in frames]
+                )
+                for frames in chunks
+            )
+        )
+        self.validated += len(batch)
+        for frames, violations in zip(chunks, results):
+            for index, errors in violations:
+                if errors is None:
+                    self.without_schema += 1
+                    continue
+                self.violations += 1
+                self.on_violation(frames[index][1], errors)
+
+    async def _run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.config.flush_interval)
+                await self.flush()
+        except Exception:
+            self.logger.exception("Validating frames failed")
+            raise
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self._buffer),
+            "validated": self.validated,
+            "violations": self.violations,
+            "sampled_out": self.sampled_out,
+            "without_schema": self.without_schema,
+            "dropped": self.dropped,
+        }
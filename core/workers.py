@@ -0,0 +1,691 @@
+import asyncio
+import base64
+import collections
+import contextlib
+import functools
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import websockets
+from websockets.extensions.permessage_deflate import enable_server_permessage_deflate
+from websockets.legacy.server import WebSocketServerProtocol
+
+from core import injection, metrics
+from core.bus import EventBus, OverflowPolicy, stream_subscription
+from core.campaigns import CampaignError, CampaignReport, CampaignSpec
+
+# Worker → supervisor event stream records: <length><charge point id>\0<serialized event>
+_EVENT_HEADER = struct.Struct(">I")
+_MAX_REQUEST_LINE = 8192
+_EVENT_BUFFER_LIMIT = 4 * 2**20
+
+
+def shard_for(charge_point_id: str, workers: int) -> int:
+    # Stable across processes and restarts, unlike hash() which is salted per interpreter
+    return zlib.crc32(charge_point_id.encode()) % workers
+
+
+def worker_socket_path(supervisor_pid: int, index: int) -> str:
+    return os.path.join(
+        tempfile.gettempdir(), f"ocpp-relay-{supervisor_pid}-worker{index}.sock"
+    )
+
+
+def parse_route(path: str):
+    """
+    Returns (kind, charge point id, query) for a websocket request path, the routing of both WebSocketRelay.on_connect
+    and the supervisor. Only the first segment tells the kind, any other path is a ChargePoint's id.
+    """
+    url = urlsplit(path)
+    query = parse_qs(url.query)
+    segments = url.path.strip("/").split("/")
+    if segments[0] == "streamlit":
+        return "streamlit", query.get("charge_point_id", [None])[0], query
+    elif segments == ["metrics"]:
+        return "metrics", None, query
+    elif segments == ["inject"]:
+        return "injection", None, query
+    elif segments == ["transactions"]:
+        return "transactions", query.get("charge_point_id", [None])[0], query
+    elif segments[0] == "inject":
+        # /inject/<direction>[/<charge_point_id>]
+        return "inject", "/".join(segments[2:]) or None, query
+    return "charge_point", url.path.strip("/"), query
+
+
+class AcceptedConnections:
+    """Runs the websocket handshake on sockets that were accepted by another process."""
+
+    def __init__(self, handler, **serve_options):
+        self.handler = handler
+        self.serve_options = serve_options
+        self.ws_server = None
+        self._factory = None
+
+    async def start(self, path: str):
+        # Handed over connections register with the WebSocketServer of a private unix endpoint,
+        # which also gives direct access to this process
+        if os.path.exists(path):
+            os.unlink(path)
+        self.ws_server = await websockets.unix_serve(
+            self.handler, path=path, **self.serve_options
+        )
+        options = dict(self.serve_options)
+        create_protocol = options.pop("create_protocol", WebSocketServerProtocol)
+        compression = options.pop("compression", "deflate")
+        extensions = options.pop("extensions", None)
+        if compression == "deflate":
+            extensions = enable_server_permessage_deflate(extensions)
+        self._factory = functools.partial(
+            create_protocol,
+            self.handler,
+            self.ws_server,
+            extensions=extensions,
+            **options,
+        )
+
+    async def serve(self, sock: socket.socket):
+        await asyncio.get_running_loop().connect_accepted_socket(self._factory, sock)
+
+
+class RelayWorker:
+    def __init__(self, index, relay, handoff: socket.socket, events: socket.socket):
+        self.index = index
+        self.relay = relay
+        self.handoff = handoff
+        self.events = events
+        self.logger = logging.getLogger(RelayWorker.__qualname__)
+        relay.metrics_labels = {"worker": str(index)}
+        self.connections = AcceptedConnections(
+            relay.on_connect, **relay.serve_options()
+        )
+        self._forwarder: Optional[asyncio.Task] = None
+        self._events_writer = None
+        self._stopped = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._stopped = loop.create_future()
+        path = worker_socket_path(os.getppid(), self.index)
+        await self.connections.start(path)
+        _, self._events_writer = await asyncio.open_unix_connection(sock=self.events)
+        self.handoff.setblocking(False)
+        loop.add_reader(self.handoff.fileno(), self._on_handoff)
+        # Sent by multiprocessing when the supervisor exits, the relay still flushes its capture
+        loop.add_signal_handler(signal.SIGTERM, self._stop)
+        self.logger.info(f"Relay worker {self.index} ready (local endpoint: {path})")
+        try:
+            await self._stopped
+        finally:
+            loop.remove_reader(self.handoff.fileno())
+            self.connections.ws_server.close()
+            await self.connections.ws_server.wait_closed()
+            await self.relay.close()
+
+    def _on_handoff(self):
+        try:
+            message, fds, _, _ = socket.recv_fds(self.handoff, 65536, 1)
+        except BlockingIOError:
+            return
+        if not message:
+            self.logger.info(
+                f"Supervisor went away, stopping relay worker {self.index}"
+            )
+            self._stop()
+            return
+
+        control = json.loads(message)
+        if control["type"] == "connection":
+            sock = socket.socket(fileno=fds[0])
+            asyncio.create_task(self.connections.serve(sock))
+        elif control["type"] == "configure":
+            self.relay.configure(control["csms_info"])
+        elif control["type"] == "subscribers":
+            self._set_forwarding(control["count"] > 0)
+
+    def _stop(self):
+        if not self._stopped.done():
+            self._stopped.set_result(None)
+
+    def _set_forwarding(self, enabled: bool):
+        if enabled and self._forwarder is None:
+            self._forwarder = asyncio.create_task(self._forward_events())
+        elif not enabled and self._forwarder is not None:
+            self._forwarder.cancel()
+            self._forwarder = None
+
+    async def _forward_events(self):
+        # Only runs while the supervisor has UI subscribers, a slow supervisor only ever loses the oldest events
+        subscription = self.relay.bus.subscribe(OverflowPolicy.DROP_OLDEST)
+        try:
+            while True:
+                for charge_point_id, message in await subscription.get_entries():
+                    record = f"{charge_point_id or ''}\0{message}".encode()
+                    self._events_writer.write(_EVENT_HEADER.pack(len(record)) + record)
+                if (
+                    self._events_writer.transport.get_write_buffer_size()
+                    > _EVENT_BUFFER_LIMIT
+                ):
+                    await self._events_writer.drain()
+        finally:
+            subscription.close()
+
+
+def _run_worker(index, relay_factory, handoff, events, inherited_fds):
+    # Supervisor side sockets inherited through fork would keep the listener bound and hide the supervisor's exit
+    for fd in inherited_fds:
+        os.close(fd)
+    threading.current_thread().name = f"Worker{index}"
+    worker = RelayWorker(index, relay_factory(), handoff, events)
+    try:
+        asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        pass
+
+
+@dataclass
+class WorkerHandle:
+    index: int
+    process: multiprocessing.Process
+    handoff: socket.socket
+    events: socket.socket
+    reader: Optional[asyncio.Task] = None
+
+
+class RelaySupervisor:
+    """
+    Front acceptor for a pool of relay worker processes. It only reads the HTTP request line of a new connection,
+    picks the worker owning the ChargePoint and hands the socket over, relayed frames never pass through it.
+    UI subscriptions without a ChargePoint are served here from the events of all workers.
+    """
+
+    def __init__(
+        self,
+        relay_factory: Callable,
+        port: int,
+        workers: int,
+        host: str = "0.0.0.0",
+        bus_capacity: int = 4096,
+        csms_info: Optional[dict] = None,
+        metrics: bool = True,
+    ):
+        self.relay_factory = relay_factory
+        self.host, self.port = host, port
+        self.bus = EventBus(capacity=bus_capacity)
+        # Given by the relay's configuration, UIs can't change it then
+        self.csms_info = csms_info
+        self.csms_configured = csms_info is not None
+        self.serve_metrics = metrics
+        self.logger = logging.getLogger(RelaySupervisor.__qualname__)
+        self._context = multiprocessing.get_context("fork")
+        self._workers = [None] * workers
+        self._restarts = 0
+        self._ui_subscribers = 0
+        self._listener = None
+        self._ui_connections = AcceptedConnections(self._on_ui_connect)
+        # Injection channels of clients are multiplexed onto one channel per worker, with tags rewritten
+        self._worker_channels = {}
+        self._injection_tags = itertools.count()
+        self._injections = {}
+
+    def _spawn(self, index) -> WorkerHandle:
+        handoff, worker_handoff = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_SEQPACKET
+        )
+        events, worker_events = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        process = self._context.Process(
+            target=_run_worker,
+            args=(
+                index,
+                self.relay_factory,
+                worker_handoff,
+                worker_events,
+                self._supervisor_fds() + [handoff.fileno(), events.fileno()],
+            ),
+            name=f"relay-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        worker_handoff.close()
+        worker_events.close()
+        handoff.settimeout(1.0)
+        self.logger.info(f"Started relay worker {index} (pid {process.pid})")
+        return WorkerHandle(index, process, handoff, events)
+
+    def _supervisor_fds(self):
+        fds = [self._listener.fileno()] if self._listener is not None else []
+        for worker in self._workers:
+            if worker is not None:
+                fds += [worker.handoff.fileno(), worker.events.fileno()]
+        return [fd for fd in fds if fd >= 0]
+
+    def _send_control(self, worker: WorkerHandle, control: dict, fds=()):
+        socket.send_fds(worker.handoff, [json.dumps(control).encode()], list(fds))
+
+    def _broadcast(self, control: dict):
+        for worker in self._workers:
+            try:
+                self._send_control(worker, control)
+            except OSError as e:
+                self.logger.error(
+                    f"Control message to worker {worker.index} failed: {e}"
+                )
+
+    def _configure(self, csms_info):
+        if csms_info != self.csms_info:
+            self.csms_info = csms_info
+            self._broadcast({"type": "configure", "csms_info": csms_info})
+
+    async def _read_worker_events(self, worker: WorkerHandle):
+        reader, _ = await asyncio.open_unix_connection(sock=worker.events)
+        try:
+            while True:
+                header = await reader.readexactly(_EVENT_HEADER.size)
+                record = await reader.readexactly(_EVENT_HEADER.unpack(header)[0])
+                charge_point_id, message = record.decode().split("\0", 1)
+                self.bus.publish(message, charge_point_id or None)
+        except asyncio.IncompleteReadError:
+            self.logger.warning(f"Event stream of worker {worker.index} closed")
+
+    async def _start_worker(self, index):
+        worker = self._workers[index] = self._spawn(index)
+        worker.reader = asyncio.create_task(self._read_worker_events(worker))
+        if self.csms_info is not None:
+            self._send_control(
+                worker, {"type": "configure", "csms_info": self.csms_info}
+            )
+        if self._ui_subscribers:
+            self._send_control(worker, {"type": "subscribers", "count": 1})
+
+    async def _watch_workers(self):
+        while True:
+            await asyncio.sleep(1)
+            for worker in self._workers:
+                if not worker.process.is_alive():
+                    self.logger.error(
+                        f"Relay worker {worker.index} exited with {worker.process.exitcode}, restarting it"
+                    )
+                    self._restarts += 1
+                    worker.reader.cancel()
+                    worker.handoff.close()
+                    worker.events.close()
+                    await self._start_worker(worker.index)
+
+    async def _on_ui_connect(self, ws, path):
+        kind, _, query = parse_route(path)
+        if kind == "injection":
+            return await self._serve_injection_channel(ws)
+        subscription = self.bus.subscribe(query.get("overflow", [None])[0])
+        self._ui_subscribers += 1
+        if self._ui_subscribers == 1:
+            self._broadcast({"type": "subscribers", "count": 1})
+        try:
+            await stream_subscription(ws, subscription, self.logger)
+        finally:
+            self._ui_subscribers -= 1
+            if self._ui_subscribers == 0:
+                self._broadcast({"type": "subscribers", "count": 0})
+
+    async def _connect_worker_channel(self, index):
+        channel = await websockets.unix_connect(
+            worker_socket_path(os.getpid(), index),
+            "ws://localhost/inject",
+            max_queue=None,
+        )
+        asyncio.create_task(self._read_injection_replies(index, channel))
+        return channel
+
+    async def _worker_channel(self, index):
+        # Shared by the clients that inject concurrently while it is being opened
+        channel = self._worker_channels.get(index)
+        if channel is None or (channel.done() and channel.result().closed):
+            channel = self._worker_channels[index] = asyncio.ensure_future(
+                self._connect_worker_channel(index)
+            )
+        try:
+            return await asyncio.shield(channel)
+        except OSError:
+            self._worker_channels.pop(index, None)
+            raise
+
+    async def _read_injection_replies(self, index, channel):
+        try:
+            async for text in channel:
+                reply = json.loads(text)
+                future, _ = self._injections.pop(reply["tag"], (None, None))
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.logger.warning(f"Injection channel of worker {index} closed")
+            for tag, (future, worker) in list(self._injections.items()):
+                if worker == index:
+                    del self._injections[tag]
+                    future.set_result(
+                        json.loads(
+                            injection.reply(
+                                None,
+                                None,
+                                None,
+                                None,
+                                "closed",
+                                reason="Relay worker restarted",
+                            )
+                        )
+                    )
+
+    async def _forward_injection(self, index, request: dict) -> dict:
+        """Sends a request on the channel of a worker, returns the worker's reply."""
+        tag = next(self._injection_tags)
+        future = asyncio.get_running_loop().create_future()
+        self._injections[tag] = (future, index)
+        try:
+            channel = await self._worker_channel(index)
+            await channel.send(json.dumps({**request, "tag": tag}))
+            return await future
+        except (OSError, websockets.exceptions.ConnectionClosed) as e:
+            return json.loads(
+                injection.reply(
+                    None,
+                    request.get("charge_point_id"),
+                    request.get("direction"),
+                    None,
+                    injection.REJECTED,
+                    reason=f"Relay worker unavailable: {e!r}",
+                )
+            )
+        finally:
+            self._injections.pop(tag, None)
+
+    async def _inject_through_worker(self, ws, request: dict):
+        try:
+            index = shard_for(request["charge_point_id"], len(self._workers))
+        except (KeyError, TypeError, AttributeError):
+            reply = json.loads(
+                injection.reply(
+                    None,
+                    None,
+                    None,
+                    None,
+                    injection.REJECTED,
+                    reason="Injection needs a target charge_point_id",
+                )
+            )
+        else:
+            reply = await self._forward_injection(index, request)
+        reply["tag"] = request.get("tag")
+        with contextlib.suppress(websockets.exceptions.ConnectionClosed):
+            await ws.send(json.dumps(reply))
+
+    async def _run_campaign(self, ws, request: dict):
+        # Split by the shards of the targets, each worker runs its share and the reports are merged
+        try:
+            spec = CampaignSpec.from_dict(request["campaign"])
+            if not spec.charge_point_ids:
+                raise CampaignError(
+                    "Campaigns need their target charge_point_ids with --workers"
+                )
+        except (CampaignError, TypeError) as e:
+            response = injection.reply(
+                request.get("tag"), None, None, None, injection.REJECTED, reason=str(e)
+            )
+        else:
+            shards = collections.defaultdict(list)
+            for charge_point_id in spec.charge_point_ids:
+                shards[shard_for(charge_point_id, len(self._workers))].append(
+                    charge_point_id
+                )
+            replies = await asyncio.gather(
+                *(
+                    self._forward_injection(index, {"campaign": share.to_dict()})
+                    for index, share in zip(shards, spec.split(list(shards.values())))
+                    if share is not None
+                )
+            )
+            reports = [
+                CampaignReport.from_dict(reply["report"])
+                for reply in replies
+                if reply["outcome"] == injection.CAMPAIGN
+            ]
+            if reports:
+                response = json.dumps(
+                    {
+                        "tag": request.get("tag"),
+                        "outcome": injection.CAMPAIGN,
+                        "report": CampaignReport.merge(reports).to_dict(),
+                    }
+                )
+            else:
+                response = injection.reply(
+                    request.get("tag"),
+                    None,
+                    None,
+                    None,
+                    injection.REJECTED,
+                    reason=replies[0].get("reason"),
+                )
+        with contextlib.suppress(websockets.exceptions.ConnectionClosed):
+            await ws.send(response)
+
+    async def _serve_injection_channel(self, ws, max_in_flight=1024):
+        in_flight = asyncio.Semaphore(max_in_flight)
+        tasks = set()
+        try:
+            async for text in ws:
+                try:
+                    request = json.loads(text)
+                    if not isinstance(request, dict):
+                        raise ValueError("Not a JSON object")
+                except ValueError as e:
+                    await ws.send(
+                        injection.reply(
+                            None, None, None, None, injection.REJECTED, reason=str(e)
+                        )
+                    )
+                    continue
+                await in_flight.acquire()
+                task = asyncio.create_task(
+                    self._run_campaign(ws, request)
+                    if "campaign" in request
+                    else self._inject_through_worker(ws, request)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: in_flight.release())
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _wait_readable(self, sock, timeout):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(
+            sock.fileno(), lambda: readable.done() or readable.set_result(None)
+        )
+        try:
+            await asyncio.wait_for(readable, timeout)
+        finally:
+            loop.remove_reader(sock.fileno())
+
+    async def _peek_request_line(self, sock, timeout=10.0) -> str:
+        # MSG_PEEK leaves the request untouched for the worker that performs the handshake
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            await self._wait_readable(sock, deadline - loop.time())
+            data = sock.recv(_MAX_REQUEST_LINE, socket.MSG_PEEK)
+            if not data:
+                raise ConnectionError("Connection closed before the request line")
+            if b"\r\n" in data:
+                return data.split(b"\r\n", 1)[0].decode("latin-1")
+            if len(data) >= _MAX_REQUEST_LINE:
+                raise ValueError("Request line too long")
+            await asyncio.sleep(0.005)
+
+    async def _fetch_worker_metrics(self, worker: WorkerHandle) -> str:
+        # Workers answer GET /metrics on their private endpoint, the same as on the public port
+        reader, writer = await asyncio.open_unix_connection(
+            worker_socket_path(os.getpid(), worker.index)
+        )
+        try:
+            writer.write(
+                b"GET /metrics HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n"
+            )
+            response = await reader.read()
+        finally:
+            writer.close()
+        return response.split(b"\r\n\r\n", 1)[1].decode()
+
+    async def _serve_metrics(self, sock):
+        loop = asyncio.get_running_loop()
+        # The request was only peeked at so far, it is read before answering so that closing doesn't reset it
+        request = b""
+        while b"\r\n\r\n" not in request and len(request) < _MAX_REQUEST_LINE:
+            chunk = await loop.sock_recv(sock, _MAX_REQUEST_LINE)
+            if not chunk:
+                break
+            request += chunk
+
+        alive = [worker for worker in self._workers if worker.process.is_alive()]
+        expositions = [
+            metrics.render(
+                [
+                    metrics.MetricFamily(
+                        "ocpp_relay_workers", "gauge", "Relay worker processes alive"
+                    ).add(len(alive)),
+                    metrics.MetricFamily(
+                        "ocpp_relay_worker_restarts_total",
+                        "counter",
+                        "Relay worker processes restarted after exiting",
+                    ).add(self._restarts),
+                    metrics.MetricFamily(
+                        "ocpp_relay_ui_subscribers",
+                        "gauge",
+                        "UI subscribers served from the events of all workers",
+                    ).add(len(self.bus.subscribers)),
+                ]
+            )
+        ]
+        for worker, result in zip(
+            alive,
+            await asyncio.gather(
+                *(
+                    asyncio.wait_for(self._fetch_worker_metrics(worker), 5.0)
+                    for worker in alive
+                ),
+                return_exceptions=True,
+            ),
+        ):
+            if isinstance(result, Exception):
+                self.logger.warning(
+                    f"Collecting metrics of worker {worker.index} failed: {result!r}"
+                )
+            else:
+                expositions.append(result)
+        body = metrics.merge(expositions).encode()
+        await loop.sock_sendall(
+            sock,
+            b"HTTP/1.1 200 OK\r\n"
+            + f"Content-Type: {metrics.CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\n".encode()
+            + b"Connection: close\r\n\r\n"
+            + body,
+        )
+        sock.close()
+
+    def _reject(self, sock, reason):
+        body = reason.encode()
+        sock.sendall(
+            b"HTTP/1.1 400 Bad Request\r\nContent-Type: text/plain\r\n"
+            + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+            + body
+        )
+        sock.close()
+
+    async def _route(self, sock: socket.socket):
+        try:
+            request_line = await self._peek_request_line(sock)
+            _, path, _ = request_line.split(" ", 2)
+        except (asyncio.TimeoutError, ConnectionError, ValueError) as e:
+            self.logger.warning(f"Dropping connection without a valid request: {e}")
+            sock.close()
+            return
+
+        kind, charge_point_id, _ = parse_route(path)
+        if kind == "metrics":
+            if not self.serve_metrics:
+                return self._reject(sock, "Metrics are disabled")
+            try:
+                return await self._serve_metrics(sock)
+            except OSError as e:
+                self.logger.warning(f"Serving metrics failed: {e}")
+                return sock.close()
+        elif kind == "streamlit":
+            if not self.csms_configured:
+                csms_info_b64 = urlsplit(path).path.strip("/").split("/", 1)[1]
+                self._configure(
+                    json.loads(base64.b64decode(csms_info_b64).decode("ascii"))
+                )
+            if charge_point_id is None:
+                return await self._ui_connections.serve(sock)
+        elif kind == "injection":
+            return await self._ui_connections.serve(sock)
+        elif kind == "inject" and charge_point_id is None:
+            if len(self._workers) > 1:
+                return self._reject(
+                    sock,
+                    "Injection needs a target ChargePoint: /inject/<direction>/<id>",
+                )
+            charge_point_id = ""
+        elif kind == "transactions" and charge_point_id is None:
+            if len(self._workers) > 1:
+                return self._reject(
+                    sock,
+                    "Transactions are kept by the worker of their ChargePoint: /transactions?charge_point_id=<id>",
+                )
+            charge_point_id = ""
+
+        worker = self._workers[shard_for(charge_point_id, len(self._workers))]
+        try:
+            self._send_control(worker, {"type": "connection"}, fds=[sock.fileno()])
+        except OSError as e:
+            self.logger.error(
+                f"Handing over connection to worker {worker.index} failed: {e}"
+            )
+        finally:
+            sock.close()
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        listener = self._listener = socket.create_server(
+            (self.host, self.port), backlog=1024
+        )
+        listener.setblocking(False)
+        await self._ui_connections.start(worker_socket_path(os.getpid(), "ui"))
+        for index in range(len(self._workers)):
+            await self._start_worker(index)
+        asyncio.create_task(self._watch_workers())
+        self.logger.info(
+            f"Relay server started on {self.port} with {len(self._workers)} workers"
+        )
+        while True:
+            sock, _ = await loop.sock_accept(listener)
+            sock.setblocking(False)
+            asyncio.create_task(self._route(sock))
+
+    def run(self):
+        asyncio.run(self._serve())
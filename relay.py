@@ -1,152 +1,1148 @@
-import asyncio
-import base64
-import json
-import logging
-from dataclasses import dataclass, field
-from datetime import datetime
-from typing import Literal
-
-import websockets
-from dataclasses_json import dataclass_json
-
-
-def setup_logger():
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-    console_logger = logging.StreamHandler()
-    console_logger.setFormatter(
-        logging.Formatter(
-            "%(asctime)s - [%(levelname)-4.4s] - [%(threadName)-7.7s] - [%(name)-20.20s] - %(message)s"
-        )
-    )
-    logger.addHandler(console_logger)
-    return logger
-
-
-def basic_auth_header(username, password):
-    user_pass = f"{username}:{password}"
-    basic_credentials = base64.b64encode(user_pass.encode()).decode()
-    return ("Authorization", f"Basic {basic_credentials}")
-
-
-@dataclass_json
-@dataclass
-class MetaInformation:
-    event: Literal["Connection", "Disconnection"]
-    payload: dict = None
-    timestamp: str = field(
-        default_factory=lambda: datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-    )
-
-
-class WebSocketRelay:
-    def __init__(self):
-        self.internal_queue = asyncio.Queue()
-        self.injected_message_ids = []
-        self.logger = setup_logger()
-        self.csms_url, self.csms_id, self.csms_pass = None, None, None
-        self.csms_ws, self.cp_ws = None, None
-        self.cp_id, cp_ws_subp = None, None
-
-    async def _relay(self, source_ws, target_ws, source_name, target_name):
-        while True:
-            try:
-                message = await source_ws.recv()
-                json_message = json.loads(message)
-                self.internal_queue.put_nowait(message)
-                if json_message[1] not in self.injected_message_ids:
-                    await target_ws.send(message)
-                    self.logger.info(
-                        f"Relayed message from {source_name} to {target_name} ({json_message[1]})"
-                    )
-            except websockets.exceptions.ConnectionClosed:
-                self.logger.info(f"{source_name} connection closed.")
-                self.internal_queue.put_nowait(
-                    str(MetaInformation(event="Disconnection").to_json())
-                )
-                break
-
-    async def on_connect(self, ws, path):
-        path = path.strip("/")
-        self.logger.info(f"WebSocket OnConnect for path: {path}")
-
-        if "streamlit" in path:
-            _, csms_info_b64 = path.split("/")
-            csms_info = json.loads(base64.b64decode(csms_info_b64).decode("ascii"))
-            self.csms_url, self.csms_id, self.csms_pass = (
-                csms_info["url"],
-                csms_info["id"],
-                csms_info["pass"],
-            )
-            self.logger.info(
-                f"Relay will connect to CSMS at: {self.csms_url} when it receives a connection from ChargePoint"
-            )
-            while True:
-                message = await self.internal_queue.get()
-                await ws.send(message)
-
-        elif "inject" in path:
-            _, direction = path.split("/")
-            request = await ws.recv()
-            json_request = json.loads(request)
-            if direction == "csms-cp":
-                self.logger.info(f"Injecting CSMS → CP: {request}")
-                self.injected_message_ids.append(json_request[1])
-                await self.cp_ws.send(request)
-                self.internal_queue.put_nowait(request)
-                # response is handled by the _relay() method, avoiding two consumers/recv() of the websocket
-            elif direction == "cp-csms":
-                self.logger.info(f"Injecting CP → CSMS: {request}")
-                self.injected_message_ids.append(json_request[1])
-                await self.csms_ws.send(request)
-                self.internal_queue.put_nowait(request)
-                # response is handled by the _relay() method, avoiding two consumers/recv() of the websocket
-
-        else:
-            charge_point_id = path.strip("/")
-            cp_ws = ws
-            try:
-                ws_subprotocol = cp_ws.request_headers["Sec-WebSocket-Protocol"]
-            except KeyError:
-                self.logger.error(
-                    "Client didn't specify any sub-protocol. A sub-protocol is required for OCPP. Closing Connection"
-                )
-                return await cp_ws.close()
-
-            self.logger.info(
-                f"Received a new connection from a ChargePoint. {charge_point_id=}"
-            )
-            self.logger.info(f"Connecting to CSMS at {self.csms_url}/{charge_point_id}")
-            connection_meta_info = MetaInformation(
-                event="Connection",
-                payload={
-                    "charge_point_id": charge_point_id,
-                    "ws_subprotocol": ws_subprotocol,
-                },
-            )
-            self.internal_queue.put_nowait(str(connection_meta_info.to_json()))
-
-            async with websockets.connect(
-                f"{self.csms_url}/{charge_point_id}",
-                subprotocols=[ws_subprotocol],
-                extra_headers=(
-                    [basic_auth_header(self.csms_id, self.csms_pass)]
-                    if all([self.csms_id, self.csms_pass])
-                    else []
-                ),
-            ) as csms_ws:
-                self.csms_ws, self.cp_ws = csms_ws, cp_ws
-                await asyncio.gather(
-                    self._relay(cp_ws, csms_ws, source_name="CP", target_name="CSMS"),
-                    self._relay(csms_ws, cp_ws, source_name="CSMS", target_name="CP"),
-                )
-
-    async def start(self, port):
-        server = await websockets.serve(self.on_connect, "0.0.0.0", port)
-        self.logger.info(f"Relay server started on {port}")
-        await server.wait_closed()
-
-
-if __name__ == "__main__":
-    relay = WebSocketRelay()
-    asyncio.run(relay.start(8500))
+import argparse
+import asyncio
+import base64
+import dataclasses
+import functools
+import http
+import json
+import logging
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Literal
+from urllib.parse import parse_qs, urlsplit
+
+import websockets
+
+from core.bus import EventBus, OverflowPolicy, stream_subscription
+from core.campaigns import Campaign, CampaignSpec
+from core.capture import CaptureReader, CaptureWriter
+from core.compression import LEGS, CompressionConfig, CompressionStats, meter
+from core.config import ConfigError, ListSetting, csms_info, load_config
+from core.correlation import CallCorrelator
+from core.frames import CALL, Frame
+from core.injection import (
+    InjectionRejected,
+    PendingInjections,
+    serve_injection_channel,
+)
+from core.links import LinkConfig, LinkOverflow, LinkPolicy, OutboundLink
+from core.meter_values import MeterValueFeed
+from core.metrics import (
+    MESSAGE_TYPE_NAMES,
+    MetricFamily,
+    RelayMetrics,
+    http_response,
+    render,
+)
+from core.rules import RuleEngine, RuleError
+from core.sessions import DIRECTIONS, ChargePointSession, SessionRegistry
+from core.tracking import InjectedMessageTracker
+from core.upstream import UpstreamConnector
+from core.validation import FrameValidator, ValidationConfig
+from core.workers import RelaySupervisor, parse_route
+
+
+def setup_logger():
+    logger = logging.getLogger()
+    if logger.handlers:
+        return logger
+    logger.setLevel(logging.INFO)
+    console_logger = logging.StreamHandler()
+    console_logger.setFormatter(
+        logging.Formatter(
+            "%(asctime)s - [%(levelname)-4.4s] - [%(threadName)-7.7s] - [%(name)-20.20s] - %(message)s"
+        )
+    )
+    logger.addHandler(console_logger)
+    return logger
+
+
+def json_response(body, status=http.HTTPStatus.OK):
+    return status, [("Content-Type", "application/json")], json.dumps(body).encode()
+
+
+DIRECTION_LABELS = {"csms-cp": "CSMS → CP", "cp-csms": "CP → CSMS"}
+
+
+def basic_auth_header(username, password):
+    user_pass = f"{username}:{password}"
+    basic_credentials = base64.b64encode(user_pass.encode()).decode()
+    return ("Authorization", f"Basic {basic_credentials}")
+
+
+@dataclass
+class MetaInformation:
+    event: Literal["Connection", "Disconnection", "Message"]
+    payload: dict = None
+    timestamp: str = field(
+        default_factory=lambda: datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    )
+
+    def to_json(self) -> str:
+        return json.dumps(dataclasses.asdict(self))
+
+
+class WebSocketRelay:
+    def __init__(
+        self,
+        bus_capacity=4096,
+        overflow_policy=OverflowPolicy.DROP_OLDEST,
+        injection_ttl=300.0,
+        capture_dir=None,
+        capture_max_segments=None,
+        call_timeout=60.0,
+        links=None,
+        validation=None,
+        compression=None,
+        csms=None,
+        csms_cafile=None,
+        metrics=True,
+        rules=None,
+        meter_values=False,
+    ):
+        self.bus = EventBus(capacity=bus_capacity, overflow_policy=overflow_policy)
+        self.injected_messages = InjectedMessageTracker(ttl=injection_ttl)
+        self.injections = PendingInjections()
+        self.sessions = SessionRegistry()
+        self.logger = setup_logger()
+        self.csms_url, self.csms_id, self.csms_pass = None, None, None
+        self.upstream = None
+        self.capture = (
+            CaptureWriter(capture_dir, max_segments=capture_max_segments)
+            if capture_dir
+            else None
+        )
+        self._capture_reader = None
+        self._searches = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Search")
+        self.metrics = RelayMetrics()
+        self.metrics_labels = {}
+        self.call_timeout = call_timeout
+        # direction -> LinkConfig of the outbound links of every session
+        self.links = {direction: LinkConfig() for direction in DIRECTIONS}
+        self.links.update(links or {})
+        # leg -> CompressionConfig of the connections with the ChargePoints and with the CSMS
+        self.compression = {leg: CompressionConfig() for leg in LEGS}
+        self.compression.update(compression or {})
+        # core.validation.ValidationConfig, frames are only validated when given
+        self.validator = (
+            FrameValidator(validation, self._on_violation) if validation else None
+        )
+        # core.meter_values.MeterValueFeed, meter values are only aggregated when enabled
+        self.meter_values = MeterValueFeed() if meter_values else None
+        # core.rules.RuleEngine of the rules file, frames are forwarded untouched without one
+        self.rules = RuleEngine(rules) if rules else None
+        self._rules_watcher = None
+        self.serve_metrics = metrics
+        self.csms_cafile = csms_cafile
+        self._call_sweeper = None
+        # A CSMS given in the relay's configuration (see core.config) is used from the start and can't be changed by UIs
+        self.csms_configured = csms is not None
+        if csms is not None:
+            self.configure(csms)
+
+    def configure(self, csms_info):
+        self.csms_url, self.csms_id, self.csms_pass = (
+            csms_info["url"],
+            csms_info["id"],
+            csms_info["pass"],
+        )
+        if self.upstream is None or self.upstream.base_url != self.csms_url:
+            self.upstream = UpstreamConnector(self.csms_url, cafile=self.csms_cafile)
+        self.logger.info(
+            f"Relay will connect to CSMS at: {self.csms_url} when it receives a connection from ChargePoint"
+        )
+
+    async def _relay(self, session, source_ws, link, source_name, target_name):
+        direction = "cp-csms" if source_name == "CP" else "csms-cp"
+        # Responses coming from the CP answer calls injected towards the CP, and vice versa
+        injected_direction = "csms-cp" if source_name == "CP" else "cp-csms"
+        while True:
+            try:
+                message = await source_ws.recv()
+                received_at = time.perf_counter()
+                frame = Frame.parse_or_none(message)
+                if frame is None:
+                    # Not OCPP-J, still relayed untouched but never shown in the UI
+                    self.metrics.malformed[direction] += 1
+                    self.logger.warning(
+                        f"Relaying malformed frame from {source_name} to {target_name} ({session.charge_point_id})"
+                    )
+                    await link.send(message)
+                    continue
+                if self.bus.has_subscribers:
+                    # Subscribers only read what is published after they attach, nobody could read it otherwise
+                    self.bus.publish(
+                        session.envelope(message, direction), session.charge_point_id
+                    )
+                if self.capture is not None:
+                    self.capture.append(
+                        time.time(), session.charge_point_id, direction, frame
+                    )
+                if frame.is_call:
+                    action = frame.action
+                    self._complete_exchanges(
+                        session.calls.request(direction, frame, received_at)
+                    )
+                else:
+                    exchange = session.calls.response(direction, frame, received_at)
+                    action = ""
+                    if exchange is not None:
+                        action = exchange.action
+                        self._complete_exchanges([exchange])
+                    else:
+                        self.metrics.unmatched[direction] += 1
+                if frame.is_call or not self.injected_messages.complete(
+                    session.charge_point_id, injected_direction, frame.message_id
+                ):
+                    verdict = None
+                    if self.rules is not None:
+                        verdict = self.rules.apply(
+                            session.charge_point_id, direction, frame, action, message
+                        )
+                    if verdict is None:
+                        if not await link.send(message):
+                            continue
+                    elif not await self._forward_verdict(
+                        session, direction, frame, link, verdict
+                    ):
+                        continue
+                    else:
+                        message = verdict.message
+                    self.metrics.relayed(
+                        direction,
+                        frame.message_type,
+                        action,
+                        len(message),
+                        time.perf_counter() - received_at,
+                    )
+                    if self.logger.isEnabledFor(logging.DEBUG):
+                        self.logger.debug(
+                            f"Relayed message from {source_name} to {target_name} ({session.charge_point_id}, {frame.message_id})"
+                        )
+                else:
+                    # Answers an injected call, consumed by the relay
+                    self.metrics.relayed(
+                        direction, frame.message_type, action, len(message)
+                    )
+                if (
+                    self.meter_values is not None
+                    and direction == "cp-csms"
+                    and frame.is_call
+                ):
+                    self.meter_values.feed(session.charge_point_id, frame)
+                if self.validator is not None and action:
+                    self.validator.submit(
+                        session.ws_subprotocol,
+                        frame,
+                        action,
+                        (
+                            session.charge_point_id,
+                            direction,
+                            frame.message_type,
+                            frame.message_id,
+                        ),
+                    )
+            except websockets.exceptions.ConnectionClosed:
+                self.logger.info(
+                    f"{source_name} connection closed for {session.charge_point_id}."
+                )
+                break
+            except LinkOverflow as e:
+                self.metrics.link_overflows[direction] += 1
+                self.logger.warning(
+                    f"Closing the {target_name} connection of {session.charge_point_id}, it is too slow: {e}"
+                )
+                link.close(f"Peer too slow: {e}")
+                break
+
+    async def _forward_verdict(self, session, direction, frame, link, verdict) -> bool:
+        """Forwards a frame the rules applied to as they decided, returns whether any copy of it was sent."""
+        if self.bus.has_subscribers:
+            self.bus.publish(
+                json.dumps(
+                    {
+                        "event": "Rule",
+                        "payload": {
+                            "charge_point_id": session.charge_point_id,
+                            "direction": direction,
+                            "message_id": frame.message_id,
+                            "message_type": frame.message_type,
+                            "rules": [rule.name for rule in verdict.rules],
+                            "copies": verdict.copies,
+                            "delay": verdict.delay,
+                        },
+                    }
+                ),
+                session.charge_point_id,
+            )
+        if verdict.delay:
+            # Frames of the leg relayed after this one wait behind it, their order is kept
+            await asyncio.sleep(verdict.delay)
+        sent = False
+        for _ in range(verdict.copies):
+            sent = await link.send(verdict.message) or sent
+        return sent
+
+    async def _send_injection(self, direction, charge_point_id, request, wait=False):
+        """Sends an injected CALL, returns its key. With `wait`, its exchange can be awaited from `self.injections`."""
+        frame = Frame.parse_or_none(request)
+        if frame is None or not frame.is_call:
+            raise InjectionRejected("Not a CALL message", code=1003)
+        session = self.sessions.resolve(charge_point_id)
+        if session is None:
+            raise InjectionRejected("Unknown ChargePoint")
+        if direction not in DIRECTIONS:
+            raise InjectionRejected("Unknown direction")
+        link = session.links.get(direction)
+        if link is None:
+            raise InjectionRejected("ChargePoint isn't connected to the CSMS yet")
+
+        key = (session.charge_point_id, direction, frame.message_id)
+        if wait:
+            # Registered before sending, the response may be relayed before the send returns
+            self.injections.expect(key)
+        self.injected_messages.add(*key)
+        self._complete_exchanges(session.calls.request(direction, frame, injected=True))
+        try:
+            if not await link.send(request):
+                raise InjectionRejected(
+                    "Dropped, the peer is above its high-water mark"
+                )
+        except LinkOverflow as e:
+            self._discard_injection(session, key)
+            self.metrics.link_overflows[direction] += 1
+            link.close(f"Peer too slow: {e}")
+            raise InjectionRejected(f"The peer is too slow: {e}")
+        except (websockets.exceptions.ConnectionClosed, InjectionRejected):
+            self._discard_injection(session, key)
+            raise
+        if self.bus.has_subscribers:
+            self.bus.publish(
+                session.envelope(request, direction), session.charge_point_id
+            )
+        if self.capture is not None:
+            self.capture.append(time.time(), session.charge_point_id, direction, frame)
+        if self.meter_values is not None and direction == "cp-csms":
+            self.meter_values.feed(session.charge_point_id, frame)
+        if self.validator is not None:
+            self.validator.submit(
+                session.ws_subprotocol,
+                frame,
+                frame.action,
+                (session.charge_point_id, direction, CALL, frame.message_id),
+            )
+        # response is handled by the _relay() method, avoiding two consumers/recv() of the websocket
+        return key
+
+    def _discard_injection(self, session, key):
+        # The call was never sent, a response with its message id isn't one to it
+        self.injections.discard(key)
+        self.injected_messages.discard(*key)
+        session.calls.discard(key[1], key[2])
+
+    async def inject_call(self, direction, charge_point_id, request, timeout=None):
+        """Injects a CALL and returns its exchange, None if it isn't answered within `timeout` seconds."""
+        key = await self._send_injection(direction, charge_point_id, request, wait=True)
+        return await self.injections.result(key, timeout or self.call_timeout)
+
+    async def run_campaign(self, spec):
+        """Runs an injection campaign (see core.campaigns.CampaignSpec), returns its report."""
+        spec = CampaignSpec.from_dict(spec)
+        targets = spec.charge_point_ids
+        if targets is None:
+            targets = self.sessions.ids()
+        report = await Campaign(spec, self.inject_call, targets).run()
+        return report.to_dict()
+
+    async def _inject(self, ws, direction, charge_point_id=None):
+        request = await ws.recv()
+        try:
+            charge_point_id, _, _ = await self._send_injection(
+                direction, charge_point_id, request
+            )
+        except InjectionRejected as e:
+            self.logger.error(
+                f"Cannot inject {direction} message for {charge_point_id=}: {e.reason}. "
+                f"Connected ChargePoints: {self.sessions.ids()}"
+            )
+            return await ws.close(code=e.code, reason=e.reason)
+        self.logger.info(
+            f"Injected {DIRECTION_LABELS[direction]} ({charge_point_id}): {request}"
+        )
+
+    async def _serve_charge_point(self, cp_ws, charge_point_id):
+        try:
+            ws_subprotocol = cp_ws.request_headers["Sec-WebSocket-Protocol"]
+        except KeyError:
+            self.logger.error(
+                "Client didn't specify any sub-protocol. A sub-protocol is required for OCPP. Closing Connection"
+            )
+            return await cp_ws.close()
+
+        self.logger.info(
+            f"Received a new connection from a ChargePoint. {charge_point_id=}"
+        )
+        session = ChargePointSession(
+            charge_point_id=charge_point_id,
+            cp_ws=cp_ws,
+            ws_subprotocol=ws_subprotocol,
+            calls=CallCorrelator(charge_point_id, timeout=self.call_timeout),
+        )
+        if self._call_sweeper is None:
+            self._call_sweeper = asyncio.create_task(self._expire_calls())
+        if self.rules is not None and self._rules_watcher is None:
+            self._rules_watcher = asyncio.create_task(self._reload_rules())
+        previous = self.sessions.register(session)
+        if previous is not None:
+            self.logger.warning(
+                f"{charge_point_id} reconnected while a session was still active. Closing the previous session"
+            )
+            await previous.cp_ws.close(code=1001, reason="Replaced by a new connection")
+
+        try:
+            if self.upstream is None:
+                self.logger.error(
+                    f"Relay isn't configured with a CSMS yet, closing connection of {charge_point_id}"
+                )
+                return await cp_ws.close(code=1013, reason="Relay not configured")
+
+            self.logger.info(f"Connecting to CSMS at {self.csms_url}/{charge_point_id}")
+            try:
+                csms_ws, connect_timings = await self.upstream.connect(
+                    charge_point_id,
+                    subprotocols=[ws_subprotocol],
+                    extra_headers=(
+                        [basic_auth_header(self.csms_id, self.csms_pass)]
+                        if all([self.csms_id, self.csms_pass])
+                        else []
+                    ),
+                    **self.compression["csms"].client_options(),
+                )
+            except (OSError, asyncio.TimeoutError, websockets.InvalidHandshake) as e:
+                self.logger.error(
+                    f"Connecting to CSMS on behalf of {charge_point_id} failed: {e!r}"
+                )
+                return await cp_ws.close(code=1011, reason="CSMS unreachable")
+            session.upstream_timings = connect_timings
+            self.metrics.connected(connect_timings)
+            self.logger.info(
+                f"Connected to CSMS for {charge_point_id} in {connect_timings.total * 1000:.1f} ms "
+                f"(dns {connect_timings.dns * 1000:.1f}, tcp {connect_timings.tcp * 1000:.1f}, "
+                f"tls {connect_timings.tls * 1000:.1f}, upgrade {connect_timings.upgrade * 1000:.1f}, "
+                f"tls resumed: {connect_timings.tls_resumed})"
+            )
+            connection_meta_info = MetaInformation(
+                event="Connection",
+                payload={
+                    "charge_point_id": charge_point_id,
+                    "ws_subprotocol": ws_subprotocol,
+                    "upstream_connect": connect_timings.to_dict(),
+                },
+            )
+            self.bus.publish(str(connection_meta_info.to_json()), charge_point_id)
+
+            try:
+                session.csms_ws = csms_ws
+                session.compression = {
+                    leg: stats
+                    for leg, stats in (("cp", meter(cp_ws)), ("csms", meter(csms_ws)))
+                    if stats is not None
+                }
+                session.links = {
+                    direction: OutboundLink(
+                        target, direction, self.links[direction], self.metrics
+                    )
+                    for direction, target in (("cp-csms", csms_ws), ("csms-cp", cp_ws))
+                }
+                legs = [
+                    asyncio.create_task(
+                        self._relay(
+                            session,
+                            cp_ws,
+                            session.links["cp-csms"],
+                            source_name="CP",
+                            target_name="CSMS",
+                        )
+                    ),
+                    asyncio.create_task(
+                        self._relay(
+                            session,
+                            csms_ws,
+                            session.links["csms-cp"],
+                            source_name="CSMS",
+                            target_name="CP",
+                        )
+                    ),
+                ]
+                # Once either leg is closed, the session is over; tear down the other leg instead of leaking it
+                _, pending = await asyncio.wait(
+                    legs, return_when=asyncio.FIRST_COMPLETED
+                )
+                for leg in pending:
+                    leg.cancel()
+                await cp_ws.close()
+            finally:
+                self.upstream.remember_session(csms_ws)
+                await csms_ws.close()
+                for leg, stats in session.compression.items():
+                    self.metrics.compression[leg].add(stats)
+            if session.compression:
+                self.logger.info(
+                    f"Compression of {charge_point_id}: "
+                    + ", ".join(
+                        f"{leg.upper()} leg {stats.format()}"
+                        for leg, stats in session.compression.items()
+                    )
+                )
+            self.bus.publish(
+                str(
+                    MetaInformation(
+                        event="Disconnection",
+                        payload={
+                            "charge_point_id": charge_point_id,
+                            "compression": {
+                                leg: stats.to_dict()
+                                for leg, stats in session.compression.items()
+                            },
+                        },
+                    ).to_json()
+                ),
+                charge_point_id,
+            )
+        finally:
+            self._complete_exchanges(session.calls.close())
+            if self.sessions.unregister(session):
+                self.injected_messages.discard_charge_point(charge_point_id)
+
+    def _complete_exchanges(self, exchanges):
+        for exchange in exchanges:
+            self.metrics.exchanged(exchange)
+            if self.meter_values is not None:
+                self.meter_values.feed_exchange(exchange)
+            if exchange.injected and self.injections:
+                self.injections.resolve(exchange)
+            # Unlike relayed frames, exchanges are serialized, which is skipped when nobody listens
+            if self.bus.has_subscribers:
+                self.bus.publish(exchange.to_event(), exchange.charge_point_id)
+
+    def _on_violation(self, context, errors):
+        charge_point_id, direction, message_type, message_id = context
+        self.logger.info(
+            f"{DIRECTION_LABELS[direction]} {MESSAGE_TYPE_NAMES[message_type]} {message_id} "
+            f"({charge_point_id}) violates the schema: {errors[0]}"
+        )
+        if self.bus.has_subscribers:
+            self.bus.publish(
+                json.dumps(
+                    {
+                        "event": "Validation",
+                        "payload": {
+                            "charge_point_id": charge_point_id,
+                            "direction": direction,
+                            "message_id": message_id,
+                            "message_type": message_type,
+                            "errors": errors,
+                        },
+                    }
+                ),
+                charge_point_id,
+            )
+
+    async def _expire_calls(self, interval=1.0):
+        while True:
+            await asyncio.sleep(interval)
+            for session in self.sessions:
+                self._complete_exchanges(session.calls.expire())
+
+    async def _reload_rules(self, interval=1.0):
+        # Rules are swapped between two frames, sessions and the frames in flight aren't affected
+        while True:
+            await asyncio.sleep(interval)
+            self.rules.reload()
+
+    async def _stream_events(self, ws, overflow_policy=None, charge_point_id=None):
+        subscription = self.bus.subscribe(overflow_policy, charge_point_id)
+        self.logger.info(
+            f"Event subscriber attached ({len(self.bus.subscribers)} subscribers, policy: {subscription.policy.value})"
+        )
+        await stream_subscription(ws, subscription, self.logger)
+
+    async def on_connect(self, ws, path):
+        # Routed like the supervisor routes to the workers, see core.workers.parse_route()
+        kind, charge_point_id, query = parse_route(path)
+        path = urlsplit(path).path.strip("/")
+        self.logger.info(f"WebSocket OnConnect for path: {path}")
+
+        if kind == "streamlit":
+            if not self.csms_configured:
+                _, csms_info_b64 = path.split("/", 1)
+                csms_info = json.loads(base64.b64decode(csms_info_b64).decode("ascii"))
+                self.configure(csms_info)
+            await self._stream_events(
+                ws, query.get("overflow", [None])[0], charge_point_id
+            )
+
+        elif kind == "injection":
+            await serve_injection_channel(
+                ws,
+                self.inject_call,
+                self.logger,
+                timeout=self.call_timeout,
+                run_campaign=self.run_campaign,
+            )
+
+        elif kind == "inject":
+            await self._inject(ws, path.split("/")[1], charge_point_id)
+
+        elif kind == "charge_point":
+            await self._serve_charge_point(ws, charge_point_id)
+
+        else:
+            # Plain HTTP endpoints, answered by process_request() unless they are disabled
+            await ws.close(code=1008, reason=f"/{path} isn't a websocket endpoint")
+
+    def collect_metrics(self):
+        families = self.metrics.collect()
+        families.append(
+            MetricFamily(
+                "ocpp_relay_sessions", "gauge", "Connected ChargePoint sessions"
+            ).add(len(self.sessions))
+        )
+        families.append(
+            MetricFamily(
+                "ocpp_relay_sessions_opened_total",
+                "counter",
+                "ChargePoint sessions relayed to the CSMS",
+            ).add(self.metrics.sessions_opened)
+        )
+        families.append(
+            MetricFamily(
+                "ocpp_relay_calls_pending",
+                "gauge",
+                "Relayed CALLs awaiting their response",
+            ).add(sum(session.calls.pending for session in self.sessions))
+        )
+        buffered = MetricFamily(
+            "ocpp_relay_link_buffered_bytes",
+            "gauge",
+            "Bytes buffered for the peers of a direction",
+        )
+        buffered_max = MetricFamily(
+            "ocpp_relay_link_buffered_bytes_max",
+            "gauge",
+            "Bytes buffered for the slowest peer of a direction",
+        )
+        stalled = MetricFamily(
+            "ocpp_relay_links_stalled",
+            "gauge",
+            "Links paused until their peer catches up",
+        )
+        for direction in DIRECTIONS:
+            links = [
+                session.links[direction] for session in self.sessions if session.links
+            ]
+            sizes = [link.buffered for link in links]
+            buffered.add(sum(sizes), direction=direction)
+            buffered_max.add(max(sizes, default=0), direction=direction)
+            stalled.add(
+                sum(link.stalled_since is not None for link in links),
+                direction=direction,
+            )
+        families += [buffered, buffered_max, stalled]
+
+        wire = MetricFamily(
+            "ocpp_relay_compression_wire_bytes_total",
+            "counter",
+            "Bytes of permessage-deflate frames on the wire",
+        )
+        payload = MetricFamily(
+            "ocpp_relay_compression_payload_bytes_total",
+            "counter",
+            "Bytes of permessage-deflate frames once decompressed",
+        )
+        seconds = MetricFamily(
+            "ocpp_relay_compression_seconds_total",
+            "counter",
+            "Time spent compressing and decompressing",
+        )
+        compressed = MetricFamily(
+            "ocpp_relay_compressed_sessions",
+            "gauge",
+            "Sessions that negotiated permessage-deflate",
+        )
+        for leg in LEGS:
+            total = CompressionStats()
+            total.add(self.metrics.compression[leg])
+            live = [
+                session.compression[leg]
+                for session in self.sessions
+                if leg in session.compression
+            ]
+            for stats in live:
+                total.add(stats)
+            for direction in ("in", "out"):
+                wire.add(
+                    getattr(total, f"wire_{direction}"), leg=leg, direction=direction
+                )
+                payload.add(
+                    getattr(total, f"payload_{direction}"), leg=leg, direction=direction
+                )
+            seconds.add(total.seconds, leg=leg)
+            compressed.add(len(live), leg=leg)
+        families += [wire, payload, seconds, compressed]
+        if self.upstream is not None:
+            for name, help_ in (
+                ("connections", "CSMS connections opened"),
+                ("failures", "CSMS connections that failed to open"),
+                ("tls_resumed", "CSMS connections that resumed a TLS session"),
+            ):
+                families.append(
+                    MetricFamily(
+                        f"ocpp_relay_upstream_{name}_total", "counter", help_
+                    ).add(getattr(self.upstream, name))
+                )
+
+        subscribers = self.bus.subscribers
+        families += [
+            MetricFamily(
+                "ocpp_relay_bus_published_total", "counter", "Events published"
+            ).add(self.bus.head),
+            MetricFamily("ocpp_relay_bus_depth", "gauge", "Events held by the bus").add(
+                self.bus.depth
+            ),
+            MetricFamily(
+                "ocpp_relay_bus_subscribers", "gauge", "Attached event subscribers"
+            ).add(len(subscribers)),
+            MetricFamily(
+                "ocpp_relay_bus_max_subscriber_lag",
+                "gauge",
+                "Events not yet read by the slowest subscriber",
+            ).add(max((subscription.lag for subscription in subscribers), default=0)),
+            MetricFamily(
+                "ocpp_relay_bus_disconnected_total",
+                "counter",
+                "Subscribers disconnected for falling behind",
+            ).add(self.bus.disconnected),
+        ]
+
+        injected = self.injected_messages.stats()
+        families.append(
+            MetricFamily(
+                "ocpp_relay_injected_pending",
+                "gauge",
+                "Injected calls awaiting their response",
+            ).add(injected["pending"])
+        )
+        families.append(
+            MetricFamily(
+                "ocpp_relay_injections_awaited",
+                "gauge",
+                "Injected calls whose response an injection channel waits for",
+            ).add(len(self.injections))
+        )
+        for name, key, help_ in (
+            ("ocpp_relay_injected_total", "injected", "Calls injected"),
+            (
+                "ocpp_relay_injected_completed_total",
+                "completed",
+                "Injected calls that got their response",
+            ),
+            (
+                "ocpp_relay_injected_expired_total",
+                "expired",
+                "Injected calls that were never answered",
+            ),
+            (
+                "ocpp_relay_injected_discarded_total",
+                "discarded",
+                "Injected calls that couldn't be sent",
+            ),
+        ):
+            families.append(MetricFamily(name, "counter", help_).add(injected[key]))
+
+        if self.validator is not None:
+            validation = self.validator.stats()
+            for name, help_ in (
+                ("validated", "Frames validated against their OCPP schema"),
+                ("violations", "Validated frames that violate their OCPP schema"),
+                ("sampled_out", "Frames skipped by the validation sample rates"),
+                ("without_schema", "Validated frames without a schema"),
+                ("dropped", "Frames not validated because validation fell behind"),
+            ):
+                families.append(
+                    MetricFamily(
+                        f"ocpp_relay_validation_{name}_total", "counter", help_
+                    ).add(validation[name])
+                )
+
+        if self.meter_values is not None:
+            meter_values = self.meter_values.stats()
+            families.append(
+                MetricFamily(
+                    "ocpp_relay_meter_transactions",
+                    "gauge",
+                    "Transactions aggregated from the relayed meter values",
+                )
+                .add(meter_values["transactions"], state="all")
+                .add(meter_values["active"], state="active")
+            )
+            for name, help_ in (
+                ("samples", "Meter values aggregated into transaction series"),
+                ("unassigned", "Meter values without a transaction"),
+                ("malformed", "Meter value frames that couldn't be aggregated"),
+                ("dropped", "Meter value frames dropped while aggregation lagged"),
+            ):
+                families.append(
+                    MetricFamily(
+                        f"ocpp_relay_meter_{name}_total", "counter", help_
+                    ).add(meter_values[name])
+                )
+
+        if self.rules is not None:
+            rules = self.rules.stats()
+            families.append(
+                MetricFamily(
+                    "ocpp_relay_rules", "gauge", "Rules loaded from the rules file"
+                ).add(rules["rules"])
+            )
+            applied = MetricFamily(
+                "ocpp_relay_rule_applied_total",
+                "counter",
+                "Relayed frames a rule applied to, by effect",
+            )
+            for (rule, effect), count in rules["applied"].items():
+                applied.add(count, rule=rule, effect=effect)
+            families.append(applied)
+            families.append(
+                MetricFamily(
+                    "ocpp_relay_rule_reloads_total",
+                    "counter",
+                    "Reloads of the rules file",
+                )
+                .add(rules["reloads"], outcome="ok")
+                .add(rules["reload_errors"], outcome="error")
+            )
+
+        if self.capture is not None:
+            capture = self.capture.stats()
+            for name in ("written", "dropped"):
+                families.append(
+                    MetricFamily(
+                        f"ocpp_relay_capture_{name}_total",
+                        "counter",
+                        f"Capture records {name}",
+                    ).add(capture[name])
+                )
+        return families
+
+    def _search(self, text, limit):
+        if self._capture_reader is None:
+            self._capture_reader = CaptureReader(self.capture.directory)
+        started = time.perf_counter()
+        records = self._capture_reader.search(text, limit)
+        return {
+            "records": [dataclasses.asdict(record) for record in records],
+            "elapsed": time.perf_counter() - started,
+        }
+
+    async def search(self, query):
+        """Answers GET /search?q=<field=value ...>&limit=<n> from the capture, see core.capture.parse_search()."""
+        if self.capture is None:
+            return json_response(
+                {"error": "The relay doesn't capture, see --capture-dir"},
+                http.HTTPStatus.NOT_FOUND,
+            )
+        try:
+            limit = min(int(query.get("limit", ["100"])[0]), 1000)
+            # The index of new segments is loaded on a thread of its own, relaying goes on meanwhile
+            result = await asyncio.get_running_loop().run_in_executor(
+                self._searches, self._search, query.get("q", [""])[0], limit
+            )
+        except ValueError as e:
+            return json_response({"error": str(e)}, http.HTTPStatus.BAD_REQUEST)
+        return json_response(result)
+
+    async def transactions(self, query):
+        """
+        Answers GET /transactions?charge_point_id=<id> with the summaries of the transactions seen in the relayed
+        meter values, and with &transaction_id=<id> with the summary and series of one of them.
+        """
+        if self.meter_values is None:
+            return json_response(
+                {
+                    "error": "The relay doesn't aggregate meter values, see --meter-values"
+                },
+                http.HTTPStatus.NOT_FOUND,
+            )
+        charge_point_id = query.get("charge_point_id", [None])[0]
+        transaction_id = query.get("transaction_id", [None])[0]
+        if transaction_id is None:
+            return json_response(
+                {
+                    "transactions": await self.meter_values.query(
+                        "transactions", charge_point_id
+                    )
+                }
+            )
+        transaction = await self.meter_values.query(
+            "describe", charge_point_id, transaction_id
+        )
+        if transaction is None:
+            return json_response(
+                {"error": f"Unknown transaction {transaction_id} of {charge_point_id}"},
+                http.HTTPStatus.NOT_FOUND,
+            )
+        return json_response(transaction)
+
+    def ready(self):
+        """Answers GET /ready, 200 once the relay knows its CSMS and ChargePoints can connect, 503 until then."""
+        if self.upstream is None:
+            return json_response(
+                {"ready": False, "reason": "No CSMS configured yet"},
+                http.HTTPStatus.SERVICE_UNAVAILABLE,
+            )
+        return json_response({"ready": True, "csms_url": self.csms_url})
+
+    async def process_request(self, path, request_headers):
+        # Plain HTTP requests on /metrics, /ready, /search and /transactions are answered before the websocket handshake
+        url = urlsplit(path)
+        if url.path.rstrip("/") == "/metrics" and self.serve_metrics:
+            return http_response(render(self.collect_metrics(), self.metrics_labels))
+        if url.path.rstrip("/") == "/ready":
+            return self.ready()
+        if url.path.rstrip("/") == "/search":
+            return await self.search(parse_qs(url.query))
+        if url.path.rstrip("/") == "/transactions":
+            return await self.transactions(parse_qs(url.query))
+        return None
+
+    def serve_options(self):
+        return {
+            "process_request": self.process_request,
+            **self.compression["cp"].server_options(),
+        }
+
+    async def close(self):
+        """Flushes what the relay still buffers for the capture, validation and meter values, on shutdown."""
+        if self.capture is not None:
+            await self.capture.close()
+        if self._capture_reader is not None:
+            self._capture_reader.close()
+        if self.validator is not None:
+            await self.validator.close()
+        if self.meter_values is not None:
+            await self.meter_values.close()
+
+    async def start(self, port, host="0.0.0.0"):
+        server = await websockets.serve(
+            self.on_connect, host, port, **self.serve_options()
+        )
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.close)
+        self.logger.info(
+            f"Relay server started on {port}"
+            + (f", relaying to {self.csms_url}" if self.upstream is not None else "")
+        )
+        try:
+            await server.wait_closed()
+        finally:
+            await self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="OCPP-J relay between a CP and CSMS",
+        epilog="Every option can also be set in the config file or as an OCPP_RELAY_<OPTION> environment variable, "
+        "e.g. OCPP_RELAY_CSMS_URL, command line options take precedence.",
+    )
+    parser.add_argument(
+        "--config",
+        help="JSON file with the relay's settings, named like the options, e.g. "
+        '{"csms_url": "wss://csms.example.com/ocpp", "capture_dir": "captures/"}',
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8500)
+    parser.add_argument(
+        "--csms-url",
+        help="CSMS to relay to from the start, without waiting for the UI to configure it",
+    )
+    parser.add_argument("--csms-id", help="Basic auth username towards the CSMS")
+    parser.add_argument("--csms-password", help="Basic auth password towards the CSMS")
+    parser.add_argument(
+        "--csms-cafile", help="CA certificates to verify a wss:// CSMS with"
+    )
+    parser.add_argument(
+        "--metrics",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Serve Prometheus metrics on /metrics",
+    )
+    parser.add_argument(
+        "--capture-dir",
+        help="Directory to write a persistent capture of all relayed frames to",
+    )
+    parser.add_argument(
+        "--capture-max-segments",
+        type=int,
+        help="Number of capture segments (64 MiB each) kept per relay process, the oldest are removed, all by default",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of relay worker processes, ChargePoints are sharded across them by id",
+    )
+    parser.add_argument(
+        "--link-high-water",
+        type=int,
+        default=LinkConfig.high_water,
+        help="Bytes buffered for a peer above which the link policy applies",
+    )
+    parser.add_argument(
+        "--link-policy",
+        action=ListSetting,
+        default=[],
+        metavar="[DIRECTION=]POLICY",
+        help="What to do while a peer is above the high-water mark: pause reading from the source, drop frames "
+        "or close the peer's connection. Applies to both directions unless prefixed with one, e.g. csms-cp=drop",
+    )
+    parser.add_argument(
+        "--link-stall-timeout",
+        type=float,
+        help="Seconds a paused link waits for its peer before closing the peer's connection",
+    )
+    parser.add_argument(
+        "--cp-compression",
+        default="on",
+        metavar="SETTINGS",
+        help="permessage-deflate towards the ChargePoints: on, off or settings such as "
+        "window_bits=10,memory_level=4,level=1,no_context_takeover",
+    )
+    parser.add_argument(
+        "--csms-compression",
+        default="on",
+        metavar="SETTINGS",
+        help="permessage-deflate towards the CSMS, like --cp-compression",
+    )
+    parser.add_argument(
+        "--meter-values",
+        action="store_true",
+        help="Aggregate the relayed meter values per transaction, served on /transactions and shown in the UI",
+    )
+    parser.add_argument(
+        "--rules",
+        metavar="FILE",
+        help="JSON file of rules dropping, delaying, rewriting or duplicating relayed frames, reloaded when it changes",
+    )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="Validate relayed and injected frames against the OCPP schemas, off the forwarding path",
+    )
+    parser.add_argument(
+        "--validate-sample",
+        action=ListSetting,
+        default=[],
+        metavar="[ACTION=]RATE",
+        help="Share of the frames validated, e.g. MeterValues=0.1, without an action the default of all others",
+    )
+    parser.add_argument(
+        "--validation-workers",
+        type=int,
+        default=1,
+        help="Number of processes validating frames",
+    )
+    # The config file and environment only provide defaults, so they are read before the command line is parsed
+    try:
+        parser.set_defaults(**load_config(parser.parse_known_args()[0].config))
+    except ConfigError as e:
+        parser.error(str(e))
+    args = parser.parse_args()
+    csms = csms_info(vars(args))
+
+    policies = {}
+    for option in args.link_policy:
+        direction, _, policy = option.rpartition("=")
+        if direction and direction not in DIRECTIONS:
+            parser.error(f"Unknown direction in --link-policy: {direction}")
+        try:
+            policy = LinkPolicy(policy)
+        except ValueError:
+            parser.error(f"Unknown --link-policy: {policy}")
+        for direction in [direction] if direction else DIRECTIONS:
+            policies[direction] = policy
+    links = {
+        direction: LinkConfig(
+            high_water=args.link_high_water,
+            policy=policies.get(direction, LinkPolicy.PAUSE),
+            stall_timeout=args.link_stall_timeout,
+        )
+        for direction in DIRECTIONS
+    }
+    try:
+        compression = {
+            "cp": CompressionConfig.parse(args.cp_compression),
+            "csms": CompressionConfig.parse(args.csms_compression),
+        }
+    except ValueError as e:
+        parser.error(str(e))
+    validation = None
+    if args.validate:
+        validation = ValidationConfig(workers=args.validation_workers)
+        for option in args.validate_sample:
+            action, _, rate = option.rpartition("=")
+            try:
+                rate = float(rate)
+            except ValueError:
+                parser.error(f"Not a sample rate: {option}")
+            if action:
+                validation.sample_rates[action] = rate
+            else:
+                validation.default_rate = rate
+    if args.capture_max_segments is not None and args.capture_max_segments < 1:
+        parser.error("--capture-max-segments must be at least 1")
+    if args.rules:
+        # Loaded once here to report mistakes on startup, every relay process loads its own copy
+        try:
+            RuleEngine(args.rules)
+        except RuleError as e:
+            parser.error(str(e))
+
+    if args.workers > 1:
+        setup_logger()
+        RelaySupervisor(
+            functools.partial(
+                WebSocketRelay,
+                capture_dir=args.capture_dir,
+                capture_max_segments=args.capture_max_segments,
+                links=links,
+                validation=validation,
+                compression=compression,
+                csms=csms,
+                csms_cafile=args.csms_cafile,
+                metrics=args.metrics,
+                rules=args.rules,
+                meter_values=args.meter_values,
+            ),
+            port=args.port,
+            workers=args.workers,
+            host=args.host,
+            csms_info=csms,
+            metrics=args.metrics,
+        ).run()
+    else:
+        relay = WebSocketRelay(
+            capture_dir=args.capture_dir,
+            capture_max_segments=args.capture_max_segments,
+            links=links,
+            validation=validation,
+            compression=compression,
+            csms=csms,
+            csms_cafile=args.csms_cafile,
+            metrics=args.metrics,
+            rules=args.rules,
+            meter_values=args.meter_values,
+        )
+        asyncio.run(relay.start(args.port, args.host))
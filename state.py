@@ -1,77 +1,400 @@
-import collections
-import dataclasses
-import logging
-import threading
-import time
-import uuid
-from typing import Dict, Optional
-
-import redis
-import streamlit as st
-
-
-@dataclasses.dataclass
-class Event:
-    timestamp: int
-    message_name: str
-    request: str
-    response: Optional[str] = None
-
-
-_redis = redis.Redis(decode_responses=True)
-
-
-class RedisBackedAttr:
-    def __init__(self, key, data_type, default=None):
-        self.key = f"ocpp-relay:{key}"
-        self.data_type = data_type
-        self.default = default
-
-    def __get__(self, instance, owner):
-        val = _redis.get(self.key)
-        # if val is None and self.default is not None:
-        #     self.__set__(instance, self.default)
-        #     return self.default
-        return eval(val) if val is not None else self.default
-
-    def __set__(self, instance, value):
-        current = _redis.get(self.key)
-        if current is None or eval(current) != value:
-            _redis.set(self.key, repr(value))
-
-
-class AppState:
-    """..."""
-
-    csms_info: str = RedisBackedAttr("csms_info", data_type=str, default="")
-    relay_configured: bool = RedisBackedAttr(
-        "relay_configured", data_type=bool, default=False
-    )
-    relay_connected: bool = RedisBackedAttr(
-        "relay_connected", data_type=bool, default=False
-    )
-    relay_url: str = RedisBackedAttr(
-        "relay_url", data_type=str, default="ws://localhost:8500"
-    )
-    charge_point_id: Optional[str] = RedisBackedAttr(
-        "charge_point_id", data_type=str, default=""
-    )
-    latest_event: Optional[str] = RedisBackedAttr(
-        "latest_event", data_type=str, default=""
-    )
-    relay_connection_manager = None
-    events = collections.OrderedDict()
-    injected_message_ids = []
-    _instance = None
-
-    @classmethod
-    def instantiate(cls):
-        # singleton
-        if cls._instance is None:
-            cls._instance = cls()
-        return cls._instance
-
-
-def introduce_statefulness():
-    if "app_state" not in st.session_state:
-        st.session_state.app_state = AppState.instantiate()
+import collections
+import copy
+import dataclasses
+import json
+import logging
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import redis
+import streamlit as st
+
+from core.event_index import EventFilter, EventIndex, EventPage
+from core.tracking import InjectedMessageTracker
+
+
+@dataclasses.dataclass
+class Event:
+    timestamp: int
+    message_name: str
+    request: str
+    response: Optional[str] = None
+    charge_point_id: str = ""
+    injected: bool = False
+    direction: str = ""
+    # Set by the relay once the exchange completes: CALLRESULT, CALLERROR, timeout or closed
+    outcome: str = ""
+    round_trip: Optional[float] = None
+    # Schema violations of the request and response, when the relay validates them
+    violations: List[str] = dataclasses.field(default_factory=list)
+
+
+_redis = redis.Redis(decode_responses=True)
+
+
+class RedisStateStore:
+    """
+    The Redis backed fields of AppState, kept as a single hash of json values. Reads are served from a local copy,
+    fetched in one round-trip and dropped whenever another writer announces a change. Writes update the local copy
+    straight away and are flushed to Redis together after `flush_delay` seconds.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        key: str = "ocpp-relay:state",
+        flush_delay: float = 0.05,
+    ):
+        self.client = client
+        self.key = key
+        self.channel = f"{key}:changed"
+        self.flush_delay = flush_delay
+        self.logger = logging.getLogger(RedisStateStore.__qualname__)
+        self._lock = threading.Lock()
+        # field -> json value, None while it has to be fetched again
+        self._cache: Optional[Dict[str, str]] = None
+        self._generation = 0
+        self._dirty: Dict[str, str] = {}
+        self._flush_timer: Optional[threading.Timer] = None
+        self._listener = None
+        self._writer_id = uuid.uuid4().hex
+        self.fetches = 0
+        self.writes = 0
+        self.flushes = 0
+        self.invalidations = 0
+
+    def _listen(self):
+        if self._listener is None:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self._on_change})
+            self._listener = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def _on_change(self, message):
+        # Own writes are already in the local copy
+        if message["data"] != self._writer_id:
+            with self._lock:
+                self._cache = None
+                self._generation += 1
+                self.invalidations += 1
+
+    def sync(self):
+        """Makes sure the local copy is current, at most one round-trip to Redis."""
+        self._listen()
+        with self._lock:
+            if self._cache is not None:
+                return
+            generation = self._generation
+        fetched = self.client.pipeline(transaction=False).hgetall(self.key).execute()[0]
+        with self._lock:
+            self.fetches += 1
+            # Writes not flushed yet are newer than what Redis has
+            fetched.update(self._dirty)
+            if generation == self._generation:
+                self._cache = fetched
+
+    def get(self, field: str, default=None):
+        self.sync()
+        with self._lock:
+            value = (self._cache or {}).get(field)
+        return json.loads(value) if value is not None else copy.copy(default)
+
+    def set(self, field: str, value):
+        encoded = json.dumps(value)
+        with self._lock:
+            if self._cache is not None and self._cache.get(field) == encoded:
+                return
+            if self._cache is not None:
+                self._cache[field] = encoded
+            self._dirty[field] = encoded
+            self.writes += 1
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_delay, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            self._flush_timer = None
+        if not dirty:
+            return
+        try:
+            pipeline = self.client.pipeline(transaction=False)
+            pipeline.hset(self.key, mapping=dirty)
+            pipeline.publish(self.channel, self._writer_id)
+            pipeline.execute()
+            self.flushes += 1
+        except redis.RedisError as e:
+            self.logger.error(f"Writing state to Redis failed: {e!r}")
+            with self._lock:
+                self._dirty = {**dirty, **self._dirty}
+
+    def stats(self) -> dict:
+        return {
+            "fetches": self.fetches,
+            "writes": self.writes,
+            "flushes": self.flushes,
+            "invalidations": self.invalidations,
+            "unflushed": len(self._dirty),
+        }
+
+
+_store = RedisStateStore(_redis)
+
+
+# Deletes stream entries (entry id, event id pairs) and takes them off the entry counts of their events, events
+# without entries left are dropped from the hash. Atomic, and only entries this call deleted count, so neither an update
+# appended meanwhile nor a concurrent prune of the same entries drops an event too early.
+_TRIM_ENTRIES = """
+local trimmed = 0
+for i = 1, #ARGV, 2 do
+    if redis.call("XDEL", KEYS[1], ARGV[i]) == 1 then
+        trimmed = trimmed + 1
+        if redis.call("HINCRBY", KEYS[2], ARGV[i + 1], -1) <= 0 then
+            redis.call("HDEL", KEYS[2], ARGV[i + 1])
+            redis.call("HDEL", KEYS[3], ARGV[i + 1])
+        end
+    end
+end
+return trimmed
+"""
+
+
+class RedisEventStore:
+    """
+    OCPP events shared through Redis. Every added or updated event is appended, as a whole, to a stream trimmed to
+    `maxlen` entries, and its latest version is kept in a hash by event id as long as the stream holds any entry of
+    it. Each process mirrors the stream locally and a sync only reads the entries it hasn't seen yet.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        key: str = "ocpp-relay:events",
+        maxlen: int = 10000,
+        flush_delay: float = 0.05,
+        prune_every: int = 500,
+        read_batch: int = 1000,
+    ):
+        self.client = client
+        self.stream = key
+        self.hash = f"{key}:by-id"
+        # event id -> entries of the event in the stream
+        self.entries = f"{key}:entries"
+        self.maxlen = maxlen
+        self.flush_delay = flush_delay
+        self.prune_every = prune_every
+        self.read_batch = read_batch
+        self.logger = logging.getLogger(RedisEventStore.__qualname__)
+        self._trim_entries = client.register_script(_TRIM_ENTRIES)
+        self._lock = threading.Lock()
+        self._events: "collections.OrderedDict[str, Event]" = collections.OrderedDict()
+        self._index = EventIndex()
+        self._last_id = "0-0"
+        # event id -> (op, json), several updates of an event within one flush are written once
+        self._unflushed: Dict[str, Tuple[str, str]] = {}
+        self._flush_timer: Optional[threading.Timer] = None
+        self._since_prune = 0
+        self.appended = 0
+        self.read = 0
+        self.pruned = 0
+
+    def _mirror(self, event_id: str, event: Event):
+        self._events[event_id] = event
+        self._index.add(event_id, event)
+        while len(self._events) > self.maxlen:
+            evicted, _ = self._events.popitem(last=False)
+            self._index.evict(evicted)
+
+    def put(self, event_id: str, event: Event):
+        with self._lock:
+            op = "update" if event_id in self._events else "add"
+            if event_id in self._unflushed:
+                op = self._unflushed[event_id][0]
+            self._mirror(event_id, event)
+            self._unflushed[event_id] = (op, json.dumps(dataclasses.asdict(event)))
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_delay, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self):
+        with self._lock:
+            unflushed, self._unflushed = self._unflushed, {}
+            self._flush_timer = None
+        if not unflushed:
+            return
+        try:
+            # A transaction, the entry counts never miss an entry of the stream
+            pipeline = self.client.pipeline()
+            for event_id, (op, encoded) in unflushed.items():
+                pipeline.xadd(self.stream, {"id": event_id, "op": op, "event": encoded})
+                pipeline.hincrby(self.entries, event_id, 1)
+            pipeline.hset(
+                self.hash,
+                mapping={
+                    event_id: encoded for event_id, (_, encoded) in unflushed.items()
+                },
+            )
+            pipeline.execute()
+        except redis.RedisError as e:
+            self.logger.error(f"Writing {len(unflushed)} events to Redis failed: {e!r}")
+            with self._lock:
+                self._unflushed = {**unflushed, **self._unflushed}
+            return
+        self.appended += len(unflushed)
+        self._since_prune += len(unflushed)
+        if self._since_prune >= self.prune_every:
+            self._since_prune = 0
+            self.prune()
+
+    def prune(self):
+        """
+        Trims the stream to `maxlen` entries, events none of whose entries are left in the stream are dropped from the
+        hash too.
+        """
+        excess = self.client.xlen(self.stream) - self.maxlen
+        if excess <= 0:
+            return
+        trimmed = self.client.xrange(self.stream, "-", "+", count=excess)
+        # Exactly the entries read above, even if more were appended meanwhile
+        self.pruned += self._trim_entries(
+            keys=[self.stream, self.entries, self.hash],
+            args=[
+                item
+                for entry_id, fields in trimmed
+                for item in (entry_id, fields["id"])
+            ],
+        )
+
+    def sync(self):
+        """Applies the events appended to the stream since the last sync, by any process."""
+        while True:
+            response = self.client.xread(
+                {self.stream: self._last_id}, count=self.read_batch
+            )
+            if not response:
+                return
+            entries = response[0][1]
+            with self._lock:
+                for _, fields in entries:
+                    self._mirror(fields["id"], Event(**json.loads(fields["event"])))
+                self._last_id = entries[-1][0]
+                self.read += len(entries)
+            if len(entries) < self.read_batch:
+                return
+
+    def lookup(self, event_id: str) -> Optional[Event]:
+        """The latest version of an event straight from Redis, also when it is not mirrored locally."""
+        encoded = self.client.hget(self.hash, event_id)
+        return Event(**json.loads(encoded)) if encoded is not None else None
+
+    def __setitem__(self, event_id: str, event: Event):
+        self.put(event_id, event)
+
+    def __getitem__(self, event_id: str) -> Event:
+        with self._lock:
+            return self._events[event_id]
+
+    def get(self, event_id: str, default=None) -> Optional[Event]:
+        with self._lock:
+            return self._events.get(event_id, default)
+
+    def __contains__(self, event_id: str) -> bool:
+        return event_id in self._events
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def keys(self):
+        with self._lock:
+            return list(self._events.keys())
+
+    def items(self):
+        with self._lock:
+            return list(self._events.items())
+
+    def page(
+        self,
+        event_filter: Optional[EventFilter] = None,
+        before: Optional[int] = None,
+        limit: int = 50,
+    ) -> EventPage:
+        """Newest events matching the filter, answered from the index of the local mirror."""
+        with self._lock:
+            return self._index.page(event_filter, before, limit)
+
+    def values(self, field: str) -> list:
+        with self._lock:
+            return self._index.values(field)
+
+    def stats(self) -> dict:
+        return {
+            "mirrored": len(self._events),
+            "last_id": self._last_id,
+            "appended": self.appended,
+            "read": self.read,
+            "pruned": self.pruned,
+            "unflushed": len(self._unflushed),
+        }
+
+
+class RedisBackedAttr:
+    def __init__(self, key, data_type, default=None):
+        self.key = key
+        self.data_type = data_type
+        self.default = default
+
+    def __get__(self, instance, owner):
+        return _store.get(self.key, self.default)
+
+    def __set__(self, instance, value):
+        _store.set(self.key, value)
+
+
+class AppState:
+    """..."""
+
+    csms_info: str = RedisBackedAttr("csms_info", data_type=str, default="")
+    relay_configured: bool = RedisBackedAttr(
+        "relay_configured", data_type=bool, default=False
+    )
+    relay_connected: bool = RedisBackedAttr(
+        "relay_connected", data_type=bool, default=False
+    )
+    relay_url: str = RedisBackedAttr(
+        "relay_url", data_type=str, default="ws://localhost:8500"
+    )
+    charge_point_id: Optional[str] = RedisBackedAttr(
+        "charge_point_id", data_type=str, default=""
+    )
+    charge_point_ids: list = RedisBackedAttr(
+        "charge_point_ids", data_type=list, default=[]
+    )
+    latest_event: Optional[str] = RedisBackedAttr(
+        "latest_event", data_type=str, default=""
+    )
+    state_store = _store
+    relay_connection_manager = None
+    injection_channel = None
+    events = RedisEventStore(_redis)
+    injected_messages = InjectedMessageTracker()
+    _instance = None
+
+    @classmethod
+    def instantiate(cls):
+        # singleton
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+
+def introduce_statefulness():
+    if "app_state" not in st.session_state:
+        st.session_state.app_state = AppState.instantiate()
+    # A single round-trip per rerun at most, after that all reads are local
+    _store.sync()
+    # Only the events appended since the previous rerun are read
+    st.session_state.app_state.events.sync()
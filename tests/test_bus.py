@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from core.bus import EventBus, OverflowPolicy, SubscriptionClosed
+
+
+def _publish(bus, first, count, charge_point_id="CP_1"):
+    for i in range(first, first + count):
+        bus.publish(f"event-{i}", charge_point_id)
+
+
+def _read(subscription, max_items=256):
+    return asyncio.run(subscription.get_batch(max_items))
+
+
+def test_subscribers_read_from_their_cursor_across_the_wrap_around():
+    bus = EventBus(capacity=4)
+    _publish(bus, 0, 3)
+    # Only what is published after subscribing is delivered
+    subscription = bus.subscribe()
+    _publish(bus, 3, 3)
+    assert _read(subscription, max_items=2) == ["event-3", "event-4"]
+    _publish(bus, 6, 3)
+    assert _read(subscription) == ["event-5", "event-6", "event-7", "event-8"]
+    assert (bus.head, bus.depth, subscription.lag) == (9, 4, 0)
+
+
+def test_lagging_subscriber_drops_the_oldest():
+    bus = EventBus(capacity=4)
+    subscription = bus.subscribe(OverflowPolicy.DROP_OLDEST)
+    _publish(bus, 0, 7)
+    assert _read(subscription) == ["event-3", "event-4", "event-5", "event-6"]
+    assert subscription.dropped == 3
+
+
+def test_lagging_subscriber_drops_the_newest():
+    bus = EventBus(capacity=4)
+    subscription = bus.subscribe(OverflowPolicy.DROP_NEW)
+    _publish(bus, 0, 7)
+    assert _read(subscription) == ["event-0", "event-1", "event-2", "event-3"]
+    assert subscription.dropped == 3
+    # Once the backlog is read, reading resumes with what is published next
+    _publish(bus, 7, 1)
+    assert _read(subscription) == ["event-7"]
+
+
+def test_lagging_subscriber_is_disconnected():
+    bus = EventBus(capacity=4)
+    subscription = bus.subscribe(OverflowPolicy.DISCONNECT)
+    _publish(bus, 0, 5)
+    assert subscription.closed
+    assert not bus.has_subscribers and bus.disconnected == 1
+    with pytest.raises(SubscriptionClosed):
+        _read(subscription)
+
+
+def test_subscription_of_a_charge_point():
+    bus = EventBus(capacity=8)
+    subscription = bus.subscribe(charge_point_id="CP_2")
+    bus.publish("cp-1", "CP_1")
+    bus.publish("relay", None)
+    bus.publish("cp-2", "CP_2")
+    assert _read(subscription) == ["relay", "cp-2"]
@@ -0,0 +1,40 @@
+import asyncio
+import json
+
+from core.capture import CaptureReader, CaptureWriter
+from core.frames import Frame
+
+
+def _capture(directory, first, count, stream="relay7"):
+    async def run():
+        writer = CaptureWriter(directory, stream=stream, segment_size=2000)
+        for i in range(first, first + count):
+            frame = Frame.parse(json.dumps([2, str(i), "Heartbeat", {}]))
+            writer.append(float(i), "CP_1", "cp-csms", frame)
+        await writer.close()
+
+    asyncio.run(run())
+
+
+def test_restarted_stream_continues_after_its_segments(tmp_path):
+    _capture(tmp_path, 0, 60)
+    _capture(tmp_path, 60, 60)
+    reader = CaptureReader(tmp_path)
+    records = list(reader.query())
+    assert [record.message_id for record in records] == [str(i) for i in range(120)]
+    assert [record.message_id for record in reader.search("message_id=75")] == ["75"]
+    assert reader.corrupt == 0
+    reader.close()
+
+
+def test_corrupt_records_are_skipped(tmp_path):
+    _capture(tmp_path, 0, 3)
+    (segment,) = tmp_path.glob("*.cap")
+    data = bytearray(segment.read_bytes())
+    # Invalid utf-8 in the message id of the second record
+    data[len(data) // 3 + 24] = 0xFF
+    segment.write_bytes(bytes(data))
+    reader = CaptureReader(tmp_path)
+    assert [record.message_id for record in reader.query()] == ["0", "2"]
+    assert reader.corrupt == 1
+    reader.close()
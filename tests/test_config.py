@@ -0,0 +1,70 @@
+import argparse
+import json
+
+import pytest
+
+from core.config import ConfigError, ListSetting, csms_info, load_config
+
+
+def _parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config")
+    parser.add_argument("--port", type=int, default=8500)
+    parser.add_argument("--csms-url")
+    parser.add_argument("--link-policy", action=ListSetting, default=[])
+    return parser
+
+
+def _parse(argv, config=None, environ=None, tmp_path=None):
+    parser = _parser()
+    path = None
+    if config is not None:
+        path = tmp_path / "relay.json"
+        path.write_text(json.dumps(config))
+    parser.set_defaults(**load_config(str(path) if path else None, environ or {}))
+    return parser.parse_args(argv)
+
+
+def test_defaults_without_config():
+    args = _parse([])
+    assert (args.port, args.csms_url, args.link_policy) == (8500, None, [])
+
+
+def test_environment_wins_over_file_and_command_line_over_both(tmp_path):
+    config = {"port": 9000, "csms_url": "ws://file"}
+    environ = {"OCPP_RELAY_CSMS_URL": "ws://env"}
+    args = _parse([], config, environ, tmp_path)
+    assert (args.port, args.csms_url) == (9000, "ws://env")
+    args = _parse(["--csms-url", "ws://cli"], config, environ, tmp_path)
+    assert (args.port, args.csms_url) == (9000, "ws://cli")
+
+
+def test_config_file_named_by_environment(tmp_path):
+    path = tmp_path / "relay.json"
+    path.write_text(json.dumps({"csms_url": "ws://file/"}))
+    settings = load_config(environ={"OCPP_RELAY_CONFIG": str(path)})
+    assert csms_info(settings) == {"url": "ws://file", "id": "", "pass": ""}
+
+
+def test_lists_are_replaced_not_appended_to(tmp_path):
+    config = {"link_policy": ["drop"]}
+    assert _parse([], config, tmp_path=tmp_path).link_policy == ["drop"]
+    environ = {"OCPP_RELAY_LINK_POLICY": "cp-csms=close, csms-cp=pause"}
+    args = _parse([], config, environ, tmp_path)
+    assert args.link_policy == ["cp-csms=close", "csms-cp=pause"]
+    argv = ["--link-policy", "pause", "--link-policy", "csms-cp=drop"]
+    args = _parse(argv, config, environ, tmp_path)
+    assert args.link_policy == ["pause", "csms-cp=drop"]
+    # The default isn't changed by the options of a parse
+    assert _parse([]).link_policy == []
+
+
+def test_invalid_settings(tmp_path):
+    with pytest.raises(ConfigError):
+        load_config(environ={"OCPP_RELAY_PORT": "eighty"})
+    with pytest.raises(ConfigError):
+        load_config(environ={"OCPP_RELAY_METRICS": "maybe"})
+    path = tmp_path / "relay.json"
+    path.write_text(json.dumps({"csms": "ws://file"}))
+    with pytest.raises(ConfigError):
+        load_config(str(path), {})
@@ -0,0 +1,64 @@
+import json
+
+from core.correlation import CallCorrelator
+from core.frames import Frame
+
+
+def _frame(*message):
+    return Frame.parse(json.dumps(list(message)))
+
+
+def test_calls_are_matched_with_their_responses():
+    correlator = CallCorrelator("CP_1", clock=lambda: 0.0)
+    correlator.request("cp-csms", _frame(2, "1", "Heartbeat", {}), at=1.0)
+    correlator.request("csms-cp", _frame(2, "1", "Reset", {"type": "Soft"}), at=1.5)
+
+    # Matched in the direction opposite to the response, the same id may be pending both ways
+    result = correlator.response(
+        "csms-cp", _frame(3, "1", {"currentTime": "now"}), at=1.25
+    )
+    assert (result.direction, result.action, result.outcome) == (
+        "cp-csms",
+        "Heartbeat",
+        "CALLRESULT",
+    )
+    assert result.round_trip == 0.25
+    assert json.loads(result.response) == [3, "1", {"currentTime": "now"}]
+
+    error = correlator.response(
+        "cp-csms", _frame(4, "1", "NotSupported", "", {}), at=2.0
+    )
+    assert (error.direction, error.action, error.outcome) == (
+        "csms-cp",
+        "Reset",
+        "CALLERROR",
+    )
+    assert correlator.pending == 0
+    # Answered already, or never seen
+    assert correlator.response("cp-csms", _frame(3, "1", {}), at=2.0) is None
+
+
+def test_unanswered_calls_time_out():
+    correlator = CallCorrelator("CP_1", timeout=10.0, clock=lambda: 0.0)
+    correlator.request("cp-csms", _frame(2, "1", "Heartbeat", {}), at=0.0)
+    correlator.request("cp-csms", _frame(2, "2", "Heartbeat", {}), at=5.0)
+    assert correlator.expire(9.0) == []
+    # Expired calls are returned by the next call recorded
+    expired = correlator.request("csms-cp", _frame(2, "3", "Reset", {}), at=12.0)
+    assert [(e.message_id, e.outcome, e.answered) for e in expired] == [
+        ("1", "timeout", False)
+    ]
+    # A response after the timeout doesn't complete the exchange anymore
+    assert correlator.response("csms-cp", _frame(3, "1", {}), at=12.0) is None
+    assert [e.message_id for e in correlator.expire(15.0)] == ["2"]
+    closed = correlator.close()
+    assert [(e.message_id, e.outcome) for e in closed] == [("3", "closed")]
+
+
+def test_pending_calls_are_bounded():
+    correlator = CallCorrelator("CP_1", max_pending=2, clock=lambda: 0.0)
+    for message_id in ("1", "2"):
+        correlator.request("cp-csms", _frame(2, message_id, "Heartbeat", {}))
+    evicted = correlator.request("cp-csms", _frame(2, "3", "Heartbeat", {}))
+    assert [e.message_id for e in evicted] == ["1"]
+    assert correlator.pending == 2
@@ -0,0 +1,260 @@
+import asyncio
+import json
+import math
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from core.correlation import Exchange
+from core.frames import Frame
+from core.meter_values import (
+    MeterValueAggregator,
+    MeterValueFeed,
+    TransactionSeries,
+    parse_meter_value,
+)
+
+_START = datetime(2025, 1, 1, 10, tzinfo=timezone.utc)
+
+
+def _call(action, payload):
+    return Frame.parse(json.dumps([2, "1", action, payload]))
+
+
+def _transaction_event(event_type, seconds, energy_kwh, power_w=None, soc=None):
+    sampled = [
+        {
+            "value": energy_kwh,
+            "measurand": "Energy.Active.Import.Register",
+            "unitOfMeasure": {"unit": "kWh"},
+        }
+    ]
+    if power_w is not None:
+        sampled.append({"value": power_w, "measurand": "Power.Active.Import"})
+    if soc is not None:
+        sampled.append({"value": soc, "measurand": "SoC"})
+    timestamp = (_START + timedelta(seconds=seconds)).isoformat()
+    return _call(
+        "TransactionEvent",
+        {
+            "eventType": event_type,
+            "timestamp": timestamp,
+            "triggerReason": "MeterValuePeriodic",
+            "seqNo": 0,
+            "transactionInfo": {"transactionId": "tx-1"},
+            "evse": {"id": 1, "connectorId": 1},
+            "meterValue": [{"timestamp": timestamp, "sampledValue": sampled}],
+        },
+    )
+
+
+def test_parse_meter_value_scales_units():
+    _, values = parse_meter_value(
+        {
+            "timestamp": "2025-01-01T00:00:00Z",
+            "sampledValue": [
+                {"value": "1.5", "unit": "kWh"},
+                {"value": 2, "measurand": "Power.Active.Import", "unit": "kW"},
+                {
+                    "value": 3,
+                    "measurand": "Current.Import",
+                    "unitOfMeasure": {"unit": "A", "multiplier": 1},
+                },
+            ],
+        }
+    )
+    assert values == {"energy": 1500.0, "power": 2000.0, "current": 30.0}
+
+
+def test_parse_meter_value_combines_phases():
+    _, values = parse_meter_value(
+        {
+            "timestamp": "2025-01-01T00:00:00Z",
+            "sampledValue": [
+                {"value": "100", "measurand": "Power.Active.Import", "phase": "L1"},
+                {"value": "200", "measurand": "Power.Active.Import", "phase": "L2"},
+                {"value": "10", "measurand": "Current.Import", "phase": "L1"},
+                {"value": "16", "measurand": "Current.Import", "phase": "L2"},
+                {"value": "5", "phase": "L1"},
+                {"value": "42"},
+            ],
+        }
+    )
+    # Powers add up, the current is the highest phase's and a total wins over the phases
+    assert values == {"power": 300.0, "current": 16.0, "energy": 42.0}
+
+
+def test_transaction_event_summary():
+    aggregator = MeterValueAggregator()
+    aggregator.feed("CP_1", _transaction_event("Started", 0, 10.0, 7000, 20))
+    aggregator.feed("CP_1", _transaction_event("Updated", 1800, 13.5, 7400, 50))
+    aggregator.feed("CP_1", _transaction_event("Ended", 3600, 17.0, 6000, 80))
+
+    summary = aggregator.describe("CP_1", "tx-1")["summary"]
+    assert summary["active"] is False
+    assert summary["evse_id"] == 1
+    assert summary["samples"] == 3
+    assert summary["duration"] == 3600
+    assert summary["energy_wh"] == 7000.0
+    assert summary["power_avg_w"] == 7000.0
+    assert summary["power_max_w"] == 7400.0
+    assert (summary["soc_start"], summary["soc_end"]) == (20, 80)
+
+
+def test_ocpp16_transaction_from_start_to_stop():
+    aggregator = MeterValueAggregator()
+    aggregator.feed_exchange(
+        Exchange(
+            charge_point_id="CP_1",
+            direction="cp-csms",
+            message_id="1",
+            action="StartTransaction",
+            request=json.dumps(
+                [
+                    2,
+                    "1",
+                    "StartTransaction",
+                    {
+                        "connectorId": 2,
+                        "idTag": "TAG",
+                        "meterStart": 1000,
+                        "timestamp": "2025-01-01T10:00:00Z",
+                    },
+                ]
+            ),
+            requested_at=0.0,
+            response=json.dumps(
+                [3, "1", {"transactionId": 7, "idTagInfo": {"status": "Accepted"}}]
+            ),
+            outcome="CALLRESULT",
+        )
+    )
+    # Without a transaction id, meter values go to the transaction active on their connector
+    aggregator.feed(
+        "CP_1",
+        _call(
+            "MeterValues",
+            {
+                "connectorId": 2,
+                "meterValue": [
+                    {
+                        "timestamp": "2025-01-01T10:30:00Z",
+                        "sampledValue": [{"value": "2500"}],
+                    }
+                ],
+            },
+        ),
+    )
+    aggregator.feed(
+        "CP_1",
+        _call(
+            "StopTransaction",
+            {
+                "transactionId": 7,
+                "meterStop": 4600,
+                "timestamp": "2025-01-01T11:00:00Z",
+            },
+        ),
+    )
+
+    summary = aggregator.describe("CP_1", "7")["summary"]
+    assert summary["active"] is False
+    assert summary["samples"] == 3
+    assert summary["energy_wh"] == 3600.0
+    assert summary["power_avg_w"] == 3600.0
+    assert aggregator.stats()["active"] == 0
+
+
+def test_unassigned_and_malformed_meter_values():
+    aggregator = MeterValueAggregator()
+    aggregator.feed(
+        "CP_1",
+        _call(
+            "MeterValues",
+            {
+                "evseId": 1,
+                "meterValue": [
+                    {"timestamp": "2025-01-01T10:00:00Z", "sampledValue": []}
+                ],
+            },
+        ),
+    )
+    aggregator.feed("CP_1", _call("MeterValues", {"evseId": 1, "meterValue": 5}))
+    aggregator.feed("CP_1", _call("Heartbeat", {}))
+    stats = aggregator.stats()
+    assert (stats["transactions"], stats["unassigned"], stats["malformed"]) == (
+        0,
+        1,
+        1,
+    )
+
+
+def test_least_recently_updated_transactions_are_forgotten():
+    aggregator = MeterValueAggregator(max_transactions=2)
+    for transaction_id in ("a", "b", "a", "c"):
+        aggregator.feed(
+            "CP_1",
+            _call(
+                "MeterValues",
+                {
+                    "transactionId": transaction_id,
+                    "connectorId": 1,
+                    "meterValue": [
+                        {
+                            "timestamp": "2025-01-01T10:00:00Z",
+                            "sampledValue": [{"value": "1"}],
+                        }
+                    ],
+                },
+            ),
+        )
+    assert [summary["transaction_id"] for summary in aggregator.transactions()] == [
+        "c",
+        "a",
+    ]
+
+
+def test_series_stops_growing_but_summary_does_not():
+    series = TransactionSeries("CP_1", "tx", max_samples=2)
+    for second, energy in enumerate((100.0, 150.0, 400.0)):
+        series.add(float(second), {"energy": energy})
+    assert series.truncated
+    assert series.series() == {
+        "timestamp": [0.0, 1.0],
+        "energy": [100.0, 150.0],
+        "power": [None, None],
+        "current": [None, None],
+        "soc": [None, None],
+    }
+    assert series.summary()["energy_wh"] == 300.0
+    assert math.isnan(series.columns["power"][0])
+
+
+def test_feed_aggregates_off_the_event_loop():
+    async def run():
+        feed = MeterValueFeed(max_buffered=2)
+        feed.feed("CP_1", _transaction_event("Started", 0, 1.0))
+        feed.feed("CP_1", _call("Heartbeat", {}))
+        feed.feed("CP_1", _transaction_event("Ended", 60, 2.0))
+        feed.feed("CP_1", _transaction_event("Ended", 60, 2.0))
+        # Queries see everything fed before them
+        transaction = await feed.query("describe", "CP_1", "tx-1")
+        return transaction, feed.stats()
+
+    transaction, stats = asyncio.run(run())
+    assert transaction["summary"]["energy_wh"] == pytest.approx(1000.0)
+    assert stats["dropped"] == 1
+    assert stats["samples"] == 2
+
+
+def test_closing_the_feed_aggregates_what_is_buffered():
+    async def run():
+        feed = MeterValueFeed(flush_interval=3600)
+        feed.feed("CP_1", _transaction_event("Started", 0, 1.0))
+        await feed.close()
+        feed.feed("CP_1", _transaction_event("Ended", 60, 2.0))
+        return feed
+
+    feed = asyncio.run(run())
+    assert feed.aggregator.stats()["samples"] == 1
+    assert feed.stats()["buffered"] == 0
@@ -0,0 +1,89 @@
+import json
+
+import pytest
+
+from core.frames import Frame
+from core.rules import RuleEngine, RuleError, RuleSet
+
+
+def _apply(specs, message, charge_point_id="CP_1", direction="cp-csms", action=None):
+    engine = RuleEngine(rules=RuleSet(specs))
+    frame = Frame.parse(message)
+    return engine, engine.apply(
+        charge_point_id, direction, frame, action or frame.action, message
+    )
+
+
+def _data_transfer(vendor_id):
+    return json.dumps([2, "1", "DataTransfer", {"vendorId": vendor_id}])
+
+
+def test_frames_no_rule_matches_are_relayed_as_is():
+    specs = [
+        {"action": "DataTransfer", "match": {"vendorId": "com.acme"}, "drop": True},
+        {"action": "DataTransfer", "direction": "csms-cp", "drop": True},
+        {"action": "DataTransfer", "charge_point_id": "CP_2*", "drop": True},
+    ]
+    _, verdict = _apply(specs, _data_transfer("other"))
+    assert verdict is None
+
+
+def test_drop_stops_the_rules_that_follow():
+    specs = [
+        {"name": "acme", "action": "DataTransfer", "drop": True},
+        {"name": "later", "action": "DataTransfer", "duplicate": 1},
+    ]
+    engine, verdict = _apply(specs, _data_transfer("com.acme"))
+    assert verdict.copies == 0
+    assert [rule.name for rule in verdict.rules] == ["acme"]
+    assert engine.stats()["applied"] == {("acme", "drop"): 1}
+
+
+def test_delays_and_duplicates_add_up():
+    message = json.dumps([2, "1", "Heartbeat", {}])
+    specs = [
+        {"action": "Heartbeat", "delay": 0.5, "duplicate": 1},
+        {"charge_point_id": ["CP_?"], "delay": 1.5, "duplicate": 2},
+    ]
+    _, verdict = _apply(specs, message)
+    assert (verdict.delay, verdict.copies) == (2.0, 4)
+    # Frames no rule rewrites are forwarded untouched
+    assert verdict.message is message
+
+
+def test_rewrite():
+    message = json.dumps(
+        [
+            3,
+            "1",
+            {"status": "Accepted", "interval": 300, "currentTime": "now"},
+        ]
+    ).encode()
+    specs = [
+        {
+            "action": "BootNotification",
+            "message_type": "CALLRESULT",
+            "set": {"status": "Pending", "customData.vendorId": "relay"},
+            "remove": "currentTime",
+            "clamp": {"interval": [None, 30]},
+        }
+    ]
+    _, verdict = _apply(specs, message, direction="csms-cp", action="BootNotification")
+    assert verdict.copies == 1
+    # Binary frames stay binary
+    assert json.loads(verdict.message.decode()) == [
+        3,
+        "1",
+        {"status": "Pending", "interval": 30, "customData": {"vendorId": "relay"}},
+    ]
+
+
+def test_invalid_rules_are_rejected():
+    for spec in (
+        {"action": "Heartbeat"},
+        {"action": "Heartbeat", "drop": True, "when": "always"},
+        {"action": "Heartbeat", "delay": -1},
+        {"direction": "sideways", "drop": True},
+    ):
+        with pytest.raises(RuleError):
+            RuleSet([spec])
@@ -0,0 +1,34 @@
+import json
+
+from core.sessions import ChargePointSession
+
+
+def _session(charge_point_id="CP_1"):
+    return ChargePointSession(
+        charge_point_id=charge_point_id, cp_ws=None, ws_subprotocol="ocpp2.0.1"
+    )
+
+
+def test_envelope_embeds_text_frame():
+    message = json.dumps([2, "1", "Heartbeat", {}])
+    event = json.loads(_session().envelope(message, "cp-csms"))
+    assert event == {
+        "event": "Message",
+        "payload": {
+            "charge_point_id": "CP_1",
+            "direction": "cp-csms",
+            "message": [2, "1", "Heartbeat", {}],
+        },
+    }
+
+
+def test_envelope_embeds_binary_frame():
+    message = json.dumps([2, "1", "Heartbeat", {"ä": 1}], ensure_ascii=False).encode()
+    event = json.loads(_session().envelope(message, "csms-cp"))
+    assert event["payload"]["message"] == [2, "1", "Heartbeat", {"ä": 1}]
+    assert event["payload"]["direction"] == "csms-cp"
+
+
+def test_envelope_escapes_charge_point_id():
+    event = json.loads(_session('CP "1"').envelope('[3, "1", {}]', "csms-cp"))
+    assert event["payload"]["charge_point_id"] == 'CP "1"'
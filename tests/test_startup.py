@@ -0,0 +1,68 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+# Generous for CI machines, the relay is usually ready well within a second
+READY_WITHIN = 10.0
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def test_import_keeps_heavy_modules_off_the_startup_path():
+    # In a fresh interpreter, modules imported by other tests would hide a regression
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import json, sys, relay; print(json.dumps(sorted(sys.modules)))",
+        ],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = {module.split(".")[0] for module in json.loads(result.stdout)}
+    assert not modules & {"streamlit", "redis", "dataclasses_json"}
+
+
+def test_relay_is_ready_quickly():
+    port = _free_port()
+    env = dict(
+        os.environ, OCPP_RELAY_CSMS_URL="ws://localhost:9000", OCPP_RELAY_PORT=str(port)
+    )
+    started = time.perf_counter()
+    relay = subprocess.Popen(
+        [sys.executable, str(ROOT / "relay.py")],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            assert relay.poll() is None, f"The relay exited with {relay.returncode}"
+            try:
+                with urllib.request.urlopen(
+                    f"http://localhost:{port}/ready", timeout=1
+                ) as response:
+                    status = response.status
+                    break
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            assert time.perf_counter() - started < READY_WITHIN
+            time.sleep(0.01)
+    finally:
+        relay.terminate()
+        relay.wait()
+    assert status == 200
@@ -0,0 +1,52 @@
+from core.tracking import InjectedMessageTracker
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_injected_calls_expire_after_their_ttl():
+    clock = _Clock()
+    tracker = InjectedMessageTracker(ttl=10.0, clock=clock)
+    tracker.add("CP_1", "csms-cp", "1")
+    clock.now = 5.0
+    tracker.add("CP_1", "csms-cp", "2")
+    assert tracker.is_pending("CP_1", "csms-cp", "1")
+    clock.now = 10.0
+    assert not tracker.is_pending("CP_1", "csms-cp", "1")
+    assert tracker.pending == 1
+    # A response after the TTL isn't matched anymore
+    clock.now = 15.0
+    assert not tracker.complete("CP_1", "csms-cp", "2")
+    assert tracker.stats() == {
+        "pending": 0,
+        "injected": 2,
+        "completed": 0,
+        "expired": 2,
+        "discarded": 0,
+    }
+
+
+def test_complete_and_discard():
+    tracker = InjectedMessageTracker(clock=_Clock())
+    tracker.add("CP_1", "csms-cp", "1")
+    tracker.add("CP_1", "cp-csms", "1")
+    assert not tracker.complete("CP_1", "csms-cp", "2")
+    assert tracker.complete("CP_1", "csms-cp", "1")
+    assert tracker.discard("CP_1", "cp-csms", "1")
+    assert not tracker.discard("CP_1", "cp-csms", "1")
+    assert (tracker.completed, tracker.discarded, tracker.pending) == (1, 1, 0)
+
+
+def test_discard_charge_point():
+    tracker = InjectedMessageTracker(clock=_Clock())
+    tracker.add("CP_1", "csms-cp", "1")
+    tracker.add("CP_1", "cp-csms", "2")
+    tracker.add("CP_2", "csms-cp", "1")
+    assert tracker.discard_charge_point("CP_1") == 2
+    assert not tracker.is_pending("CP_1", "csms-cp", "1")
+    assert tracker.is_pending("CP_2", "csms-cp", "1")